@@ -1,7 +1,7 @@
 from django.contrib import admin
 from django.contrib.contenttypes.generic import GenericInlineModelAdmin
 from django.contrib.contenttypes.models import ContentType
-from django.core.exceptions import ObjectDoesNotExist, PermissionDenied
+from django.core.exceptions import PermissionDenied
 from django.http import HttpResponseRedirect
 from django.shortcuts import render_to_response
 from django.utils.translation import ugettext_lazy as _
@@ -10,6 +10,7 @@ from django.utils.encoding import force_unicode
 from threadedcomments.admin import ThreadedCommentsAdmin
 from threadedcomments.models import ThreadedComment
 
+from ella_comments import moderation
 from ella_comments.models import CommentOptionsObject
 
 class CommentOptionsGenericInline(GenericInlineModelAdmin):
@@ -37,11 +38,7 @@ class CommentsAdmin(ThreadedCommentsAdmin):
             raise PermissionDenied
 
         if request.POST: # The user has already confirmed the deletion.
-            for comment in comments:
-                try:
-                    comment.delete()
-                except ObjectDoesNotExist, e:
-                    pass
+            moderation.delete_comments(comments)
 
             from django.contrib.admin.models import LogEntry, CHANGE
             LogEntry.objects.log_action(request.user.id, ct.id, id, force_unicode(obj),
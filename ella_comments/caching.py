@@ -0,0 +1,161 @@
+"""
+Cache helper protecting expensive values from cache stampedes.
+
+Values are stored together with a soft expiration time. After it passes, one
+worker (holding a lock in cache) recomputes the value while everybody else
+keeps getting the stale one for a grace period. Threads within one process
+missing the same key at the same time share a single computation.
+"""
+import time
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+# how long can stale values be served while being recomputed
+GRACE_PERIOD = getattr(settings, 'COMMENTS_CACHE_GRACE_PERIOD', 60)
+# how long can a lock be held before another worker gives up on it
+LOCK_TIMEOUT = getattr(settings, 'COMMENTS_CACHE_LOCK_TIMEOUT', 10)
+# how long to wait for another worker computing a missing value
+LOCK_WAIT = getattr(settings, 'COMMENTS_CACHE_LOCK_WAIT', 1.0)
+LOCK_POLL_INTERVAL = 0.05
+
+STATS = {
+    # value was computed by another thread in this process
+    'coalesced': 0,
+    # stale value was served while another worker recomputes it
+    'stale_served': 0,
+    # waited for another worker to compute a missing value
+    'lock_waits': 0,
+    # value was computed
+    'computed': 0,
+}
+_stats_lock = threading.Lock()
+
+def _incr(stat):
+    _stats_lock.acquire()
+    try:
+        STATS[stat] += 1
+    finally:
+        _stats_lock.release()
+
+def get_stats():
+    " Return a copy of the counters. "
+    return dict(STATS)
+
+def reset_stats():
+    for k in STATS:
+        STATS[k] = 0
+
+
+class _Call(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.done = False
+        self.value = None
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+def _coalesce(key, compute):
+    " Run ``compute`` only once for all threads asking for ``key`` at once. "
+    _inflight_lock.acquire()
+    try:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = _Call()
+    finally:
+        _inflight_lock.release()
+
+    if not leader:
+        call.event.wait(LOCK_TIMEOUT)
+        if call.done:
+            _incr('coalesced')
+            return call.value
+        # the other thread failed, try ourselves
+        return compute()
+
+    try:
+        call.value = compute()
+        call.done = True
+        return call.value
+    finally:
+        _inflight_lock.acquire()
+        try:
+            del _inflight[key]
+        finally:
+            _inflight_lock.release()
+        call.event.set()
+
+def _lock_key(key):
+    return 'lock:%s' % key
+
+def _compute_and_store(key, compute, timeout):
+    value = compute()
+    _incr('computed')
+    cache.set(key, (value, time.time() + timeout), timeout + GRACE_PERIOD)
+    return value
+
+def _refresh(key, compute, timeout):
+    " Compute the value under a lock, return None if somebody else holds it. "
+    lock_key = _lock_key(key)
+    if not cache.add(lock_key, 1, LOCK_TIMEOUT):
+        return None
+    try:
+        return (_compute_and_store(key, compute, timeout), )
+    finally:
+        cache.delete(lock_key)
+
+def _fill(key, compute, timeout):
+    " Value is missing from cache, compute it or wait for whoever does. "
+    result = _refresh(key, compute, timeout)
+    if result is not None:
+        return result[0]
+
+    # another worker is computing the value, wait for it
+    _incr('lock_waits')
+    waited = 0
+    while waited < LOCK_WAIT:
+        time.sleep(LOCK_POLL_INTERVAL)
+        waited += LOCK_POLL_INTERVAL
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+
+    # it takes too long, compute it ourselves
+    return _compute_and_store(key, compute, timeout)
+
+def get_cached(key, compute, timeout):
+    """
+    Return value stored in cache under ``key``, use ``compute()`` to get it
+    when missing. ``timeout`` is the soft timeout after which the value gets
+    recomputed, stale value is kept for GRACE_PERIOD more seconds to be served
+    while the recomputation runs.
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        value, expires = entry
+        if expires > time.time():
+            return value
+
+        # stale, recompute if nobody else does
+        result = _coalesce(key, lambda: _refresh(key, compute, timeout))
+        if result is not None:
+            return result[0]
+        _incr('stale_served')
+        return value
+
+    return _coalesce(key, lambda: _fill(key, compute, timeout))
+
+def get_many_cached(keys):
+    """
+    Bulk lookup of values stored by ``get_cached``, returns a dict of the
+    values found (including stale ones), never computes anything.
+    """
+    return dict((k, entry[0]) for k, entry in cache.get_many(keys).items())
+
+def set_many_cached(data, timeout):
+    " Bulk store of values to be read by ``get_cached``. "
+    expires = time.time() + timeout
+    cache.set_many(dict((k, (v, expires)) for k, v in data.items()), timeout + GRACE_PERIOD)
@@ -0,0 +1,202 @@
+"""
+Optional deferred execution of the redis listing handlers.
+
+With ``COMMENTS_DEFERRED_HANDLERS`` set, the handlers updating comment counts
+and listings in redis don't run within the request posting or moderating the
+comment. Instead a task (handler name, comment id, its previous publication
+info and the flags the change produced) is queued and executed later:
+
+    ``'thread'``
+        by a pool of ``COMMENTS_DEFERRED_THREADS`` threads in the same process,
+        tasks of one commented object are always executed by the same thread
+    ``'redis'``
+        by the ``process_comment_tasks`` management command consuming a redis
+        list, run just one of them to keep the tasks in order
+
+Tasks created within a managed transaction during a request are only queued
+once the request is finished (even a failed one - tasks of a rolled back
+transaction find nothing to do) so that the workers see the committed data.
+Outside of requests tasks are queued right away. Failed tasks are retried
+``COMMENTS_DEFERRED_RETRIES`` times.
+"""
+import time
+import logging
+import threading
+from Queue import Queue
+
+from django.conf import settings
+from django.contrib import comments
+from django.core.signals import request_started, request_finished
+from django.db import transaction, close_connection
+from django.utils import simplejson as json
+
+from ella.core.cache.redis import client
+
+log = logging.getLogger('ella_comments')
+
+MODE = getattr(settings, 'COMMENTS_DEFERRED_HANDLERS', None)
+QUEUE_KEY = getattr(settings, 'COMMENTS_DEFERRED_QUEUE', 'comments:tasks')
+THREADS = getattr(settings, 'COMMENTS_DEFERRED_THREADS', 2)
+MAX_RETRIES = getattr(settings, 'COMMENTS_DEFERRED_RETRIES', 3)
+# seconds, multiplied by the number of the attempt
+RETRY_DELAY = getattr(settings, 'COMMENTS_DEFERRED_RETRY_DELAY', 1)
+
+_handlers = {}
+
+def register(name, handler):
+    " Make ``handler(comment)`` available for deferred execution as ``name``. "
+    _handlers[name] = handler
+
+def run_task(task):
+    """
+    Execute a task, raise an exception on failure. Tasks for comments that
+    don't exist (anymore) are dropped. The handler gets the comment with the
+    flags it had when the task was created, not the ones in the database -
+    those may have been changed again by a task still waiting in the queue.
+    """
+    name, comment_pk, pub_info, flags = task[:4]
+    try:
+        comment = comments.get_model()._default_manager.get(pk=comment_pk)
+    except comments.get_model().DoesNotExist:
+        log.warning('Dropping deferred %s, comment %s does not exist.', name, comment_pk)
+        return
+    if pub_info is not None:
+        setattr(comment, '__pub_info', pub_info)
+    if flags is not None:
+        for f, value in flags.items():
+            setattr(comment, f, value)
+    _handlers[name](comment)
+
+
+# tasks waiting for the end of the current request
+_local = threading.local()
+
+def _pending():
+    if not hasattr(_local, 'tasks'):
+        _local.tasks = []
+    return _local.tasks
+
+def defer(name, comment, pub_info=None):
+    " Schedule handler registered as ``name`` to run for ``comment``. "
+    flags = {'is_public': comment.is_public, 'is_removed': comment.is_removed}
+    task = (name, comment.pk, pub_info, flags, 0)
+    key = '%s:%s' % (comment.content_type_id, comment.object_pk)
+    if getattr(_local, 'in_request', False) and transaction.is_managed():
+        _pending().append((task, key))
+    else:
+        enqueue(task, key)
+
+def start(**kwargs):
+    _local.in_request = True
+
+def flush(**kwargs):
+    " Queue all the tasks waiting for the end of request. "
+    tasks, _local.tasks = _pending(), []
+    _local.in_request = False
+    for task, key in tasks:
+        enqueue(task, key)
+
+def discard(**kwargs):
+    " Forget tasks waiting for the end of request. "
+    _local.tasks = []
+    _local.in_request = False
+
+request_started.connect(start)
+request_finished.connect(flush)
+
+
+def enqueue(task, key=None):
+    """
+    Queue ``task``, tasks with the same ``key`` (the commented object) are
+    executed in the order they were queued.
+    """
+    if MODE == 'redis':
+        client.rpush(QUEUE_KEY, json.dumps(task))
+    else:
+        _start_threads()
+        _get_queue(key).put((task, key))
+
+def retry(task, key=None):
+    """
+    Schedule failed ``task`` to be executed again, return False if it
+    has been tried too many times. Tasks queued after it may run first.
+    """
+    name, comment_pk, attempt = task[0], task[1], task[-1]
+    if attempt >= MAX_RETRIES:
+        log.error('Giving up deferred %s for comment %s after %d attempts.', name, comment_pk, attempt + 1)
+        return False
+
+    task = task[:-1] + (attempt + 1, )
+    delay = RETRY_DELAY * (attempt + 1)
+    if MODE == 'redis':
+        # the worker is single threaded, don't block it
+        client.zadd(QUEUE_KEY + ':retry', json.dumps(task), time.time() + delay)
+    else:
+        timer = threading.Timer(delay, _get_queue(key).put, [(task, key)])
+        timer.setDaemon(True)
+        timer.start()
+    return True
+
+def execute(task, key=None):
+    " Run ``task`` scheduling a retry if it fails, return True on success. "
+    try:
+        run_task(task)
+        return True
+    except Exception:
+        log.exception('Deferred %s for comment %s failed.', task[0], task[1])
+        retry(task, key)
+        return False
+
+
+# thread pool, every thread has its own queue
+_queues = [Queue() for i in xrange(max(THREADS, 1))]
+_threads = []
+_threads_lock = threading.Lock()
+
+def _get_queue(key):
+    return _queues[hash(key) % len(_queues)]
+
+def _worker(queue):
+    while True:
+        execute(*queue.get())
+        # don't keep a transaction open between tasks
+        close_connection()
+        queue.task_done()
+
+def _start_threads():
+    if _threads:
+        return
+    _threads_lock.acquire()
+    try:
+        for queue in _queues[len(_threads):]:
+            t = threading.Thread(target=_worker, args=(queue, ), name='ella-comments-deferred')
+            t.setDaemon(True)
+            t.start()
+            _threads.append(t)
+    finally:
+        _threads_lock.release()
+
+
+# redis worker
+def requeue_retries():
+    " Move tasks whose retry delay passed back to the queue. "
+    retry_key = QUEUE_KEY + ':retry'
+    now = time.time()
+    pipe = client.pipeline()
+    pipe.zrangebyscore(retry_key, '-inf', now)
+    pipe.zremrangebyscore(retry_key, '-inf', now)
+    tasks = pipe.execute()[0]
+    if tasks:
+        client.rpush(QUEUE_KEY, *tasks)
+
+def process_queue(timeout=1):
+    """
+    Execute one task from the redis queue waiting at most ``timeout`` seconds
+    for it, return False if there was nothing to do.
+    """
+    requeue_retries()
+    item = client.blpop(QUEUE_KEY, timeout)
+    if item is None:
+        return False
+    execute(tuple(json.loads(item[1])))
+    return True
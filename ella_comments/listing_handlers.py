@@ -1,11 +1,19 @@
 import logging
+from datetime import date
 
+from django.conf import settings
 from django.contrib import comments
+from django.contrib.contenttypes.models import ContentType
 
+from ella.core.cache import get_cached_object
 from ella.core.cache.redis import RedisListingHandler, client, SlidingListingHandler, TimeBasedListingHandler
 from ella.core.models import Publishable, Listing
 from ella.utils.timezone import to_timestamp
 
+from threadedcomments.models import PATH_DIGITS, PATH_SEPARATOR
+
+from ella_comments import deferred
+
 log = logging.getLogger('ella_comments')
 
 MOST_COMMENTED_LH = 'most_commented'
@@ -16,6 +24,22 @@ LAST_COMMENTED_LH = 'last_commented'
 COMCOUNT_KEY = 'comcount:pub:%s:%s'
 LASTCOM_KEY = 'lastcom:pub:%s:%s'
 
+# optional index of listed comments for each object and site, see CachedCommentList
+COMINDEX_DATE_KEY = 'comidx:date:%s:%s:%s'
+COMINDEX_TREE_KEY = 'comidx:tree:%s:%s:%s'
+COMINDEX_READY_KEY = 'comidx:ready:%s:%s:%s'
+COMINDEX_TIMEOUT = getattr(settings, 'COMMENTS_REDIS_INDEX_TIMEOUT', 24 * 60 * 60)
+
+# comments waiting for moderation, ordered by submit_date
+PENDING_SITE_KEY = 'compending:site:%s'
+PENDING_CATEGORY_KEY = 'compending:cat:%s'
+# number of comments waiting for moderation per object
+PENDING_COUNT_KEY = 'compending:pub:%s:%s'
+
+# numbers of listed replies in each thread of an object, a hash keyed by the
+# zero padded id of the root comment (the first PATH_DIGITS of tree_path)
+COMREPLIES_KEY = 'comreplies:pub:%s:%s'
+
 class RecentMostCommentedListingHandler(SlidingListingHandler):
     PREFIX = 'slidingccount'
 
@@ -25,53 +49,141 @@ class MostCommentedListingHandler(RedisListingHandler):
 class LastCommentedListingHandler(TimeBasedListingHandler):
     PREFIX = 'lastcom'
 
+def _public_comments(ct_id, object_pk):
+    return comments.get_model()._default_manager.filter(
+        content_type=ct_id,
+        object_pk=object_pk,
+        is_public=True,
+        is_removed=False
+    )
+
 def comment_post_save(instance, **kwargs):
-    if hasattr(instance, '__pub_info'):
-        is_public = instance.is_public and not instance.is_removed
-        was_public = instance.__pub_info['is_public'] and not instance.__pub_info['is_removed']
-
-        # Base queryset for public comments
-        public_comments = comments.get_model()._default_manager.filter(
-            content_type=instance.content_type_id,
-            object_pk=instance.object_pk,
-            is_public=True,
-            is_removed=False
-        )
-
-        # If the comment's "publicity" was modified in any way, update the count key
-        if (was_public and not is_public) or (not was_public and is_public):
-            client.set(
-                COMCOUNT_KEY % (instance.content_type_id, instance.object_pk),
-                public_comments.count()
-            )
-        # If no change to the "publicity" of the comment was made, return
+    """
+    Adjust the counter and listings of the commented object when a comment's
+    "publicity" changes. The counter is only incremented or decremented, the
+    last comment is recomputed only if it is the one affected.
+    """
+    if not hasattr(instance, '__pub_info'):
+        return
+
+    is_public = instance.is_public and not instance.is_removed
+    was_public = instance.__pub_info['is_public'] and not instance.__pub_info['is_removed']
+
+    # If no change to the "publicity" of the comment was made, return
+    if is_public == was_public:
+        return
+
+    ct_id, object_pk = instance.content_type_id, instance.object_pk
+    count_key = COMCOUNT_KEY % (ct_id, object_pk)
+    last_keu = LASTCOM_KEY % (ct_id, object_pk)
+    diff = is_public and 1 or -1
+
+    submit_date = to_timestamp(instance.submit_date)
+    last_date = client.hget(last_keu, 'submit_date')
+    update_last, lastcom = False, None
+    if is_public:
+        if last_date is None or submit_date > float(last_date):
+            update_last, lastcom = True, _lastcom_data(instance)
+    elif last_date is not None and submit_date >= float(last_date):
+        # the last comment is gone, find the previous one
+        update_last = True
+        latest = list(_public_comments(ct_id, object_pk).order_by('-submit_date')[:1])
+        if latest:
+            lastcom = _lastcom_data(latest[0])
+
+    pipe = client.pipeline()
+    pipe.incrby(count_key, diff)
+    if update_last:
+        if lastcom:
+            pipe.delete(last_keu)
+            pipe.hmset(last_keu, lastcom)
         else:
-            return
-
-        # Update the last comment info
-        last_keu = LASTCOM_KEY % (instance.content_type_id, instance.object_pk)
-        try:
-            last_com = public_comments.latest('submit_date')
-            client.hmset(last_keu, {
-                'submit_date': repr(to_timestamp(last_com.submit_date)),
-                'user_id': last_com.user_id or '',
-                'username': last_com.user_name,
-                'comment': last_com.comment,
-                'url': last_com.url,
-            })
-        except comments.get_model().DoesNotExist:
-            client.delete(last_keu)
-
-        # update the listing handlers
-        obj = instance.content_object
-        if isinstance(obj, Publishable) and obj.is_published():
-            publishable_published(obj)
+            pipe.delete(last_keu)
+
+    # update the listing handlers
+    obj = instance.content_object
+    if isinstance(obj, Publishable) and obj.is_published():
+        if get_listing_handler(MOST_COMMENTED_LH):
+            incr_listing_score(get_listing_handler(MOST_COMMENTED_LH), obj, diff, pipe)
 
+        if update_last and get_listing_handler(LAST_COMMENTED_LH):
+            if lastcom:
+                get_listing_handler(LAST_COMMENTED_LH).add_publishable(obj.category, obj, lastcom['submit_date'], pipe=pipe, commit=False)
+            else:
+                get_listing_handler(LAST_COMMENTED_LH).remove_publishable(obj.category, obj, pipe=pipe, commit=False)
+
+    if int(pipe.execute()[0]) < 0:
+        # the counter was missing or drifted, recompute it
+        reconcile_comment_count(ct_id, object_pk)
+
+def reconcile_comment_count(ct_id, object_pk):
+    """
+    Recompute the counter and the last comment of given object from the
+    database and update its listings accordingly.
+    """
+    public_comments = _public_comments(ct_id, object_pk)
+    count_key = COMCOUNT_KEY % (ct_id, object_pk)
+    last_keu = LASTCOM_KEY % (ct_id, object_pk)
+
+    pipe = client.pipeline()
+    pipe.set(count_key, public_comments.count())
+    pipe.delete(last_keu)
+    latest = list(public_comments.order_by('-submit_date')[:1])
+    if latest:
+        pipe.hmset(last_keu, _lastcom_data(latest[0]))
+    pipe.execute()
+
+    ct = ContentType.objects.get_for_id(ct_id)
+    try:
+        obj = get_cached_object(ct, pk=object_pk)
+    except ct.model_class().DoesNotExist:
+        return
+    if isinstance(obj, Publishable) and obj.is_published():
+        publishable_published(obj)
+
+
+_listing_handlers = {}
+
+def get_listing_handler(name):
+    " Memoized ``Listing.objects.get_listing_handler`` without fallback. "
+    if name not in _listing_handlers:
+        _listing_handlers[name] = Listing.objects.get_listing_handler(name, fallback=False)
+    return _listing_handlers[name]
+
+def _lastcom_data(comment):
+    return {
+        'submit_date': repr(to_timestamp(comment.submit_date)),
+        'user_id': comment.user_id or '',
+        'username': comment.user_name,
+        'comment': comment.comment,
+        'url': comment.url,
+    }
+
+def incr_listing_score(ListingHandler, publishable, incr_by, pipe):
+    """
+    Like ``ListingHandler.incr_score`` but without any extra round trips, the
+    sliding window bookkeeping done by ``SlidingListingHandler.get_keys`` is
+    added to ``pipe`` instead of being executed right away.
+    """
+    category = publishable.category
+    if issubclass(ListingHandler, SlidingListingHandler):
+        base_keys = super(SlidingListingHandler, ListingHandler).get_keys(category, publishable)
+        day = date.today().strftime('%Y%m%d')
+        day_keys = ['%s:%s' % (k, day) for k in base_keys]
+        pipe.sadd(ListingHandler.base_key_set(), *base_keys)
+        pipe.zadd(ListingHandler.window_key_zset(), **dict((k, day) for k in day_keys))
+        keys = base_keys + day_keys
+    else:
+        keys = ListingHandler.get_keys(category, publishable)
+
+    value = ListingHandler.get_value(publishable)
+    for k in keys:
+        pipe.zincrby(k, value, incr_by)
 
 def publishable_unpublished(publishable, **kwargs):
     pipe = client.pipeline()
     for k in (MOST_COMMENTED_LH, LAST_COMMENTED_LH, RECENTLY_COMMENTED_LH):
-        ListingHandler = Listing.objects.get_listing_handler(k, fallback=False)
+        ListingHandler = get_listing_handler(k)
         if ListingHandler is None:
             continue
         ListingHandler.remove_publishable(publishable.category, publishable, pipe=pipe, commit=False)
@@ -86,46 +198,319 @@ def publishable_published(publishable, **kwargs):
     if cnt is None:
         cnt = 0
 
-    if Listing.objects.get_listing_handler(MOST_COMMENTED_LH, fallback=False):
-        Listing.objects.get_listing_handler(MOST_COMMENTED_LH).add_publishable(publishable.category, publishable, cnt, pipe=pipe, commit=False)
+    if get_listing_handler(MOST_COMMENTED_LH):
+        get_listing_handler(MOST_COMMENTED_LH).add_publishable(publishable.category, publishable, cnt, pipe=pipe, commit=False)
 
-    if lastcom and Listing.objects.get_listing_handler(LAST_COMMENTED_LH, fallback=False):
-        Listing.objects.get_listing_handler(LAST_COMMENTED_LH).add_publishable(publishable.category, publishable, lastcom['submit_date'], pipe=pipe, commit=False)
+    if lastcom and get_listing_handler(LAST_COMMENTED_LH):
+        get_listing_handler(LAST_COMMENTED_LH).add_publishable(publishable.category, publishable, lastcom['submit_date'], pipe=pipe, commit=False)
 
     pipe.execute()
 
 def comment_posted(comment, **kwargs):
+    """
+    Update the counter, the last comment and all the listings of the commented
+    object atomically in a single round trip (MULTI/EXEC). Comments that
+    aren't public are counted by ``comment_post_save`` once approved.
+    """
+    if not comment.is_public or comment.is_removed:
+        return
+
     count_key = COMCOUNT_KEY % (comment.content_type_id, comment.object_pk)
     last_keu = LASTCOM_KEY % (comment.content_type_id, comment.object_pk)
 
     pipe = client.pipeline()
     pipe.incr(count_key)
-    pipe.hmset(last_keu, {
-        'submit_date': repr(to_timestamp(comment.submit_date)),
-        'user_id': comment.user_id or '',
-        'username': comment.user_name,
-        'comment': comment.comment,
-        'url': comment.url,
-    })
+    lastcom = _lastcom_data(comment)
+    pipe.hmset(last_keu, lastcom)
 
     obj = comment.content_object
-    if not isinstance(obj, Publishable) or not obj.is_published():
-        pipe.execute()
-    elif Listing.objects.get_listing_handler(RECENTLY_COMMENTED_LH, fallback=False):
-        Listing.objects.get_listing_handler(RECENTLY_COMMENTED_LH).incr_score(obj.category, obj, pipe=pipe, commit=False)
-        pipe.execute()
-        publishable_published(obj)
+    if isinstance(obj, Publishable) and obj.is_published():
+        if get_listing_handler(RECENTLY_COMMENTED_LH):
+            incr_listing_score(get_listing_handler(RECENTLY_COMMENTED_LH), obj, 1, pipe)
+
+        # the score equals the counter as long as they are updated together
+        if get_listing_handler(MOST_COMMENTED_LH):
+            incr_listing_score(get_listing_handler(MOST_COMMENTED_LH), obj, 1, pipe)
+
+        if get_listing_handler(LAST_COMMENTED_LH):
+            get_listing_handler(LAST_COMMENTED_LH).add_publishable(obj.category, obj, lastcom['submit_date'], pipe=pipe, commit=False)
+
+    pipe.execute()
+
+def comment_index_enabled():
+    return bool(client) and getattr(settings, 'COMMENTS_REDIS_INDEX', False)
+
+def is_listed(is_public, is_removed):
+    " Would a comment with these flags be displayed in CachedCommentList? "
+    if getattr(settings, 'COMMENTS_HIDE_REMOVED', False) and is_removed:
+        return False
+    return is_public
+
+def _index_member(pk):
+    # zero padded so that lexical order of members equals numerical order
+    return str(pk).zfill(PATH_DIGITS)
+
+def _index_args(comment):
+    return (comment.content_type_id, comment.object_pk, comment.site_id)
+
+def index_add(comment, pipe):
+    args = _index_args(comment)
+    pipe.zadd(COMINDEX_DATE_KEY % args, _index_member(comment.pk), repr(to_timestamp(comment.submit_date)))
+    # same score for everything, members (tree_paths) are then sorted lexically
+    pipe.zadd(COMINDEX_TREE_KEY % args, comment.tree_path, 0)
+
+def index_remove(comment, pipe):
+    args = _index_args(comment)
+    pipe.zrem(COMINDEX_DATE_KEY % args, _index_member(comment.pk))
+    pipe.zrem(COMINDEX_TREE_KEY % args, comment.tree_path)
+
+def build_comment_index(ct_id, object_pk, site_id, rows):
+    """
+    (Re)build the index for given object and site from ``rows`` - triples of
+    (pk, tree_path, submit_date) of all the listed comments. The index expires
+    after COMINDEX_TIMEOUT to limit the effect of any missed updates.
+    """
+    date_key = COMINDEX_DATE_KEY % (ct_id, object_pk, site_id)
+    tree_key = COMINDEX_TREE_KEY % (ct_id, object_pk, site_id)
+
+    pipe = client.pipeline()
+    pipe.delete(date_key, tree_key)
+    for pk, tree_path, submit_date in rows:
+        pipe.zadd(date_key, _index_member(pk), repr(to_timestamp(submit_date)))
+        pipe.zadd(tree_key, tree_path, 0)
+    pipe.setex(COMINDEX_READY_KEY % (ct_id, object_pk, site_id), 1, COMINDEX_TIMEOUT)
+    pipe.execute()
+
+def get_index_range(ct_id, object_pk, site_id, flat, ascending, start, stop):
+    """
+    Return ids of comments on positions ``start``:``stop`` of the index, None
+    if the index for the object hasn't been built.
+    """
+    if flat:
+        key = COMINDEX_DATE_KEY % (ct_id, object_pk, site_id)
+    else:
+        key = COMINDEX_TREE_KEY % (ct_id, object_pk, site_id)
+    if stop is None:
+        stop = 0
+    pipe = client.pipeline()
+    pipe.exists(COMINDEX_READY_KEY % (ct_id, object_pk, site_id))
+    if ascending:
+        pipe.zrange(key, start, stop - 1)
+    else:
+        pipe.zrevrange(key, start, stop - 1)
+    ready, members = pipe.execute()
+
+    if not ready:
+        return None
+    # tree_path ends with the zero padded id
+    return [int(m[-PATH_DIGITS:]) for m in members]
+
+def get_index_rank(ct_id, object_pk, site_id, flat, ascending, comment):
+    """
+    Return a tuple (ready, position) where position is the rank of
+    ``comment`` in the index or None if it's not there. ``ready`` is False if
+    the index for the object hasn't been built.
+    """
+    if flat:
+        key, member = COMINDEX_DATE_KEY % (ct_id, object_pk, site_id), _index_member(comment.pk)
+    else:
+        key, member = COMINDEX_TREE_KEY % (ct_id, object_pk, site_id), comment.tree_path
+    pipe = client.pipeline()
+    pipe.exists(COMINDEX_READY_KEY % (ct_id, object_pk, site_id))
+    if ascending:
+        pipe.zrank(key, member)
+    else:
+        pipe.zrevrank(key, member)
+    ready, rank = pipe.execute()
+    return bool(ready), rank
+
+def index_comment_posted(comment, **kwargs):
+    if not comment_index_enabled() or not is_listed(comment.is_public, comment.is_removed):
+        return
+    pipe = client.pipeline()
+    index_add(comment, pipe)
+    pipe.execute()
+
+def index_comment_post_save(instance, **kwargs):
+    if not comment_index_enabled() or not hasattr(instance, '__pub_info'):
+        return
+    was_listed = is_listed(instance.__pub_info['is_public'], instance.__pub_info['is_removed'])
+    listed = is_listed(instance.is_public, instance.is_removed)
+    if was_listed == listed:
+        return
+
+    pipe = client.pipeline()
+    if listed:
+        index_add(instance, pipe)
+    else:
+        index_remove(instance, pipe)
+    pipe.execute()
+
+def index_comment_post_delete(instance, **kwargs):
+    if not comment_index_enabled() or deleted_in_bulk(instance):
+        return
+    pipe = client.pipeline()
+    index_remove(instance, pipe)
+    pipe.execute()
+
+def deleted_in_bulk(comment):
+    """
+    Was ``comment`` deleted by ``moderation.delete_comments``? Its post_delete
+    handlers are then skipped, the deletion is handled for all the comments
+    at once.
+    """
+    return getattr(comment, '_deleted_in_bulk', False)
+
+def is_pending(is_public, is_removed):
+    " Is a comment with these flags waiting for moderation? "
+    return not is_public and not is_removed
+
+def _pending_keys(comment, obj=None):
+    keys = [PENDING_SITE_KEY % comment.site_id]
+    if obj is None:
+        obj = comment.content_object
+    if isinstance(obj, Publishable):
+        keys.append(PENDING_CATEGORY_KEY % obj.category_id)
+    return keys
+
+def pending_add(comment, pipe, obj=None):
+    for k in _pending_keys(comment, obj):
+        pipe.zadd(k, comment.pk, repr(to_timestamp(comment.submit_date)))
+    pipe.incr(PENDING_COUNT_KEY % (comment.content_type_id, comment.object_pk))
+
+def pending_remove(comment, pipe, obj=None):
+    for k in _pending_keys(comment, obj):
+        pipe.zrem(k, comment.pk)
+    pipe.decr(PENDING_COUNT_KEY % (comment.content_type_id, comment.object_pk))
+
+def get_pending_range(key, start, stop):
+    " Return ids and total size of the pending queue in ``key``, oldest first. "
+    pipe = client.pipeline()
+    pipe.zrange(key, start, stop - 1)
+    pipe.zcard(key)
+    ids, total = pipe.execute()
+    return [int(i) for i in ids], total
+
+def get_pending_counts(keys):
+    " Return numbers of pending comments for (ct_id, object_pk) ``keys``. "
+    if not keys:
+        return []
+    return [max(int(c or 0), 0) for c in client.mget([PENDING_COUNT_KEY % k for k in keys])]
+
+def pending_comment_posted(comment, **kwargs):
+    if not is_pending(comment.is_public, comment.is_removed):
+        return
+    pipe = client.pipeline()
+    pending_add(comment, pipe)
+    pipe.execute()
+
+def pending_comment_post_save(instance, **kwargs):
+    if not hasattr(instance, '__pub_info'):
+        return
+    was_pending = is_pending(instance.__pub_info['is_public'], instance.__pub_info['is_removed'])
+    pending = is_pending(instance.is_public, instance.is_removed)
+    if was_pending == pending:
+        return
+
+    pipe = client.pipeline()
+    if pending:
+        pending_add(instance, pipe)
+    else:
+        pending_remove(instance, pipe)
+    pipe.execute()
+
+def pending_comment_post_delete(instance, **kwargs):
+    if deleted_in_bulk(instance) or not is_pending(instance.is_public, instance.is_removed):
+        return
+    pipe = client.pipeline()
+    pending_remove(instance, pipe)
+    pipe.execute()
+
+def _reply_root(comment):
+    " Field of the thread ``comment`` belongs to, None for root comments. "
+    if PATH_SEPARATOR not in comment.tree_path:
+        return None
+    return comment.tree_path[:PATH_DIGITS]
+
+def replies_incr(comment, incr_by, pipe):
+    root = _reply_root(comment)
+    if root is not None:
+        pipe.hincrby(COMREPLIES_KEY % (comment.content_type_id, comment.object_pk), root, incr_by)
+
+def get_reply_counts(ct_id, object_pk, root_ids):
+    " Return a dict mapping ``root_ids`` to numbers of replies in their threads. "
+    if not root_ids:
+        return {}
+    counts = client.hmget(COMREPLIES_KEY % (ct_id, object_pk), [str(i).zfill(PATH_DIGITS) for i in root_ids])
+    return dict((i, max(int(c or 0), 0)) for i, c in zip(root_ids, counts))
+
+def replies_comment_posted(comment, **kwargs):
+    if not is_listed(comment.is_public, comment.is_removed):
+        return
+    pipe = client.pipeline()
+    replies_incr(comment, 1, pipe)
+    pipe.execute()
+
+def replies_comment_post_save(instance, **kwargs):
+    if not hasattr(instance, '__pub_info'):
+        return
+    was_listed = is_listed(instance.__pub_info['is_public'], instance.__pub_info['is_removed'])
+    listed = is_listed(instance.is_public, instance.is_removed)
+    if was_listed == listed:
+        return
+
+    pipe = client.pipeline()
+    replies_incr(instance, listed and 1 or -1, pipe)
+    pipe.execute()
+
+def replies_comment_post_delete(instance, **kwargs):
+    if deleted_in_bulk(instance):
+        return
+    pipe = client.pipeline()
+    if _reply_root(instance) is None:
+        # the whole thread is gone
+        pipe.hdel(COMREPLIES_KEY % (instance.content_type_id, instance.object_pk), instance.tree_path)
+    elif is_listed(instance.is_public, instance.is_removed):
+        replies_incr(instance, -1, pipe)
+    pipe.execute()
+
+def deferred_comment_posted(comment, **kwargs):
+    # comments that aren't public are counted by comment_post_save once approved
+    if comment.is_public and not comment.is_removed:
+        deferred.defer('comment_posted', comment)
+
+def deferred_comment_post_save(instance, **kwargs):
+    if hasattr(instance, '__pub_info'):
+        deferred.defer('comment_post_save', instance, instance.__pub_info)
+
+deferred.register('comment_posted', comment_posted)
+deferred.register('comment_post_save', comment_post_save)
 
 def connect_signals():
     from django.contrib.comments.signals import comment_was_posted
     from ella.core.signals import content_published, content_unpublished
-    from django.db.models.signals import post_save
+    from django.db.models.signals import post_save, post_delete
     content_published.connect(publishable_published)
     content_unpublished.connect(publishable_unpublished)
 
-    comment_was_posted.connect(comment_posted, sender=comments.get_model())
+    if deferred.MODE:
+        comment_was_posted.connect(deferred_comment_posted, sender=comments.get_model())
+        post_save.connect(deferred_comment_post_save, sender=comments.get_model())
+    else:
+        comment_was_posted.connect(comment_posted, sender=comments.get_model())
+        post_save.connect(comment_post_save, sender=comments.get_model())
+
+    comment_was_posted.connect(pending_comment_posted, sender=comments.get_model())
+    post_save.connect(pending_comment_post_save, sender=comments.get_model())
+    post_delete.connect(pending_comment_post_delete, sender=comments.get_model())
+
+    comment_was_posted.connect(replies_comment_posted, sender=comments.get_model())
+    post_save.connect(replies_comment_post_save, sender=comments.get_model())
+    post_delete.connect(replies_comment_post_delete, sender=comments.get_model())
 
-    post_save.connect(comment_post_save, sender=comments.get_model())
+    comment_was_posted.connect(index_comment_posted, sender=comments.get_model())
+    post_save.connect(index_comment_post_save, sender=comments.get_model())
+    post_delete.connect(index_comment_post_delete, sender=comments.get_model())
 
 if client:
     connect_signals()
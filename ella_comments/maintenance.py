@@ -0,0 +1,333 @@
+"""
+Maintenance of the comment counters and listings kept in redis by
+``ella_comments.listing_handlers``.
+"""
+import time
+import random
+import operator
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib import comments
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Max, Min, Q
+
+from ella.core.cache import get_cached_objects, SKIP
+from ella.core.cache.redis import client, SlidingListingHandler
+from ella.core.models import Publishable
+from ella.utils.timezone import now, localize, to_timestamp
+
+from threadedcomments.models import PATH_DIGITS, PATH_SEPARATOR
+
+from ella_comments.listing_handlers import COMCOUNT_KEY, LASTCOM_KEY, COMREPLIES_KEY, \
+    MOST_COMMENTED_LH, LAST_COMMENTED_LH, RECENTLY_COMMENTED_LH, \
+    get_listing_handler, _lastcom_data
+
+# objects per query when working with a list of objects
+CHUNK_SIZE = 200
+
+def counted_comments():
+    " Comments included in the redis counters. "
+    return comments.get_model()._default_manager.filter(is_public=True, is_removed=False)
+
+def listed_replies():
+    " Replies included in the reply counters, see ``listing_handlers.is_listed``. "
+    qs = comments.get_model()._default_manager.filter(is_public=True, tree_path__contains=PATH_SEPARATOR)
+    if getattr(settings, 'COMMENTS_HIDE_REMOVED', False):
+        qs = qs.filter(is_removed=False)
+    return qs
+
+def iter_comment_stats(chunk_size=1000, start=None):
+    """
+    Yield tuples (last pk, rows) for ranges of ``chunk_size`` comments by
+    primary key, starting after comment ``start``. Rows are dicts with
+    ``content_type``, ``object_pk``, ``cnt``, ``last`` (submit_date of the
+    latest comment) and ``first`` (pk of the first comment) of the objects
+    whose first comment is within the range, so that every commented object
+    is yielded exactly once. Each range costs a primary key range scan, a
+    query for objects commented before it and one aggregate query limited to
+    the objects first commented within it - every object is aggregated once.
+    """
+    last = start or 0
+    while True:
+        comments_range = list(
+            counted_comments().filter(pk__gt=last).order_by('pk')\
+                .values_list('pk', 'content_type', 'object_pk')[:chunk_size]
+        )
+        if not comments_range:
+            return
+        first_pk, last = comments_range[0][0], comments_range[-1][0]
+        keys = set((ct_id, object_pk) for pk, ct_id, object_pk in comments_range)
+        # objects commented before the range were yielded already
+        keys -= set(counted_comments().filter(
+            pk__lt=first_pk,
+            content_type__in=set(ct_id for ct_id, object_pk in keys),
+            object_pk__in=set(object_pk for ct_id, object_pk in keys),
+        ).order_by().values_list('content_type', 'object_pk').distinct())
+        rows = sorted(_object_stats(keys).values(), key=lambda r: r['first'])
+        if rows:
+            yield last, rows
+
+def _latest_comments(rows):
+    " Return the latest comment of each object in ``rows`` keyed by (ct_id, object_pk). "
+    rows = [r for r in rows if r['last'] is not None]
+    if not rows:
+        return {}
+    wanted = dict(((r['content_type'], r['object_pk']), r['last']) for r in rows)
+    qs = counted_comments().filter(
+        content_type__in=set(r['content_type'] for r in rows),
+        object_pk__in=set(r['object_pk'] for r in rows),
+        submit_date__in=set(wanted.values()),
+    )
+    latest = {}
+    for c in qs:
+        key = (c.content_type_id, c.object_pk)
+        if wanted.get(key) == c.submit_date and (key not in latest or latest[key].pk < c.pk):
+            latest[key] = c
+    return latest
+
+def _published(keys):
+    " Return published publishables from (ct_id, object_pk) ``keys``. "
+    ids = []
+    for ct_id, object_pk in keys:
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        if model is not None and issubclass(model, Publishable):
+            ids.append((ct_id, int(object_pk)))
+    if not ids:
+        return []
+    return [p for p in get_cached_objects(ids, missing=SKIP) if p.is_published()]
+
+def rebuild_chunk(rows, listings=True):
+    """
+    Store counters and last comments for objects in ``rows`` (as yielded by
+    ``iter_comment_stats``) and put published objects to the most and last
+    commented listings. Everything is sent in one pipeline.
+    """
+    latest = _latest_comments(rows)
+    replies = _reply_counts((r['content_type'], r['object_pk']) for r in rows)
+    pipe = client.pipeline(transaction=False)
+    for r in rows:
+        key = (r['content_type'], r['object_pk'])
+        pipe.set(COMCOUNT_KEY % key, r['cnt'])
+        pipe.delete(LASTCOM_KEY % key, COMREPLIES_KEY % key)
+        if key in latest:
+            pipe.hmset(LASTCOM_KEY % key, _lastcom_data(latest[key]))
+        if key in replies:
+            pipe.hmset(COMREPLIES_KEY % key, replies[key])
+
+    most_commented = get_listing_handler(MOST_COMMENTED_LH)
+    last_commented = get_listing_handler(LAST_COMMENTED_LH)
+    if listings and (most_commented or last_commented):
+        stats = dict(((r['content_type'], r['object_pk']), r) for r in rows)
+        for obj in _published(stats.keys()):
+            r = stats[(obj.content_type_id, str(obj.pk))]
+            if most_commented:
+                most_commented.add_publishable(obj.category, obj, r['cnt'], pipe=pipe, commit=False)
+            if not last_commented:
+                continue
+            if r['last'] is None:
+                last_commented.remove_publishable(obj.category, obj, pipe=pipe, commit=False)
+            else:
+                last_commented.add_publishable(obj.category, obj, repr(to_timestamp(r['last'])), pipe=pipe, commit=False)
+    pipe.execute()
+
+def _reply_counts(keys):
+    " Return dicts of reply counts per thread for (ct_id, object_pk) ``keys``. "
+    keys = list(keys)
+    replies = {}
+    for i in xrange(0, len(keys), CHUNK_SIZE):
+        q = reduce(operator.or_, [Q(content_type=ct_id, object_pk=object_pk) for ct_id, object_pk in keys[i:i + CHUNK_SIZE]])
+        for ct_id, object_pk, tree_path in listed_replies().filter(q).order_by()\
+                .values_list('content_type', 'object_pk', 'tree_path').iterator():
+            threads = replies.setdefault((ct_id, object_pk), {})
+            root = tree_path[:PATH_DIGITS]
+            threads[root] = threads.get(root, 0) + 1
+    return replies
+
+def rebuild_objects(keys, listings=True):
+    """
+    Rebuild counters, last comments and listings of objects given by
+    (ct_id, object_pk) ``keys``, including those left without any comments.
+    """
+    keys = list(keys)
+    stats = _object_stats(keys)
+    rows = [stats.get(key, {'content_type': key[0], 'object_pk': key[1], 'cnt': 0, 'last': None}) for key in keys]
+    for i in xrange(0, len(rows), CHUNK_SIZE):
+        rebuild_chunk(rows[i:i + CHUNK_SIZE], listings)
+
+def _object_stats(keys):
+    " Return ``iter_comment_stats`` rows for ``keys`` keyed by (ct_id, object_pk). "
+    keys = list(keys)
+    stats = {}
+    for i in xrange(0, len(keys), CHUNK_SIZE):
+        q = reduce(operator.or_, [Q(content_type=ct_id, object_pk=object_pk) for ct_id, object_pk in keys[i:i + CHUNK_SIZE]])
+        for r in counted_comments().filter(q).values('content_type', 'object_pk')\
+                .annotate(cnt=Count('pk'), last=Max('submit_date'), first=Min('pk')).order_by():
+            stats[(r['content_type'], unicode(r['object_pk']))] = r
+    return stats
+
+def rebuild_recently_commented():
+    """
+    Rebuild the daily slots of the recently commented listing from comments
+    within its window and regenerate the aggregates. Unlike live updates
+    which use the time of posting, comments are put to slots by their
+    ``submit_date``. Scores are merged into the slots (the higher one wins)
+    so that comments posted during the rebuild aren't lost.
+    """
+    ListingHandler = get_listing_handler(RECENTLY_COMMENTED_LH)
+    if ListingHandler is None or not issubclass(ListingHandler, SlidingListingHandler):
+        return
+
+    today = localize(now()).date()
+    since = today - timedelta(days=ListingHandler.WINDOW_SIZE - 1)
+    scores = {}
+    qs = counted_comments().filter(submit_date__gte=localize(now()) - timedelta(days=ListingHandler.WINDOW_SIZE))
+    for ct_id, object_pk, submit_date in qs.values_list('content_type', 'object_pk', 'submit_date').iterator():
+        day = localize(submit_date).date()
+        if day < since:
+            continue
+        days = scores.setdefault((ct_id, object_pk), {})
+        day = day.strftime('%Y%m%d')
+        days[day] = days.get(day, 0) + 1
+
+    slots = {}
+    pipe = client.pipeline()
+    for obj in _published(scores.keys()):
+        base_keys = super(SlidingListingHandler, ListingHandler).get_keys(obj.category, obj)
+        value = ListingHandler.get_value(obj)
+        pipe.sadd(ListingHandler.base_key_set(), *base_keys)
+        for day, cnt in scores[(obj.content_type_id, str(obj.pk))].items():
+            day_keys = ['%s:%s' % (k, day) for k in base_keys]
+            pipe.zadd(ListingHandler.window_key_zset(), **dict((k, day) for k in day_keys))
+            for k in day_keys:
+                slots.setdefault(k, {})[value] = cnt
+
+    # live updates may have incremented the slots since the query, merge
+    for k, values in slots.items():
+        tmp_key = k + ':rebuild'
+        pipe.delete(tmp_key)
+        pipe.zadd(tmp_key, **values)
+        pipe.zunionstore(k, [k, tmp_key], aggregate='MAX')
+        pipe.delete(tmp_key)
+    pipe.execute()
+
+    ListingHandler.regenerate()
+
+def rebuild_counters(chunk_size=1000, rate=0, listings=True, start=None, progress=None):
+    """
+    Rebuild all the redis counters, last comments and (with ``listings``) the
+    commented listings from the database, continuing after comment ``start``
+    if given. At most ``rate`` objects per second are processed if given,
+    ``progress(done, last_pk)`` is called after every chunk. Return the
+    number of objects processed.
+    """
+    done = 0
+    started = time.time()
+    for last_pk, rows in iter_comment_stats(chunk_size, start):
+        rebuild_chunk(rows, listings)
+        done += len(rows)
+        if progress:
+            progress(done, last_pk)
+        if rate:
+            delay = started + float(done) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    if listings:
+        rebuild_recently_commented()
+    return done
+
+
+DRIFT_STATS_KEY = 'comments:drift'
+# seconds to wait before checking mismatched counters again
+RECHECK_DELAY = getattr(settings, 'COMMENTS_DRIFT_RECHECK_DELAY', 1)
+
+def sample_objects(size=100, recent=timedelta(hours=1)):
+    """
+    Return a set of (ct_id, object_pk) of objects with comments - up to
+    ``size`` objects commented within ``recent`` and objects of ``size``
+    randomly picked comments.
+    """
+    model = comments.get_model()
+    objects = set(
+        (ct_id, unicode(object_pk)) for ct_id, object_pk in model._default_manager\
+            .filter(submit_date__gte=now() - recent).order_by()\
+            .values_list('content_type', 'object_pk').distinct()[:size]
+    )
+
+    max_pk = model._default_manager.aggregate(max_pk=Max('pk'))['max_pk']
+    if max_pk:
+        ids = [random.randint(1, max_pk) for i in xrange(size)]
+        objects.update(
+            (ct_id, unicode(object_pk)) for ct_id, object_pk in model._default_manager\
+                .filter(pk__in=ids).order_by().values_list('content_type', 'object_pk')
+        )
+    return objects
+
+def _find_mismatches(objects):
+    stats = _object_stats(objects)
+    counts = client.mget([COMCOUNT_KEY % key for key in objects])
+
+    mismatches = []
+    for key, cnt in zip(objects, counts):
+        db_cnt = key in stats and stats[key]['cnt'] or 0
+        if int(cnt or 0) != db_cnt:
+            mismatches.append(key + (cnt and int(cnt), db_cnt))
+    return mismatches
+
+def check_counts(objects, fix=False):
+    """
+    Compare redis counters of ``objects`` ((ct_id, object_pk) tuples) with
+    the database and rebuild the mismatching ones if ``fix`` is set. Return
+    a list of (ct_id, object_pk, redis count, db count) of the mismatches.
+
+    Objects commented while they are checked look drifted until the handlers
+    update their counters, with ``fix`` the mismatches are checked again
+    after RECHECK_DELAY and only those still differing are rebuilt (and
+    returned).
+    """
+    objects = list(objects)
+    if not objects:
+        return []
+
+    mismatches = _find_mismatches(objects)
+    if fix and mismatches:
+        time.sleep(RECHECK_DELAY)
+        mismatches = _find_mismatches([m[:2] for m in mismatches])
+        if mismatches:
+            rebuild_objects([m[:2] for m in mismatches])
+    return mismatches
+
+def check_drift(size=100, recent=timedelta(hours=1), fix=False):
+    """
+    Check a sample of objects (see ``sample_objects``) and record the
+    results in redis hash DRIFT_STATS_KEY for monitoring. Return a tuple
+    (number of objects checked, list of mismatches).
+    """
+    objects = sample_objects(size, recent)
+    mismatches = check_counts(objects, fix)
+
+    pipe = client.pipeline()
+    pipe.hmset(DRIFT_STATS_KEY, {
+        'last_run': repr(time.time()),
+        'last_checked': len(objects),
+        'last_mismatched': len(mismatches),
+    })
+    pipe.hincrby(DRIFT_STATS_KEY, 'checked', len(objects))
+    pipe.hincrby(DRIFT_STATS_KEY, 'mismatched', len(mismatches))
+    if fix:
+        pipe.hincrby(DRIFT_STATS_KEY, 'fixed', len(mismatches))
+    pipe.execute()
+    return len(objects), mismatches
+
+def get_drift_stats():
+    " Return the totals recorded by ``check_drift``. "
+    data = client.hgetall(DRIFT_STATS_KEY)
+    return {
+        'last_run': float(data.get('last_run', 0)),
+        'checked': int(data.get('checked', 0)),
+        'mismatched': int(data.get('mismatched', 0)),
+        'fixed': int(data.get('fixed', 0)),
+        'last_checked': int(data.get('last_checked', 0)),
+        'last_mismatched': int(data.get('last_mismatched', 0)),
+    }
@@ -0,0 +1,36 @@
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ella.core.cache.redis import client
+
+from ella_comments.maintenance import check_drift
+
+
+class Command(NoArgsCommand):
+    help = 'Compare comment counts in redis with the database for a sample of objects.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sample', type='int', dest='sample', default=100,
+            help='Number of random comments whose objects are checked.'),
+        make_option('--recent', type='int', dest='recent', default=60,
+            help='Also check objects commented within this many minutes.'),
+        make_option('--fix', action='store_true', dest='fix', default=False,
+            help='Rebuild the counters that differ.'),
+    )
+
+    def handle_noargs(self, **options):
+        if not client:
+            raise CommandError('Redis is not configured.')
+
+        checked, mismatches = check_drift(options['sample'], timedelta(minutes=options['recent']), options['fix'])
+
+        verbosity = int(options.get('verbosity', 1))
+        if verbosity > 1:
+            for ct_id, object_pk, redis_cnt, db_cnt in mismatches:
+                self.stdout.write('%s:%s redis %s, db %s\n' % (ct_id, object_pk, redis_cnt, db_cnt))
+        if verbosity > 0:
+            rate = checked and 100.0 * len(mismatches) / checked or 0
+            self.stdout.write('Checked %d objects, %d (%.1f%%) differ%s.\n' % (
+                checked, len(mismatches), rate, options['fix'] and ' and were fixed' or ''))
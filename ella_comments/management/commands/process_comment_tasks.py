@@ -0,0 +1,33 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import close_connection
+
+from ella_comments import deferred
+
+
+class Command(NoArgsCommand):
+    help = 'Execute deferred comment handlers queued in redis (COMMENTS_DEFERRED_HANDLERS = "redis").'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Exit when the queue is empty instead of waiting for more tasks.'),
+        make_option('--timeout', type='int', dest='timeout', default=5,
+            help='How long to wait for a task before checking for retries, in seconds.'),
+    )
+
+    def handle_noargs(self, **options):
+        if deferred.MODE != 'redis':
+            raise CommandError('COMMENTS_DEFERRED_HANDLERS is not set to "redis".')
+
+        processed = 0
+        while True:
+            if deferred.process_queue(options['timeout']):
+                processed += 1
+                # don't keep a transaction open between tasks
+                close_connection()
+            elif options['once']:
+                break
+
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('Processed %d tasks.\n' % processed)
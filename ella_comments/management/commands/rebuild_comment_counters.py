@@ -0,0 +1,42 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from ella.core.cache.redis import client
+
+from ella_comments.maintenance import rebuild_counters
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuild comment counts, last comments and commented listings in redis from the database.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+            help='Number of comments scanned in one chunk, their objects are processed in one redis pipeline.'),
+        make_option('--rate', type='int', dest='rate', default=0,
+            help='Maximum number of objects processed per second, 0 for no limit.'),
+        make_option('--skip-listings', action='store_false', dest='listings', default=True,
+            help='Only rebuild the counters and last comments.'),
+        make_option('--start', dest='start', default=None,
+            help='Continue after comment with given id (as reported in the progress).'),
+    )
+
+    def handle_noargs(self, **options):
+        if not client:
+            raise CommandError('Redis is not configured.')
+
+        start = None
+        if options['start']:
+            try:
+                start = int(options['start'])
+            except ValueError:
+                raise CommandError('Invalid --start value, use a comment id.')
+
+        verbosity = int(options.get('verbosity', 1))
+        def progress(done, last):
+            if verbosity > 1:
+                self.stdout.write('%d objects done, last comment %d\n' % (done, last))
+
+        done = rebuild_counters(options['chunk_size'], options['rate'], options['listings'], start, progress)
+        if verbosity > 0:
+            self.stdout.write('Rebuilt counters of %d objects.\n' % done)
@@ -0,0 +1,48 @@
+# encoding: utf-8
+from south.db import db
+from south.v2 import SchemaMigration
+
+# one index serving the lookups of comments of an object - the counts, the
+# lists ordered by submit_date with or without removed comments and the
+# duplicate check of new comments
+INDEX_NAME = 'django_comments_object_listing'
+INDEX_COLUMNS = ('content_type_id', 'object_pk', 'site_id', 'is_public', 'submit_date', 'is_removed')
+# object_pk is a TEXT column, MySQL can only index its prefix
+MYSQL_PREFIX_LENGTH = 40
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        columns = [db.quote_name(c) for c in INDEX_COLUMNS]
+        if db.backend_name == 'mysql':
+            columns[1] += '(%d)' % MYSQL_PREFIX_LENGTH
+        db.execute('CREATE INDEX %s ON %s (%s)' % (db.quote_name(INDEX_NAME), db.quote_name('django_comments'), ', '.join(columns)))
+
+
+    def backwards(self, orm):
+        if db.backend_name == 'mysql':
+            db.execute('DROP INDEX %s ON %s' % (db.quote_name(INDEX_NAME), db.quote_name('django_comments')))
+        else:
+            db.execute('DROP INDEX %s' % db.quote_name(INDEX_NAME))
+
+
+    models = {
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'ella_comments.commentoptionsobject': {
+            'Meta': {'unique_together': "(('target_ct', 'target_id'),)", 'object_name': 'CommentOptionsObject'},
+            'blocked': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'check_profanities': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'premoderated': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'target_ct': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'target_id': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['ella_comments']
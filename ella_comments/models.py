@@ -1,20 +1,33 @@
 import operator
+import time
+import zlib
+import cPickle as pickle
+from hashlib import md5
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
 
-from django.db import models
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db import models, router, connections
+from django.db.models import Count
+from django.db.models.signals import post_init, pre_save, post_save, post_delete
 from django.contrib import comments
+from django.contrib.comments.signals import comment_was_posted
 from django.contrib.contenttypes.models import ContentType
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 from django.core.cache import cache
+from django.template import Context
 
-from ella.core.cache import CachedGenericForeignKey, get_cached_object, ContentTypeForeignKey
+from ella.core.cache import CachedGenericForeignKey, ContentTypeForeignKey
 from ella.core.cache.redis import client
+from ella.core.models import Publishable
+from ella.utils.timezone import utc_localize
 
-from threadedcomments.models import PATH_DIGITS
+from threadedcomments.models import PATH_DIGITS, PATH_SEPARATOR
 
-from ella_comments.listing_handlers import COMCOUNT_KEY
-from ella_comments.signals import comment_removed
+from ella_comments.listing_handlers import COMCOUNT_KEY, comment_index_enabled, \
+    get_index_range, get_index_rank, build_comment_index, is_listed, get_reply_counts, deleted_in_bulk
+from ella_comments.signals import comment_removed, comment_updated
+from ella_comments.caching import get_cached, get_many_cached, set_many_cached
 
 DEFAULT_COMMENT_OPTIONS = {
     'blocked': False,
@@ -22,71 +35,867 @@ DEFAULT_COMMENT_OPTIONS = {
     'check_profanities': True
 }
 
+GENERATION_KEY = 'comments:gen:%s:%s'
+GENERATION_TIMEOUT = getattr(settings, 'COMMENTS_GENERATION_TIMEOUT', 7 * 24 * 60 * 60)
+
+def get_generation(ctype_id, object_pk):
+    """
+    Return the current generation of comments for given object. The generation
+    is part of all cache keys of ``CachedCommentList`` so that bumping it makes
+    all the cached lists and counts for the object obsolete at once.
+    """
+    key = GENERATION_KEY % (ctype_id, object_pk)
+    gen = cache.get(key)
+    if gen is None:
+        # start from current time so that a generation lost from cache never
+        # points back to any previously used keys
+        gen = int(time.time() * 1000)
+        cache.add(key, gen, GENERATION_TIMEOUT)
+    return gen
+
+def get_generations(keys):
+    """
+    Bulk version of ``get_generation``, ``keys`` is a list of (ctype_id,
+    object_pk) tuples, returns a dict mapping them to their generations.
+    """
+    cache_keys = dict((GENERATION_KEY % k, k) for k in keys)
+    gens = dict((cache_keys[ck], gen) for ck, gen in cache.get_many(cache_keys.keys()).items())
+
+    missing = [ck for ck, k in cache_keys.items() if k not in gens]
+    if missing:
+        gen = int(time.time() * 1000)
+        cache.set_many(dict((ck, gen) for ck in missing), GENERATION_TIMEOUT)
+        for ck in missing:
+            gens[cache_keys[ck]] = gen
+    return gens
+
+def bump_generation(ctype_id, object_pk):
+    key = GENERATION_KEY % (ctype_id, object_pk)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), GENERATION_TIMEOUT)
+
+
+# version of every comment, part of its rendered fragments in cache
+VERSION_KEY = 'comments:version:%s'
+FRAGMENT_KEY = 'comments:fragment:%s:%s'
+FRAGMENT_TIMEOUT = getattr(settings, 'COMMENTS_FRAGMENT_CACHE_TIMEOUT', 24 * 60 * 60)
+
+def bump_versions(comment_ids):
+    " Make rendered fragments of comments with ``comment_ids`` obsolete. "
+    keys = [VERSION_KEY % pk for pk in comment_ids]
+    # timestamps, same as generations, always past the current version
+    now = int(time.time() * 1000)
+    versions = cache.get_many(keys)
+    cache.set_many(dict((k, max(now, versions.get(k, 0) + 1)) for k in keys), GENERATION_TIMEOUT)
+
+def render_fragments(comment_list, template):
+    """
+    Return a list of HTML fragments of comments in ``comment_list`` rendered
+    by ``template`` in a context holding just the comment as ``comment``.
+    Fragments are cached by comment, template and the comment's version (and
+    tree annotations, which differ between pages) - all of them are fetched
+    by one get_many and only the misses are rendered.
+    """
+    comment_list = list(comment_list)
+    name = md5(template.name or '').hexdigest()
+    keys = [(VERSION_KEY % c.pk, FRAGMENT_KEY % (name, c.pk)) for c in comment_list]
+    cached = cache.get_many([k for pair in keys for k in pair])
+
+    to_cache, fragments = {}, []
+    now = int(time.time() * 1000)
+    for c, (version_key, fragment_key) in zip(comment_list, keys):
+        version = cached.get(version_key)
+        if version is None:
+            # a lost version never matches an older fragment, add doesn't
+            # overwrite a version bumped meanwhile
+            cache.add(version_key, now, GENERATION_TIMEOUT)
+            version = now
+        annotations = tuple(getattr(c, a, None) for a in ANNOTATIONS)
+        fragment = cached.get(fragment_key)
+        if fragment is not None and fragment[:2] == (version, annotations):
+            fragments.append(fragment[2])
+            continue
+
+        html = template.render(Context({'comment': c}))
+        to_cache[fragment_key] = (version_key, (version, annotations, html))
+        fragments.append(html)
+
+    if to_cache:
+        # the comment may have changed while rendering, don't store fragments
+        # of versions that are already gone
+        versions = cache.get_many([k for k, f in to_cache.values()])
+        cache.set_many(dict(
+            (fragment_key, f) for fragment_key, (version_key, f) in to_cache.items()
+            if versions.get(version_key) == f[0]
+        ), FRAGMENT_TIMEOUT)
+    return fragments
+
+
+# fields stored in cache for every comment, enough to render comment lists
+CACHED_FIELDS = getattr(settings, 'COMMENTS_CACHED_FIELDS', (
+    'id', 'content_type_id', 'object_pk', 'site_id',
+    'user_id', 'user_name', 'user_email', 'user_url',
+    'title', 'comment', 'submit_date', 'is_public', 'is_removed',
+    'parent_id', 'last_child_id', 'tree_path',
+))
+# cached lists bigger than this (in bytes) are compressed
+COMPRESS_THRESHOLD = getattr(settings, 'COMMENTS_CACHE_COMPRESS_THRESHOLD', 16 * 1024)
+# attributes set by annotate_tree (and new_thread marking the first comment
+# of every thread), optionally stored with cached lists
+ANNOTATIONS = ('open', 'close', 'last', 'new_thread')
+
+def pack_comments(items, annotations=False):
+    """
+    Serialize comments into a compact form suitable for cache - tuples of
+    CACHED_FIELDS instead of pickled model instances, zlib compressed when
+    bigger than COMPRESS_THRESHOLD. ANNOTATIONS are stored too if
+    ``annotations`` is set.
+    """
+    model = comments.get_model()
+    fields = [f.attname for f in model._meta.fields if f.attname in CACHED_FIELDS or f.primary_key]
+    items = list(items)
+    records = [tuple(getattr(c, f) for f in fields) for c in items]
+    extra = None
+    if annotations:
+        extra = [tuple(getattr(c, a, None) for a in ANNOTATIONS) for c in items]
+
+    data = pickle.dumps((fields, records, extra), pickle.HIGHEST_PROTOCOL)
+    if COMPRESS_THRESHOLD and len(data) > COMPRESS_THRESHOLD:
+        return ('z', zlib.compress(data))
+    return ('p', data)
+
+def unpack_comments(packed):
+    """
+    Rebuild comment instances from the output of ``pack_comments``.
+    """
+    format, data = packed
+    if format == 'z':
+        data = zlib.decompress(data)
+    data = pickle.loads(data)
+    fields, records = data[:2]
+    # lists cached before annotations were stored have no extra item
+    extra = len(data) > 2 and data[2] or None
+
+    model = comments.get_model()
+    db = router.db_for_read(model)
+    items = []
+    for r in records:
+        c = model(**dict(zip(fields, r)))
+        c._state.adding = False
+        c._state.db = db
+        items.append(c)
+
+    if extra:
+        for c, values in zip(items, extra):
+            for a, v in zip(ANNOTATIONS, values):
+                if v is not None:
+                    setattr(c, a, v)
+    return items
+
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+def listed_comments():
+    " Comments that are displayed in comment lists. "
+    qs = comments.get_model().objects.filter(site__pk=settings.SITE_ID, is_public=True)
+    if getattr(settings, 'COMMENTS_HIDE_REMOVED', False):
+        qs = qs.filter(is_removed=False)
+    return qs
+
+def get_target_ctype(obj):
+    """
+    Content type comments for ``obj`` are stored under, publishables always use
+    their specific content type.
+    """
+    if isinstance(obj, Publishable):
+        return obj.content_type
+    return ContentType.objects.get_for_model(obj)
+
+def count_key(obj):
+    """
+    Key of ``obj`` in dicts returned by ``CachedCommentList.get_counts``.
+    Instances can't be used, a Publishable equals its Article.
+    """
+    return (get_target_ctype(obj).pk, obj.pk)
+
 class CachedCommentList(object):
-    CACHE_TIMEOUT = 30
-    def __init__(self, ctype, object_pk, reverse=None, group_threads=None, flat=None, ids=()):
+    # keys are invalidated by bumping the generation, timeout can be long
+    CACHE_TIMEOUT = getattr(settings, 'COMMENTS_CACHE_TIMEOUT', 6 * 60 * 60)
+    # threads up to this size are cached as one list and sliced in memory
+    FULL_THREAD_SIZE = getattr(settings, 'COMMENTS_FULL_THREAD_CACHE_SIZE', 500)
+
+    def __init__(self, ctype, object_pk, reverse=None, group_threads=None, flat=None, ids=(), max_depth=None, annotate=None):
         self.ctype = ctype
         self.object_pk = object_pk
         self.reverse = reverse if reverse is not None else getattr(settings, 'COMMENTS_REVERSED', False)
         self.group_threads = group_threads if group_threads is not None else getattr(settings, 'COMMENTS_GROUP_THREADS', False)
         self.flat = flat if flat is not None else getattr(settings, 'COMMENTS_FLAT', False)
         self.ids = ids
+        # only comments up to this level (roots are 1) are listed
+        self.max_depth = max_depth
+        # cache lists of a tree with ANNOTATIONS so that templates needn't
+        # run annotate_tree and group_threads on every render
+        self.annotate = annotate if annotate is not None else getattr(settings, 'COMMENTS_CACHE_ANNOTATIONS', False)
+
+    def _generation(self):
+        if not hasattr(self, '_gen'):
+            self._gen = get_generation(self.ctype.pk, self.object_pk)
+        return self._gen
+
+    # lists of branches (``ids``) are cached per branch, not per combination
+    # of branches, the keys below are only used for whole lists - except for
+    # annotated pages which include the branches in the key
 
     def _count_cache_key(self):
-        return 'comments:count:%s:%s:%s' % (self.ctype.pk, self.object_pk, ','.join(map(str, sorted(self.ids))))
+        return 'comments:count:%s:%s:%s:%s' % (self.ctype.pk, self.object_pk, self._generation(), self.max_depth or '')
 
     def _cache_key(self, start=None, stop=None):
-        return 'comments:list:%s:%s:%d:%d:%d:%s:%s:%s' % (
-            self.ctype.pk, self.object_pk,
+        return 'comments:list:%s:%s:%s:%d:%d:%d:%d:%s:%s:%s:%s' % (
+            self.ctype.pk, self.object_pk, self._generation(),
             1 if self.reverse else 0,
             1 if self.group_threads else 0,
             1 if self.flat else 0,
-            ','.join(map(str, sorted(self.ids))),
+            1 if self._annotated() else 0,
+            self.max_depth or '',
+            md5(','.join(map(str, self._branches()))).hexdigest() if self.ids else '',
             start or '', stop or ''
         )
 
+    def _position_cache_key(self, comment):
+        return 'comments:position:%s:%s:%s:%d:%d:%s:%s' % (
+            self.ctype.pk, self.object_pk, self._generation(),
+            1 if self.reverse else 0,
+            1 if self.flat else 0,
+            self.max_depth or '',
+            comment.pk
+        )
+
+    def _truncated_cache_key(self, leaves):
+        return 'comments:truncated:%s:%s:%s:%s:%s' % (
+            self.ctype.pk, self.object_pk, self._generation(),
+            self.max_depth,
+            md5(','.join(sorted(c.tree_path for c in leaves))).hexdigest()
+        )
+
+    def _branch_cache_key(self, kind, root_id):
+        return 'comments:branch:%s:%s:%s:%s:%s' % (kind, self.ctype.pk, self.object_pk, self._generation(), root_id)
+
+    def _roots_cache_key(self, start, stop):
+        return 'comments:roots:%s:%s:%s:%d:%s:%s' % (
+            self.ctype.pk, self.object_pk, self._generation(),
+            1 if self.reverse else 0,
+            start, stop
+        )
+
+    def _replies_cache_key(self, comment, key, count):
+        return 'comments:replies:%s:%s:%s:%s:%d:%s' % (
+            self.ctype.pk, self.object_pk, self._generation(),
+            comment.pk, count, md5(repr(key)).hexdigest()
+        )
+
+    def _thread_cache_key(self):
+        return 'comments:thread:%s:%s:%s' % (self.ctype.pk, self.object_pk, self._generation())
+
+    # not bound to the generation - threads grow by posting, a thread too big
+    # to be loaded stays too big for all the following generations
+    def _big_thread_cache_key(self):
+        return 'comments:thread:big:%s:%s:%d' % (self.ctype.pk, self.object_pk, self.FULL_THREAD_SIZE)
+
+    def _base_query_set(self):
+        return listed_comments().filter(content_type=self.ctype, object_pk=self.object_pk)
+
     def get_query_set(self):
         # basic queryset
-        qs = comments.get_model().objects.filter(content_type=self.ctype, object_pk=self.object_pk, site__pk=settings.SITE_ID, is_public=True)
-        if getattr(settings, 'COMMENTS_HIDE_REMOVED', False):
-            qs = qs.filter(is_removed=False)
+        qs = self._base_query_set()
 
         # only individual branches requested
         if self.ids:
-            # branch is everything whose tree_path begins with the same prefix
-            qs = qs.filter(reduce(
-                        operator.or_,
-                        map(lambda x: models.Q(tree_path__startswith=x.zfill(PATH_DIGITS)), self.ids)
-                ))
+            qs = qs.filter(self._branches_filter(self._branches()))
+
+        if self.max_depth:
+            qs = self._depth_filter(qs)
+
+        return qs.order_by(*self._order_by(self._ascending()))
+
+    def _max_path_length(self):
+        # PATH_DIGITS per level, separated by PATH_SEPARATOR
+        return self.max_depth * (PATH_DIGITS + len(PATH_SEPARATOR)) - len(PATH_SEPARATOR)
 
+    def _depth_filter(self, qs):
+        " Limit ``qs`` to comments at most max_depth levels deep by length of their tree_path. "
+        field, model = qs.model._meta.get_field_by_name('tree_path')[:2]
+        qn = connections[qs.db].ops.quote_name
+        column = '%s.%s' % (qn((model or qs.model)._meta.db_table), qn(field.column))
+        return qs.extra(where=['LENGTH(%s) <= %%s' % column], params=[self._max_path_length()])
+
+    def _branches(self):
+        " Sorted ids of root comments of the requested branches. "
+        return sorted(set(int(x) for x in self.ids if unicode(x).isdigit()))
+
+    def _branches_filter(self, branches):
+        """
+        Q object selecting comments in ``branches`` (root comment ids). Paths
+        in a branch start with the zero padded root id so every branch is a
+        half-open range of tree_path values, adjacent branches are merged.
+        """
+        ranges = []
+        for root_id in sorted(branches):
+            if ranges and ranges[-1][1] == root_id:
+                ranges[-1][1] = root_id + 1
+            else:
+                ranges.append([root_id, root_id + 1])
+        if not ranges:
+            return models.Q(pk__in=[])
+        return reduce(operator.or_, [
+            models.Q(tree_path__gte=str(lo).zfill(PATH_DIGITS), tree_path__lt=str(hi).zfill(PATH_DIGITS))
+            for lo, hi in ranges
+        ])
+
+    def _root_id(self, comment):
+        return int(comment.tree_path[:PATH_DIGITS])
+
+    def _subtree_filter(self, tree_path):
+        """
+        Q object selecting all the replies to comment with ``tree_path`` - the
+        paths between it and the same path followed by the character after
+        PATH_SEPARATOR.
+        """
+        return models.Q(tree_path__gt=tree_path, tree_path__lt=tree_path + chr(ord(PATH_SEPARATOR) + 1))
+
+    def _get_branch_data(self, kind, compute):
+        """
+        Return a dict of cached values of ``kind`` for every requested branch.
+        Branches missing in cache are passed to ``compute`` which returns
+        their values in one go.
+        """
+        keys = dict((self._branch_cache_key(kind, root_id), root_id) for root_id in self._branches())
+        data = dict((keys[k], v) for k, v in get_many_cached(keys.keys()).items())
+        missing = [root_id for root_id in keys.values() if root_id not in data]
+        if missing:
+            computed = compute(missing)
+            data.update(computed)
+            set_many_cached(dict((k, computed[root_id]) for k, root_id in keys.items() if root_id in computed), self.CACHE_TIMEOUT)
+        return data
+
+    def _get_branch_counts(self, replies=False):
+        def compute(branches):
+            counts = dict((root_id, 0) for root_id in branches)
+            qs = self._base_query_set().filter(self._branches_filter(branches))
+            for tree_path in qs.order_by().values_list('tree_path', flat=True).iterator():
+                if not replies or PATH_SEPARATOR in tree_path:
+                    counts[int(tree_path[:PATH_DIGITS])] += 1
+            return counts
+        return self._get_branch_data(replies and 'replies' or 'count', compute)
+
+    def _root_query_set(self):
+        return self._base_query_set().filter(parent__isnull=True)
+
+    def count_roots(self):
+        " Number of threads (root comments) in the list. "
+        thread = self.get_thread()
+        if thread is not None:
+            return len([c for c in thread if PATH_SEPARATOR not in c.tree_path])
+        return int(get_cached(self._roots_cache_key('count', ''), lambda: self._root_query_set().count(), self.CACHE_TIMEOUT))
+
+    def get_roots(self, start, stop):
+        " Root comments on positions ``start``:``stop`` among the roots in tree order. "
+        thread = self.get_thread()
+        if thread is not None:
+            roots = [c for c in thread if PATH_SEPARATOR not in c.tree_path]
+            if self.reverse:
+                roots.reverse()
+            return roots[start:stop]
+
+        def compute():
+            return pack_comments(self._root_query_set().order_by(self.reverse and '-tree_path' or 'tree_path')[start:stop])
+        return unpack_comments(get_cached(self._roots_cache_key(start, stop), compute, self.CACHE_TIMEOUT))
+
+    def get_first_replies(self, roots, count):
+        """
+        Return a dict mapping ids of ``roots`` to lists of their first
+        ``count`` replies (not below max_depth) in tree order. Every thread is
+        cached on its own and costs at most one query limited to ``count`` rows.
+        """
+        if not count or not roots or self.max_depth == 1:
+            return dict((r.pk, []) for r in roots)
+
+        thread = self.get_thread()
+        if thread is not None:
+            length = self.max_depth and self._max_path_length()
+            replies = dict((r.pk, []) for r in roots)
+            for c in thread:
+                first = replies.get(self._root_id(c))
+                if first is None or PATH_SEPARATOR not in c.tree_path or len(first) >= count:
+                    continue
+                if not length or len(c.tree_path) <= length:
+                    first.append(c)
+            return replies
+
+        def compute(branches):
+            items = {}
+            for root_id in branches:
+                qs = self._base_query_set().filter(self._subtree_filter(str(root_id).zfill(PATH_DIGITS)))
+                if self.max_depth:
+                    qs = self._depth_filter(qs)
+                items[root_id] = pack_comments(qs.order_by('tree_path')[:count])
+            return items
+
+        clist = CachedCommentList(self.ctype, self.object_pk, ids=[r.pk for r in roots])
+        clist._gen = self._generation()
+        packed = clist._get_branch_data('first:%d:%s' % (count, self.max_depth), compute)
+        return dict((root_id, unpack_comments(p)) for root_id, p in packed.items())
+
+    def get_collapsed_list(self, start, stop, replies):
+        """
+        Threads on positions ``start``:``stop``, every root comment followed
+        by at most ``replies`` of its first replies.
+        """
+        roots = self.get_roots(start, stop)
+        first = self.get_first_replies(roots, replies)
+        items = []
+        for r in roots:
+            items.append(r)
+            items.extend(first.get(r.pk, []))
+        return items
+
+    def get_replies(self, comment, count, after=None):
+        """
+        Return up to ``count`` replies to ``comment`` (its whole subtree) in
+        tree order following the cursor ``after`` together with a cursor for
+        the next page, None if there are no more replies. Only the subtree's
+        range of tree_paths is queried. Cursors are those of tree ordered lists,
+        ValueError is raised for invalid ones.
+        """
+        key = comment.tree_path
+        if after is not None:
+            key = max(key, self.parse_cursor(after))
+
+        thread = self.get_thread()
+        if thread is not None:
+            end = comment.tree_path + chr(ord(PATH_SEPARATOR) + 1)
+            items = [c for c in thread if key < c.tree_path < end][:count + 1]
+        else:
+            def compute():
+                qs = self._base_query_set().filter(self._subtree_filter(comment.tree_path), tree_path__gt=key)
+                return pack_comments(qs.order_by('tree_path')[:count + 1])
+            items = unpack_comments(get_cached(self._replies_cache_key(comment, key, count), compute, self.CACHE_TIMEOUT))
+
+        # one more item was fetched to see if there is a next page
+        if len(items) > count:
+            return items[:count], self.make_cursor(items[count - 1])
+        return items, None
+
+    def get_truncated_counts(self, items):
+        """
+        Return a dict mapping comments from ``items`` whose replies were left
+        out of the list (being below max_depth) to numbers of these replies,
+        for "show more" links.
+        Only tree_paths of the hidden replies are loaded, in one query.
+        """
+        if not self.max_depth:
+            return {}
+        length = self._max_path_length()
+        leaves = [c for c in items if len(c.tree_path) == length]
+        if not leaves:
+            return {}
+
+        def compute():
+            counts = dict((c.tree_path, 0) for c in leaves)
+            thread = self.get_thread()
+            if thread is not None:
+                paths = (c.tree_path for c in thread)
+            else:
+                qs = self._base_query_set().filter(reduce(operator.or_, [self._subtree_filter(c.tree_path) for c in leaves]))
+                paths = qs.order_by().values_list('tree_path', flat=True).iterator()
+            for tree_path in paths:
+                if len(tree_path) > length and tree_path[:length] in counts:
+                    counts[tree_path[:length]] += 1
+            return counts
+
+        counts = get_cached(self._truncated_cache_key(leaves), compute, self.CACHE_TIMEOUT)
+        return dict((c, counts[c.tree_path]) for c in leaves if counts[c.tree_path])
+
+    def get_reply_counts(self, root_ids):
+        """
+        Return a dict mapping ``root_ids`` (ids of root comments) to numbers of
+        replies in their threads without loading them - one HMGET of the
+        counters kept in redis or the cached per-branch counts.
+        """
+        if client:
+            return get_reply_counts(self.ctype.pk, self.object_pk, root_ids)
+        clist = CachedCommentList(self.ctype, self.object_pk, ids=root_ids)
+        clist._gen = self._generation()
+        return clist._get_branch_counts(replies=True)
+
+    def _get_branch_thread(self):
+        """
+        Return comments in all the requested branches in tree order, loaded
+        from per-branch caches.
+        """
+        def compute(branches):
+            items = dict((root_id, []) for root_id in branches)
+            for c in self._base_query_set().filter(self._branches_filter(branches)).order_by('tree_path'):
+                items[self._root_id(c)].append(c)
+            return dict((root_id, pack_comments(branch)) for root_id, branch in items.items())
+
+        branches = self._get_branch_data('list', compute)
+        return [c for root_id in sorted(branches) for c in unpack_comments(branches[root_id])]
+
+    def _get_items(self):
+        """
+        All the comments of the list in tree order if they are available
+        without querying the list itself - from the full thread cache or from
+        the branch caches for lists of branches. None otherwise.
+        """
+        thread = self.get_thread()
+        if thread is None and self.ids:
+            thread = self._get_branch_thread()
+        return thread
+
+    def _ascending(self):
+        " Is the list ordered by ascending tree_path/submit_date? "
         if self.flat:
-            order = '-submit_date' if not self.reverse else 'submit_date'
+            return self.reverse
+        return not self.reverse
+
+    def _order_by(self, ascending):
+        if self.flat:
+            # pk is there to make the order unique for keyset pagination
+            fields = ('submit_date', 'pk')
         else:
-            order = 'tree_path' if not self.reverse else '-tree_path'
-        qs = qs.order_by(order)
+            fields = ('tree_path', )
+        if not ascending:
+            fields = tuple('-' + f for f in fields)
+        return fields
+
+    def _sort_key(self, comment):
+        if self.flat:
+            return (comment.submit_date, comment.pk)
+        return comment.tree_path
+
+    def get_thread(self):
+        """
+        Return all the comments for the object in tree order, all the variants
+        (ordering, branches, pages) can then be computed from it in memory.
+        Returns None for threads larger than FULL_THREAD_SIZE.
+        """
+        if not self.FULL_THREAD_SIZE:
+            return None
 
-        return qs
+        def compute():
+            big_key = self._big_thread_cache_key()
+            if cache.get(big_key):
+                return False
+            # don't trust the counters, one row more tells the thread is too big
+            items = list(self._base_query_set().order_by('tree_path')[:self.FULL_THREAD_SIZE + 1])
+            if len(items) > self.FULL_THREAD_SIZE:
+                # remember the thread is too big so that we don't load it again
+                cache.set(big_key, True, self.CACHE_TIMEOUT)
+                return False
+            return pack_comments(items)
+
+        packed = get_cached(self._thread_cache_key(), compute, self.CACHE_TIMEOUT)
+        if packed is False:
+            return None
+        return unpack_comments(packed)
+
+    def _from_thread(self, thread):
+        items = thread
+        if self.ids:
+            branches = set(self._branches())
+            items = [c for c in items if self._root_id(c) in branches]
+        if self.max_depth:
+            length = self._max_path_length()
+            items = [c for c in items if len(c.tree_path) <= length]
+
+        if self.flat:
+            items = sorted(items, key=self._sort_key, reverse=not self.reverse)
+        elif self.reverse:
+            items = items[::-1]
+        return items
 
     def __len__(self):
-        if client and not self.ids:
+        if client and not self.ids and not self.max_depth:
             return int(client.get(COMCOUNT_KEY % (self.ctype.pk, self.object_pk)) or 0)
-        cnt = cache.get(self._count_cache_key())
-        if cnt is None:
-            cnt = self.get_query_set().count()
-            cache.set(self._count_cache_key(), cnt, self.CACHE_TIMEOUT)
-        return int(cnt)
+
+        if self.ids:
+            thread = self.get_thread()
+            if thread is None and self.max_depth:
+                thread = self._get_branch_thread()
+            if thread is not None:
+                return len(self._from_thread(thread))
+            return sum(self._get_branch_counts().values())
+
+        return int(get_cached(self._count_cache_key(), lambda: self.get_query_set().count(), self.CACHE_TIMEOUT))
     count = __len__
 
+    @classmethod
+    def get_counts(cls, objects):
+        """
+        Return a dict mapping ``count_key`` of ``objects`` to their comment
+        counts, using a single redis MGET or a cache multi-get followed by one
+        grouped query for the counts that are missing.
+        """
+        targets = [(obj, get_target_ctype(obj)) for obj in objects]
+        if not targets:
+            return {}
+
+        if client:
+            counts = client.mget([COMCOUNT_KEY % (ct.pk, obj.pk) for obj, ct in targets])
+            return dict(((ct.pk, obj.pk), int(cnt or 0)) for (obj, ct), cnt in zip(targets, counts))
+
+        gens = get_generations([(ct.pk, obj.pk) for obj, ct in targets])
+        lists = {}
+        for obj, ct in targets:
+            clist = cls(ct, obj.pk)
+            clist._gen = gens[(ct.pk, obj.pk)]
+            lists[clist._count_cache_key()] = (ct.pk, obj.pk)
+
+        cached = get_many_cached(lists.keys())
+        counts = dict((lists[key], cnt) for key, cnt in cached.items())
+
+        missing = [(key, ct_id, pk) for key, (ct_id, pk) in lists.items() if key not in cached]
+        if missing:
+            # one query for all the missing counts
+            qs = listed_comments().filter(reduce(operator.or_,
+                    [models.Q(content_type=ct_id, object_pk=pk) for key, ct_id, pk in missing]))
+            found = dict(
+                ((c['content_type'], unicode(c['object_pk'])), c['cnt'])
+                for c in qs.order_by().values('content_type', 'object_pk').annotate(cnt=Count('pk'))
+            )
+
+            to_cache = {}
+            for key, ct_id, pk in missing:
+                to_cache[key] = counts[(ct_id, pk)] = found.get((ct_id, unicode(pk)), 0)
+            set_many_cached(to_cache, cls.CACHE_TIMEOUT)
+
+        return dict(((ct.pk, obj.pk), int(counts[(ct.pk, obj.pk)])) for obj, ct in targets)
+
+    def _annotated(self):
+        return self.annotate and not self.flat
+
+    def _annotate(self, items):
+        """
+        Set ANNOTATIONS on ``items`` - what annotate_tree and group_threads
+        would compute when rendering them.
+        """
+        prev = None
+        for c in annotate_tree(items):
+            root = c.tree_path[:PATH_DIGITS]
+            if root != prev:
+                c.new_thread = True
+                prev = root
+            yield c
+
+    def _list_from_thread(self, start, stop):
+        thread = self._get_items()
+        if thread is None:
+            return None
+        items = self._from_thread(thread)
+        if start is not None:
+            items = items[start:stop]
+        return items
+
     def get_list(self, start=None, stop=None):
-        cache_key = self._cache_key(start, stop)
-        items = cache.get(cache_key)
-        if items is None:
+        if not self._annotated():
+            # slicing a cached thread is cheaper than caching its pages
+            items = self._list_from_thread(start, stop)
+            if items is not None:
+                return items
+
+        def compute():
+            items = self._list_from_thread(start, stop)
+            if items is None:
+                items = self._get_list_from_index(start, stop)
+            if items is None:
+                qs = self.get_query_set()
+                if start is not None:
+                    qs = qs[start:stop]
+                items = qs
+            if self._annotated():
+                return pack_comments(self._annotate(items), annotations=True)
+            return pack_comments(items)
+
+        return unpack_comments(get_cached(self._cache_key(start, stop), compute, self.CACHE_TIMEOUT))
+
+    def _get_list_from_index(self, start, stop):
+        """
+        Use the redis index (if enabled) to get ids of the comments on given
+        positions and load them by primary key, no ORDER BY/OFFSET needed.
+        """
+        if self.ids or self.max_depth or not comment_index_enabled():
+            return None
+        start = start or 0
+        if stop is not None and stop <= start:
+            return []
+
+        args = (self.ctype.pk, self.object_pk, settings.SITE_ID, self.flat, self._ascending(), start, stop)
+        ids = get_index_range(*args)
+        if ids is None:
+            self._build_index()
+            ids = get_index_range(*args)
+
+        comments_by_id = self._base_query_set().in_bulk(ids)
+        return [comments_by_id[i] for i in ids if i in comments_by_id]
+
+    def _build_index(self):
+        build_comment_index(self.ctype.pk, self.object_pk, settings.SITE_ID,
+            self._base_query_set().order_by().values_list('pk', 'tree_path', 'submit_date').iterator())
+
+    def get_position(self, comment):
+        """
+        Return the (0 based) position of ``comment`` in the list or None if it
+        isn't part of the list. Uses the full-thread cache, the redis index or
+        a COUNT of comments preceding ``comment``, never loads the list.
+        """
+        if (comment.content_type_id != self.ctype.pk or
+                str(comment.object_pk) != str(self.object_pk) or
+                comment.site_id != settings.SITE_ID or
+                not is_listed(comment.is_public, comment.is_removed)):
+            return None
+        if self.ids and self._root_id(comment) not in self._branches():
+            return None
+        if self.max_depth and len(comment.tree_path) > self._max_path_length():
+            return None
+
+        thread = self._get_items()
+        if thread is not None:
+            for i, c in enumerate(self._from_thread(thread)):
+                if c.pk == comment.pk:
+                    return i
+            return None
+
+        if not self.ids and not self.max_depth and comment_index_enabled():
+            args = (self.ctype.pk, self.object_pk, settings.SITE_ID, self.flat, self._ascending(), comment)
+            ready, position = get_index_rank(*args)
+            if not ready:
+                self._build_index()
+                ready, position = get_index_rank(*args)
+            return position
+
+        def compute():
+            # everything before comment in the list's order
+            return self.get_query_set().filter(
+                    self._cursor_filter(self._sort_key(comment), not self._ascending())
+                ).count()
+
+        return get_cached(self._position_cache_key(comment), compute, self.CACHE_TIMEOUT)
+
+    def make_cursor(self, comment):
+        """
+        Return an opaque cursor representing position of ``comment`` in the
+        list, to be used with ``get_cursor_page``.
+        """
+        if self.flat:
+            key = 'f:%s:%s' % (utc_localize(comment.submit_date).strftime(CURSOR_DATE_FORMAT), comment.pk)
+        else:
+            key = 't:%s' % comment.tree_path
+        return urlsafe_b64encode(key).rstrip('=')
+
+    def parse_cursor(self, cursor):
+        """
+        Return the sort key encoded in ``cursor``, raise ValueError if the
+        cursor is invalid or wasn't made for this kind of list.
+        """
+        try:
+            cursor = str(cursor)
+            key = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        except (TypeError, UnicodeEncodeError):
+            raise ValueError('Invalid cursor %r.' % cursor)
+
+        kind, _, key = key.partition(':')
+        if self.flat and kind == 'f':
+            submit_date, _, pk = key.partition(':')
+            return (utc_localize(datetime.strptime(submit_date, CURSOR_DATE_FORMAT)), int(pk))
+        elif not self.flat and kind == 't' and key:
+            return key
+        raise ValueError('Invalid cursor %r.' % cursor)
+
+    def _cursor_filter(self, key, ascending):
+        """
+        Q object selecting comments that follow ``key`` in ascending (or
+        descending) order of the list's sort key.
+        """
+        lookup = 'gt' if ascending else 'lt'
+        if self.flat:
+            submit_date, pk = key
+            return models.Q(**{'submit_date__' + lookup: submit_date}) | models.Q(submit_date=submit_date, **{'pk__' + lookup: pk})
+        return models.Q(**{'tree_path__' + lookup: key})
+
+    def _cursor_cache_key(self, key, forward, count):
+        return 'comments:cursor:%s:%s:%s:%d:%d:%s:%s:%d:%s' % (
+            self.ctype.pk, self.object_pk, self._generation(),
+            1 if self.reverse else 0,
+            1 if self.flat else 0,
+            self.max_depth or '',
+            1 if forward else 0,
+            count,
+            md5(repr(key)).hexdigest()
+        )
+
+    def _items_around(self, key, forward, count):
+        """
+        Return up to ``count`` items directly following (or preceding if not
+        ``forward``) the item with sort key ``key`` in the list's order.
+        """
+        ascending = self._ascending() == forward
+
+        thread = self._get_items()
+        if thread is not None:
+            items = self._from_thread(thread)
+            if not forward:
+                items = items[::-1]
+            if key is not None:
+                if ascending:
+                    items = [c for c in items if self._sort_key(c) > key]
+                else:
+                    items = [c for c in items if self._sort_key(c) < key]
+            return items[:count]
+
+        def compute():
             qs = self.get_query_set()
-            if start is not None:
-                qs = qs[start:stop]
-            items = list(qs)
-            cache.set(cache_key, items, self.CACHE_TIMEOUT)
-        return items
+            if key is not None:
+                qs = qs.filter(self._cursor_filter(key, ascending))
+            return pack_comments(qs.order_by(*self._order_by(ascending))[:count])
+
+        return unpack_comments(get_cached(self._cursor_cache_key(key, forward, count), compute, self.CACHE_TIMEOUT))
+
+    def get_cursor_page(self, count, after=None, before=None):
+        """
+        Keyset pagination - return ``count`` items following the cursor
+        ``after`` or preceding the cursor ``before`` (the first page if no
+        cursor is given) together with cursors for the previous and next
+        pages (None if there is no such page).
+
+        Unlike slicing this never uses OFFSET so all pages cost the same.
+        """
+        forward = before is None
+        key = None
+        if after is not None or before is not None:
+            key = self.parse_cursor(after if forward else before)
+
+        # fetch one more item to see if there are more pages
+        items = self._items_around(key, forward, count + 1)
+        more = len(items) > count
+        items = items[:count]
+
+        if forward:
+            has_prev, has_next = key is not None, more
+        else:
+            if not more:
+                # reached the beginning, return the full first page instead
+                return self.get_cursor_page(count)
+            items.reverse()
+            has_prev, has_next = True, True
+
+        prev_cursor = next_cursor = None
+        if items and has_prev:
+            prev_cursor = self.make_cursor(items[0])
+        if items and has_next:
+            next_cursor = self.make_cursor(items[-1])
+        return items, prev_cursor, next_cursor
 
     def __getitem__(self, key):
         assert isinstance(key, slice), 'CachedCommentList only supports slicing'
@@ -97,16 +906,115 @@ class CachedCommentList(object):
         return self.get_list(start, stop)
 
 
-def group_threads(items, prop=lambda x: x.tree_path[:PATH_DIGITS]):
-    groups = []
+class CollapsedCommentList(object):
+    """
+    Threads of a (tree ordered) CachedCommentList paged by their root
+    comments, each root followed by at most ``replies`` of its first replies
+    so that a page is never used up by a single long discussion. The rest of
+    a thread is loaded by ``CachedCommentList.get_replies``.
+    """
+    REPLIES = getattr(settings, 'COMMENTS_COLLAPSED_REPLIES', 3)
+
+    def __init__(self, clist, replies=None):
+        self.clist = clist
+        self.replies = replies if replies is not None else self.REPLIES
+
+    def __len__(self):
+        return self.clist.count_roots()
+    count = __len__
+
+    def __getitem__(self, key):
+        assert isinstance(key, slice), 'CollapsedCommentList only supports slicing'
+        assert not key.step, 'CollapsedCommentList doesn\'t support step'
+        return self.clist.get_collapsed_list(key.start or 0, key.stop or 0, self.replies)
+
+
+# tree transforms, generators so that they can be chained in one lazy pass
+
+def iter_threads(items, prop=lambda x: x.tree_path[:PATH_DIGITS]):
+    " Yield lists of consecutive ``items`` with the same ``prop`` (the same thread). "
+    group = []
     prev = None
     for i in items:
-        if prop(i) != prev:
-            prev = prop(i)
-            groups.append([])
-        groups[-1].append(i)
-    return groups
+        p = prop(i)
+        if p != prev and group:
+            yield group
+            group = []
+        prev = p
+        group.append(i)
+    if group:
+        yield group
+
+def group_threads(items, prop=lambda x: x.tree_path[:PATH_DIGITS]):
+    return list(iter_threads(items, prop))
 
+def annotate_tree(comments):
+    """
+    Same as ``threadedcomments.util.annotate_tree_properties`` - set ``open``,
+    ``close`` and ``last`` properties used to render the tree - but depth
+    and root of every comment are computed just once from its tree_path.
+    """
+    it = iter(comments)
+    try:
+        old = it.next()
+    except StopIteration:
+        return
+
+    # first item starts a new thread
+    old.open = True
+    old_depth, old_root = old.tree_path.count(PATH_SEPARATOR) + 1, old.tree_path[:PATH_DIGITS]
+    last = set()
+    for c in it:
+        # if this comment has a parent, store its last child for future reference
+        if old.last_child_id:
+            last.add(old.last_child_id)
+
+        # this is the last child, mark it
+        if c.pk in last:
+            c.last = True
+
+        depth, root = c.tree_path.count(PATH_SEPARATOR) + 1, c.tree_path[:PATH_DIGITS]
+        if depth > old_depth:
+            c.open = True
+        else:
+            # close some depths
+            old.close = range(old_depth - depth)
+
+            # new thread
+            if old_root != root:
+                # close even the top depth and start a new thread
+                old.close.append(len(old.close))
+                c.open = True
+                last = set()
+        yield old
+        old, old_depth, old_root = c, depth, root
+
+    old.close = range(old_depth)
+    yield old
+
+def fill_tree(comments):
+    """
+    Same as ``threadedcomments.util.fill_tree`` - prepend ancestors of the
+    first comment (marked with ``added_path``) so that its thread is visible.
+    """
+    it = iter(comments)
+    try:
+        first = it.next()
+    except StopIteration:
+        return
+
+    for c in first.root_path:
+        c.added_path = True
+        yield c
+    yield first
+    for c in it:
+        yield c
+
+
+OPTIONS_KEY = 'comments:options:%s:%s'
+OPTIONS_TIMEOUT = getattr(settings, 'COMMENTS_OPTIONS_CACHE_TIMEOUT', 24 * 60 * 60)
+# cached for objects without any CommentOptionsObject
+NO_OPTIONS = 'none'
 
 class CommentOptionsManager(models.Manager):
     def set_for_object(self, obj, **kwargs):
@@ -120,25 +1028,48 @@ class CommentOptionsManager(models.Manager):
         else:
             coo, created = self.get_or_create(target_ct=ContentType.objects.get_for_model(obj), target_id=obj.pk, defaults=kwargs)
             if not created:
-                for k, v in kwargs:
+                for k, v in kwargs.items():
                     setattr(coo, k, v)
                 coo.save(force_update=True)
 
 
     def get_for_object(self, obj):
-        if hasattr(obj, 'app_data'):
-            return obj.app_data.get('comments', DEFAULT_COMMENT_OPTIONS)
+        return self.get_for_objects([obj])[obj]
 
-        ct = ContentType.objects.get_for_model(obj)
-        try:
-            coo = get_cached_object(CommentOptionsObject, target_ct=ct, target_id=obj.pk)
-            return {
-                'blocked': coo.blocked,
-                'premoderated': coo.premoderated,
-                'check_profanities': coo.check_profanities,
-            }
-        except CommentOptionsObject.DoesNotExist:
-            return DEFAULT_COMMENT_OPTIONS
+    def get_for_objects(self, objs):
+        """
+        Return a dict mapping ``objs`` to their comment options. Options of
+        objects without ``app_data`` are looked up in cache and all the misses
+        are fetched by one query, missing rows are cached as well.
+        """
+        options = {}
+        keys = {}
+        for obj in objs:
+            if hasattr(obj, 'app_data'):
+                options[obj] = obj.app_data.get('comments', DEFAULT_COMMENT_OPTIONS)
+            else:
+                ct = ContentType.objects.get_for_model(obj)
+                keys[OPTIONS_KEY % (ct.pk, obj.pk)] = (obj, ct)
+
+        if not keys:
+            return options
+
+        cached = cache.get_many(keys.keys())
+        missing = [k for k in keys if k not in cached]
+        if missing:
+            q = reduce(operator.or_, [models.Q(target_ct=keys[k][1], target_id=keys[k][0].pk) for k in missing])
+            found = dict(
+                (OPTIONS_KEY % (coo.target_ct_id, coo.target_id), coo.as_options())
+                for coo in self.filter(q)
+            )
+            to_cache = dict((k, found.get(k, NO_OPTIONS)) for k in missing)
+            cache.set_many(to_cache, OPTIONS_TIMEOUT)
+            cached.update(to_cache)
+
+        for k, (obj, ct) in keys.items():
+            opts = cached[k]
+            options[obj] = opts == NO_OPTIONS and DEFAULT_COMMENT_OPTIONS or opts
+        return options
 
 
 class CommentOptionsObject(models.Model):
@@ -163,27 +1094,86 @@ class CommentOptionsObject(models.Model):
     def __unicode__(self):
         return u"%s: %s" % (_("Comment Options"), self.target)
 
+    def as_options(self):
+        return {
+            'blocked': self.blocked,
+            'premoderated': self.premoderated,
+            'check_profanities': self.check_profanities,
+        }
+
+def comment_options_changed(instance, **kwargs):
+    cache.delete(OPTIONS_KEY % (instance.target_ct_id, instance.target_id))
+
+post_save.connect(comment_options_changed, sender=CommentOptionsObject)
+post_delete.connect(comment_options_changed, sender=CommentOptionsObject)
+
+# fields whose original values are available in ``__pub_info`` during save
+PUB_INFO_FIELDS = ('is_public', 'is_removed')
+
+def _snapshot_pub_info(instance):
+    # fields can be deferred, don't trigger a query for them
+    if all(f in instance.__dict__ for f in PUB_INFO_FIELDS):
+        instance._pub_info_snapshot = dict((f, instance.__dict__[f]) for f in PUB_INFO_FIELDS)
+
 # signal handlers for sending comment_removed signals
+def comment_post_init(instance, **kwargs):
+    _snapshot_pub_info(instance)
+
 def comment_pre_save(instance, **kwargs):
-    if instance.pk:
-        try:
-            old_instance = instance.__class__._default_manager.get(pk=instance.pk)
-        except instance.__class__.DoesNotExist:
-            return
-        instance.__pub_info = {
-            'is_public': old_instance.is_public,
-            'is_removed': old_instance.is_removed,
-        }
+    if not instance.pk:
+        return
+
+    # values from the time the instance was loaded or last saved
+    if not instance._state.adding and hasattr(instance, '_pub_info_snapshot'):
+        instance.__pub_info = dict(instance._pub_info_snapshot)
+        return
+
+    try:
+        old_instance = instance.__class__._default_manager.get(pk=instance.pk)
+    except instance.__class__.DoesNotExist:
+        return
+    instance.__pub_info = {
+        'is_public': old_instance.is_public,
+        'is_removed': old_instance.is_removed,
+    }
 
 def comment_post_save(instance, **kwargs):
+    _snapshot_pub_info(instance)
     if hasattr(instance, '__pub_info'):
         # if this is a newly removed comment, send the comment_removed signal
         if not instance.__pub_info['is_removed'] and instance.is_removed:
             comment_removed.send(sender=instance.__class__, comment=instance)
 
 def comment_post_delete(instance, **kwargs):
+    if deleted_in_bulk(instance):
+        return
     comment_removed.send(sender=instance.__class__, comment=instance)
 
+# signal handlers for invalidating cached comment lists
+def comment_list_changed(comment, **kwargs):
+    bump_generation(comment.content_type_id, comment.object_pk)
+
+def comment_list_post_save(instance, **kwargs):
+    comment_list_changed(instance)
+
+# signal handlers for invalidating rendered comments
+def comment_version_changed(comment, **kwargs):
+    bump_versions([comment.pk])
+
+def comment_version_post_save(instance, **kwargs):
+    if not kwargs.get('created'):
+        comment_version_changed(instance)
+
+post_init.connect(comment_post_init, sender=comments.get_model())
 pre_save.connect(comment_pre_save, sender=comments.get_model())
 post_save.connect(comment_post_save, sender=comments.get_model())
 post_delete.connect(comment_post_delete, sender=comments.get_model())
+
+post_save.connect(comment_list_post_save, sender=comments.get_model())
+comment_was_posted.connect(comment_list_changed, sender=comments.get_model())
+comment_updated.connect(comment_list_changed, sender=comments.get_model())
+comment_removed.connect(comment_list_changed, sender=comments.get_model())
+
+post_save.connect(comment_version_post_save, sender=comments.get_model())
+comment_updated.connect(comment_version_changed, sender=comments.get_model())
+comment_removed.connect(comment_version_changed, sender=comments.get_model())
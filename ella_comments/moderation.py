@@ -0,0 +1,157 @@
+"""
+Bulk moderation of comments.
+
+Comments are changed by a single UPDATE instead of saving them one by one.
+Everything the per-comment signal handlers would do is then done once per
+affected object - cached comment lists and rendered comments are
+invalidated, redis counters, last comments and listings are recomputed in a
+pipeline and one ``comments_removed`` signal is sent for all removed
+comments. Deleted comments go through Django's deletion collector so that
+related objects are handled and post_delete is sent as usual - the
+handlers of this app skip such comments, they are updated with the rest.
+Everything runs in the caller's transaction.
+"""
+from django.contrib import comments
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import router
+from django.db.models.deletion import Collector
+
+from ella.core.cache import get_cached_object
+from ella.core.cache.redis import client
+
+from ella_comments.listing_handlers import comment_index_enabled, is_listed, index_add, index_remove, \
+    is_pending, pending_add, pending_remove
+from ella_comments.models import bump_generation, bump_versions, PUB_INFO_FIELDS
+from ella_comments.signals import comments_removed
+
+# comments per query when working with a list of ids
+CHUNK_SIZE = 500
+
+FIELDS = ('pk', 'content_type', 'object_pk', 'site', 'submit_date', 'tree_path', 'is_public', 'is_removed')
+
+def _load(queryset):
+    " Return lightweight instances of comments in ``queryset``. "
+    model = comments.get_model()
+    items = []
+    for values in queryset.order_by().values_list(*FIELDS):
+        c = model(**dict(zip(('pk', 'content_type_id', 'object_pk', 'site_id') + FIELDS[4:], values)))
+        c._state.adding = False
+        items.append(c)
+    return items
+
+def _get_objects(keys):
+    " Return commented objects for (ct_id, object_pk) ``keys``. "
+    objects = {}
+    for ct_id, object_pk in keys:
+        ct = ContentType.objects.get_for_id(ct_id)
+        try:
+            objects[(ct_id, object_pk)] = get_cached_object(ct, pk=object_pk)
+        except ObjectDoesNotExist:
+            pass
+    return objects
+
+def _chunks(ids):
+    for i in xrange(0, len(ids), CHUNK_SIZE):
+        yield ids[i:i + CHUNK_SIZE]
+
+def comments_changed(items, removed=False):
+    """
+    Update everything derived from comments after ``items`` were changed (or
+    deleted, with ``removed``) in bulk.
+    """
+    keys = set((c.content_type_id, c.object_pk) for c in items)
+    for ct_id, object_pk in keys:
+        bump_generation(ct_id, object_pk)
+    bump_versions([c.pk for c in items])
+
+    if client:
+        # avoid circular import, maintenance uses the listing handlers too
+        from ella_comments.maintenance import rebuild_objects
+        rebuild_objects(keys)
+
+    if client:
+        objects = _get_objects(keys)
+        pipe = client.pipeline()
+        for c in items:
+            if comment_index_enabled():
+                if not removed and is_listed(c.is_public, c.is_removed):
+                    index_add(c, pipe)
+                else:
+                    index_remove(c, pipe)
+
+            # flags from the time the comment was loaded
+            was_pending = is_pending(*[c._pub_info_snapshot[f] for f in PUB_INFO_FIELDS])
+            pending = not removed and is_pending(c.is_public, c.is_removed)
+            obj = objects.get((c.content_type_id, c.object_pk))
+            if was_pending and not pending:
+                pending_remove(c, pipe, obj)
+            elif pending and not was_pending:
+                pending_add(c, pipe, obj)
+        pipe.execute()
+
+    model = comments.get_model()
+    removed_items = [c for c in items if removed or c.is_removed]
+    if removed_items:
+        comments_removed.send(sender=model, comments=removed_items)
+
+def _moderate(queryset, values):
+    items = _load(queryset)
+    if not items:
+        return 0
+
+    queryset.update(**values)
+
+    for c in items:
+        for k, v in values.items():
+            setattr(c, k, v)
+    comments_changed(items)
+    return len(items)
+
+def approve_comments(queryset):
+    " Make comments in ``queryset`` public and not removed, return how many changed. "
+    return _moderate(queryset.exclude(is_public=True, is_removed=False), {'is_public': True, 'is_removed': False})
+
+def remove_comments(queryset):
+    " Mark comments in ``queryset`` as removed, return how many changed. "
+    return _moderate(queryset.filter(is_removed=False), {'is_removed': True})
+
+def delete_comments(queryset):
+    """
+    Delete comments in ``queryset`` including all their replies and objects
+    related to them, return the number of comments deleted. Parents that
+    stay get their ``last_child`` fixed.
+    """
+    model = comments.get_model()
+    ids = list(queryset.order_by().values_list('pk', flat=True))
+    if not ids:
+        return 0
+
+    # replies are collected through the cascading parent relation
+    collector = Collector(using=router.db_for_write(model))
+    for chunk in _chunks(ids):
+        collector.collect(model._base_manager.filter(pk__in=chunk))
+    items = list(collector.data.get(model, []))
+    pks = [c.pk for c in items]
+    for c in items:
+        c._deleted_in_bulk = True
+    collector.delete()
+    # the collector clears primary keys of deleted instances
+    for c, pk in zip(items, pks):
+        c.pk = pk
+
+    _fix_last_children(set(c.parent_id for c in items if c.parent_id) - set(c.pk for c in items))
+    comments_changed(items, removed=True)
+    return len(items)
+
+def _fix_last_children(parent_ids):
+    " Point ``last_child`` of comments with ``parent_ids`` to their latest remaining replies. "
+    model = comments.get_model()
+    for chunk in _chunks(list(parent_ids)):
+        last = {}
+        for parent_id, pk, submit_date in model._base_manager.filter(parent__in=chunk)\
+                .order_by().values_list('parent', 'pk', 'submit_date'):
+            if parent_id not in last or last[parent_id] < (submit_date, pk):
+                last[parent_id] = (submit_date, pk)
+        for parent_id, (submit_date, pk) in last.items():
+            model._base_manager.filter(pk=parent_id).update(last_child=pk)
@@ -7,6 +7,7 @@ try:
     from threadedcomments.models import ThreadedComment
     from threadedcomments.admin import ThreadedCommentsAdmin
 
+    from ella_comments import moderation
     from ella_comments.models import CommentOptionsObject
 
     class CommentOptionsGenericInline(newman.GenericStackedInline):
@@ -27,7 +28,7 @@ try:
             return actions
 
         def approve_comments(self, request, queryset):
-            n_comments = queryset.update(is_removed=False, is_public=True)
+            n_comments = moderation.approve_comments(queryset)
             msg = ungettext(u'1 comment was successfully approved.',
                 u'%(count)s comments were successfully approved.',
                 n_comments)
@@ -35,7 +36,7 @@ try:
         approve_comments.short_description = _('Approve selected comments')
 
         def remove_comments(self, request, queryset):
-            n_comments = queryset.update(is_removed=True)
+            n_comments = moderation.remove_comments(queryset)
             msg = ungettext(u'1 comment was successfully removed.',
                 u'%(count)s comments were successfully removed.',
                 n_comments)
@@ -2,3 +2,6 @@ from django.dispatch import Signal
 
 comment_removed = Signal(providing_args=['comment'])
 comment_updated = Signal(providing_args=['comment', 'updating_user', 'date_updated'])
+
+# sent once for comments removed or deleted by bulk moderation
+comments_removed = Signal(providing_args=['comments'])
@@ -2,15 +2,18 @@ from django import template
 from django.contrib.comments.templatetags import comments as dt
 from django.contrib.contenttypes.models import ContentType
 from django.conf import settings
+from django.template import loader
 from django.utils.encoding import smart_unicode
+from django.utils.safestring import mark_safe
 
-from threadedcomments.util import annotate_tree_properties, fill_tree
 from threadedcomments.templatetags import threadedcomments_tags as tt
 
 from ella.core.models import Publishable
 from ella.core.cache.redis import client
+from ella.core.views import get_templates_from_publishable
 
-from ella_comments.models import CommentOptionsObject, CachedCommentList, group_threads
+from ella_comments.models import CommentOptionsObject, CachedCommentList, group_threads, iter_threads, annotate_tree, fill_tree, \
+    render_fragments, count_key
 from ella_comments.listing_handlers import COMCOUNT_KEY
 
 register = template.Library()
@@ -70,9 +73,25 @@ class CommentCountNode(EllaMixin, dt.CommentCountNode):
 
 
 class CommentListNode(EllaMixin, tt.CommentListNode):
+    max_depth_expr = None
+
+    @classmethod
+    def handle_token(cls, parser, token):
+        tokens = token.contents.split()
+        max_depth_expr = None
+        if len(tokens) > 2 and tokens[-2] == 'max_depth':
+            max_depth_expr = parser.compile_filter(tokens[-1])
+            token = template.Token(token.token_type, ' '.join(tokens[:-2]))
+        node = super(CommentListNode, cls).handle_token(parser, token)
+        node.max_depth_expr = max_depth_expr
+        return node
+
     def get_query_set(self, context):
         ctype, object_pk = self.get_target_ctype_pk(context)
-        return CachedCommentList(ctype, object_pk)
+        max_depth = None
+        if self.max_depth_expr:
+            max_depth = int(self.max_depth_expr.resolve(context) or 0) or None
+        return CachedCommentList(ctype, object_pk, max_depth=max_depth)
 
     def get_context_value_from_queryset(self, context, qs):
         paginate_by = getattr(settings, 'COMMENTS_PAGINATE_BY', 50)
@@ -89,6 +108,7 @@ def get_comment_list(parser, token):
 
         {% get_comment_list for [object] as [varname] %}
         {% get_comment_list for [app].[model] [object_id] as [varname] %}
+        {% get_comment_list for [object] as [varname] max_depth [depth] %}
 
     Example usage::
 
@@ -127,9 +147,6 @@ def render_comment_form(parser, token):
     """
     return RenderCommentFormNode.handle_token(parser, token)
 
-def annotate_tree(comments):
-    return annotate_tree_properties(comments)
-
 # copied from django.comments
 def get_comment_count(parser, token):
     """
@@ -152,6 +169,137 @@ def get_comment_count(parser, token):
     return CommentCountNode.handle_token(parser, token)
 
 
+class CommentCountsNode(template.Node):
+    def __init__(self, objects_expr, as_varname):
+        self.objects_expr = objects_expr
+        self.as_varname = as_varname
+
+    def render(self, context):
+        try:
+            objects = self.objects_expr.resolve(context)
+        except template.VariableDoesNotExist:
+            objects = []
+        context[self.as_varname] = CachedCommentList.get_counts(objects or [])
+        return ''
+
+def get_comment_counts(parser, token):
+    """
+    Gets comment counts for all objects in a list at once and populates the
+    template context with a dict mapping the objects to their counts. Use the
+    ``count_for`` filter to get the count of an individual object.
+
+    Syntax::
+
+        {% get_comment_counts for [object_list] as [varname] %}
+
+    Example usage::
+
+        {% get_comment_counts for object_list as counts %}
+        {% for obj in object_list %}
+            {{ counts|count_for:obj }}
+        {% endfor %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 5 or bits[1] != 'for' or bits[3] != 'as':
+        raise template.TemplateSyntaxError("%r tag syntax is {%% %r for [object_list] as [varname] %%}" % (bits[0], bits[0]))
+    return CommentCountsNode(parser.compile_filter(bits[2]), bits[4])
+
+def count_for(counts, obj):
+    return counts.get(count_key(obj), 0)
+
+
+class ReplyCountsNode(template.Node):
+    def __init__(self, comments_expr, as_varname):
+        self.comments_expr = comments_expr
+        self.as_varname = as_varname
+
+    def render(self, context):
+        try:
+            comment_list = self.comments_expr.resolve(context)
+        except template.VariableDoesNotExist:
+            comment_list = []
+
+        # root comments grouped by the commented object
+        roots = {}
+        for c in comment_list or []:
+            if c.parent_id is None:
+                roots.setdefault((c.content_type_id, c.object_pk), []).append(c)
+
+        counts = {}
+        for (ct_id, object_pk), root_comments in roots.items():
+            clist = CachedCommentList(ContentType.objects.get_for_id(ct_id), object_pk)
+            replies = clist.get_reply_counts([c.pk for c in root_comments])
+            for c in root_comments:
+                counts[count_key(c)] = replies.get(c.pk, 0)
+        context[self.as_varname] = counts
+        return ''
+
+def get_reply_counts(parser, token):
+    """
+    Gets numbers of replies to all the root comments in a list at once
+    without loading the replies and populates the template context with a
+    dict mapping the root comments to their counts.
+
+    Syntax::
+
+        {% get_reply_counts for [comment_list] as [varname] %}
+
+    Example usage::
+
+        {% get_reply_counts for comment_list as replies %}
+        {% for comment in comment_list %}
+            {{ replies|count_for:comment }} replies
+        {% endfor %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 5 or bits[1] != 'for' or bits[3] != 'as':
+        raise template.TemplateSyntaxError("%r tag syntax is {%% %r for [comment_list] as [varname] %%}" % (bits[0], bits[0]))
+    return ReplyCountsNode(parser.compile_filter(bits[2]), bits[4])
+
+
+class RenderCommentsNode(template.Node):
+    def __init__(self, comments_expr, template_expr):
+        self.comments_expr = comments_expr
+        self.template_expr = template_expr
+
+    def get_template(self, name, context):
+        obj = context.get('object')
+        if obj is None:
+            return loader.get_template(name)
+        if hasattr(obj, 'get_templates'):
+            return loader.select_template(obj.get_templates(name))
+        return loader.select_template(get_templates_from_publishable(name, obj))
+
+    def render(self, context):
+        try:
+            comment_list = self.comments_expr.resolve(context)
+        except template.VariableDoesNotExist:
+            comment_list = []
+        t = self.get_template(self.template_expr.resolve(context), context)
+        return mark_safe(u''.join(render_fragments(comment_list or [], t)))
+
+def render_comments(parser, token):
+    """
+    Renders every comment in a list by the given template (looked up in the
+    templates of ``object`` if there is one in the context) in a context
+    holding just the comment as ``comment`` - variables of the page are not
+    available. Rendered comments are cached until the comment is updated or
+    removed and only those not in cache are rendered.
+
+    Syntax::
+
+        {% render_comments [comment_list] using [template_name] %}
+
+    Example usage::
+
+        {% render_comments comment_list using "comment_item.html" %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 4 or bits[2] != 'using':
+        raise template.TemplateSyntaxError("%r tag syntax is {%% %r [comment_list] using [template_name] %%}" % (bits[0], bits[0]))
+    return RenderCommentsNode(parser.compile_filter(bits[1]), parser.compile_filter(bits[3]))
+
+
 class CommentOptionsNode(EllaMixin, dt.BaseCommentNode):
 
     def render(self, context):
@@ -177,10 +325,16 @@ def get_comment_options(parser, token):
 
 
 register.filter(group_threads)
+# lazy variant for a single {% for %} over large lists
+register.filter(iter_threads)
 register.filter(annotate_tree)
 register.filter(fill_tree)
+register.filter(count_for)
 register.tag(get_comment_list)
 register.tag(get_comment_form)
 register.tag(render_comment_form)
 register.tag(get_comment_count)
+register.tag(get_comment_counts)
+register.tag(get_reply_counts)
+register.tag(render_comments)
 register.tag(get_comment_options)
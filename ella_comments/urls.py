@@ -6,11 +6,13 @@ except ImportError:
     from django.conf.urls.defaults import patterns, url
 
 from ella.core.custom_urls import resolver
-from ella_comments.views import list_comments, post_comment, update_comment, comment_detail
+from ella_comments.views import list_comments, post_comment, update_comment, comment_detail, moderation_queue, \
+    list_replies
 
 urlpatterns = patterns('',
     url(r'^$', list_comments, name='comments-list'),
     url(r'^(?P<comment_id>\d+)/$', comment_detail, name='comment-detail'),
+    url(r'^%s/(?P<comment_id>\d+)/$' % slugify(_('replies')), list_replies, name='comments-replies'),
     url(r'^%s/(?P<comment_id>\d+)/$' % slugify(_('update')), update_comment, name='comments-update'),
     url(r'^%s/$' % slugify(_('new')), post_comment, name='comments-new'),
     url(r'^%s/(?P<parent_id>\d+)/$' % slugify(_('new')), post_comment, name='comments-reply'),
@@ -18,3 +20,9 @@ urlpatterns = patterns('',
 
 resolver.register(urlpatterns, prefix=slugify(_('comments')))
 
+
+# not bound to an object, include these in your urls.py under some prefix
+moderation_urlpatterns = patterns('',
+    url(r'^$', moderation_queue, name='comments-moderation-queue'),
+    url(r'^(?P<category_id>\d+)/$', moderation_queue, name='comments-moderation-queue-category'),
+)
@@ -7,19 +7,23 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.html import escape
 from django.template import RequestContext
 from django.shortcuts import get_object_or_404, render_to_response
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.db import transaction
 from django.core.paginator import Paginator
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.utils import importlib
+from django.utils import importlib, simplejson
+from django.core.exceptions import PermissionDenied
 
 from ella.core.views import get_templates_from_publishable
 from ella.core.custom_urls import resolver
+from ella.core.cache.redis import client
 from ella.utils.timezone import now
 
-from ella_comments.models import CommentOptionsObject, CachedCommentList
+from ella_comments.models import CommentOptionsObject, CachedCommentList, CollapsedCommentList, listed_comments
 from ella_comments.signals import comment_updated
+from ella_comments.listing_handlers import PENDING_SITE_KEY, PENDING_CATEGORY_KEY, \
+    get_pending_range, is_pending, pending_remove
 
 
 class CommentView(object):
@@ -93,7 +97,7 @@ class UpdateComment(SaveComment):
         if not request.user.is_authenticated():
             raise Http404("you are not logged in")
 
-        # Try to get the comment owned by the current user
+        # Try to get the comment owned by the current user, it is then passed along
         try:
             comment = self.get_comment_for_user(context['object'], request.user, comment_id)
         except comments.get_model().DoesNotExist:
@@ -317,22 +321,100 @@ class ListComments(CommentView):
         ids = ()
         if 'ids' in request.GET:
             ids = request.GET.getlist('ids')
+        max_depth = None
+        if 'depth' in request.GET and request.GET['depth'].isdigit():
+            max_depth = int(request.GET['depth']) or None
         ctype = ContentType.objects.get_for_model(context['object'])
-        clist = CachedCommentList(ctype, context['object'].pk, reverse=reverse, ids=ids)
+        clist = CachedCommentList(ctype, context['object'].pk, reverse=reverse, ids=ids, max_depth=max_depth)
 
-        paginator = Paginator(clist, paginate_by)
+        if 'after' in request.GET or 'before' in request.GET:
+            # keyset pagination, cost of the page doesn't depend on its depth
+            try:
+                comment_list, prev_cursor, next_cursor = clist.get_cursor_page(
+                    paginate_by, after=request.GET.get('after'), before=request.GET.get('before'))
+            except ValueError:
+                raise Http404()
+
+            context.update({
+                'comment_list': comment_list,
+                'page': None,
+                'is_paginated': bool(prev_cursor or next_cursor),
+                'results_per_page': paginate_by,
+                'prev_cursor': prev_cursor,
+                'next_cursor': next_cursor,
+            })
+        else:
+            object_list = clist
+            collapsed = 'collapsed' in request.GET and not ids
+            if collapsed:
+                # page by threads, each with only its first replies
+                replies = request.GET['collapsed']
+                object_list = CollapsedCommentList(clist, int(replies) if replies.isdigit() else None)
+            paginator = Paginator(object_list, paginate_by)
+
+            if page_no > paginator.num_pages or page_no < 1:
+                raise Http404()
+
+            page = paginator.page(page_no)
+            object_list = page.object_list
+            context.update({
+                'comment_list': object_list,
+                'page': page,
+                'is_paginated': paginator.num_pages > 1,
+                'results_per_page': paginate_by,
+                'prev_cursor': None,
+                'next_cursor': None,
+            })
+            if not collapsed:
+                # allow templates to switch to cursors for further pages, they
+                # point into the full list and can't continue a collapsed one
+                context.update({
+                    'prev_cursor': clist.make_cursor(object_list[0]) if object_list and page.has_previous() else None,
+                    'next_cursor': clist.make_cursor(object_list[-1]) if object_list and page.has_next() else None,
+                })
+
+        # numbers of replies hidden below the max_depth level
+        context['truncated_counts'] = clist.get_truncated_counts(context['comment_list'])
+
+        return render_to_response(
+            self.get_template(templates['list_template'], context),
+            context,
+            RequestContext(request)
+        )
+
+class ListReplies(CommentView):
+    normal_templates = dict(
+            list_template = 'comment_replies.html',
+        )
+    async_templates = dict(
+            list_template = 'comment_replies_async.html',
+        )
+
+    def __call__(self, request, context, comment_id):
+        """
+        Replies to comment ``comment_id`` paged by cursors (``after``), used
+        to expand threads of collapsed lists.
+        """
+        templates = self.normal_templates
+        if request.is_ajax():
+            templates = self.async_templates
+
+        page_no, paginate_by, reverse = list_comments.get_display_params(request.GET)
+        ctype = ContentType.objects.get_for_model(context['object'])
+        comment = get_object_or_404(listed_comments(), pk=comment_id, content_type=ctype, object_pk=context['object'].pk)
 
-        if page_no > paginator.num_pages or page_no < 1:
+        clist = CachedCommentList(ctype, context['object'].pk, flat=False)
+        try:
+            comment_list, next_cursor = clist.get_replies(comment, paginate_by, after=request.GET.get('after'))
+        except ValueError:
             raise Http404()
 
-        page = paginator.page(page_no)
         context.update({
-            'comment_list': page.object_list,
-            'page': page,
-            'is_paginated': paginator.num_pages > 1,
+            'comment': comment,
+            'comment_list': comment_list,
             'results_per_page': paginate_by,
+            'next_cursor': next_cursor,
         })
-
         return render_to_response(
             self.get_template(templates['list_template'], context),
             context,
@@ -373,7 +455,9 @@ def comment_detail(request, context, comment_id):
     results_per_page = _get_results_per_page(content_object, results_per_page)
 
     # Find the page on which the comment is located
-    index = clist.get_list().index(comment) # This isn't very efficient, I know
+    index = clist.get_position(comment)
+    if index is None:
+        raise Http404()
     page = ((index) / results_per_page) + 1
 
     # Redirect the user to the content_object's detail page passing the `p` GET param to fetch the comments page on which this comment is found
@@ -404,4 +488,53 @@ if getattr(settings, 'COMMENTS_AUTHORIZED_ONLY', False):
     post_comment = login_required(post_comment)
 
 list_comments = ListComments()
+list_replies = ListReplies()
 update_comment = UpdateComment()
+
+
+def moderation_queue(request, category_id=None):
+    """
+    List comments waiting for moderation on the current site or in given
+    category, oldest first. The queue is kept in redis so that no query over
+    all the comments is needed, ``p`` and ``pby`` GET params page it.
+    """
+    if not client:
+        raise Http404()
+    if not request.user.has_perm('comments.can_moderate'):
+        raise PermissionDenied()
+
+    page_no, paginate_by, reverse = list_comments.get_display_params(request.GET)
+    if category_id is not None:
+        key = PENDING_CATEGORY_KEY % category_id
+    else:
+        key = PENDING_SITE_KEY % settings.SITE_ID
+
+    start = (page_no - 1) * paginate_by
+    ids, total = get_pending_range(key, start, start + paginate_by)
+    found = comments.get_model()._default_manager.in_bulk(ids)
+
+    # moderated or deleted by means not covered by the signals
+    comment_list, stale = [], client.pipeline()
+    for pk in ids:
+        c = found.get(int(pk))
+        if c is None:
+            # the commented object is unknown, only the queue can be fixed
+            stale.zrem(key, pk)
+        elif not is_pending(c.is_public, c.is_removed):
+            pending_remove(c, stale)
+        else:
+            comment_list.append(c)
+    stale.execute()
+
+    context = {
+        'comment_list': comment_list,
+        'page_no': page_no,
+        'paginate_by': paginate_by,
+        'total': total,
+        'has_previous': page_no > 1,
+        'has_next': start + paginate_by < total,
+    }
+    if request.GET.get('format') == 'json':
+        data = dict(context, comment_list=[c.pk for c in comment_list])
+        return HttpResponse(simplejson.dumps(data), mimetype='application/json')
+    return render_to_response('comments/moderation_queue.html', context, RequestContext(request))
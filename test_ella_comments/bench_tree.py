@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the tree filters used to render comment threads, compares
+the list based implementations with the generators in ``ella_comments.models``.
+
+    python test_ella_comments/bench_tree.py [number of comments]
+
+Every variant runs in a forked process so that peak memory (maxrss) of one
+doesn't hide the other.
+"""
+import os
+import sys
+import gc
+import resource
+from os.path import abspath, dirname
+from timeit import default_timer
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_ella_comments.settings')
+
+from threadedcomments.models import ThreadedComment, PATH_DIGITS, PATH_SEPARATOR
+from threadedcomments.util import annotate_tree_properties
+
+from ella_comments.models import iter_threads, annotate_tree
+
+REPEAT = 5
+
+def build_thread(size):
+    " ``size`` comments in tree order, threads of 50 comments nested up to 5 levels. "
+    items = []
+    path = []
+    for pk in xrange(1, size + 1):
+        depth = pk % 50 and min(len(path), 4) + (pk % 3 and 1 or 0) or 0
+        path = path[:depth] + [str(pk).zfill(PATH_DIGITS)]
+        items.append(ThreadedComment(id=pk, tree_path=PATH_SEPARATOR.join(path), last_child_id=None))
+    return items
+
+def group_threads_lists(items, prop=lambda x: x.tree_path[:PATH_DIGITS]):
+    " The original list building ``group_threads``. "
+    groups = []
+    prev = None
+    for i in items:
+        if prop(i) != prev:
+            prev = prop(i)
+            groups.append([])
+        groups[-1].append(i)
+    return groups
+
+def render_lists(items):
+    # each filter materialized its output before passing it on
+    for thread in group_threads_lists(list(annotate_tree_properties(items))):
+        for c in thread:
+            pass
+
+def render_generators(items):
+    for thread in iter_threads(annotate_tree(items)):
+        for c in thread:
+            pass
+
+def measure(func, items):
+    " Run ``func`` in a child process, return (best time, maxrss growth in kB). "
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        gc.collect()
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        best = None
+        for i in xrange(REPEAT):
+            start = default_timer()
+            func(items)
+            best = min(best, default_timer() - start) if best is not None else default_timer() - start
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(w, '%r %d' % (best, peak - base))
+        os._exit(0)
+
+    os.close(w)
+    os.waitpid(pid, 0)
+    best, rss = os.read(r, 100).split()
+    os.close(r)
+    return float(best), int(rss)
+
+def main(size):
+    items = build_thread(size)
+    print '%d comments, best of %d runs' % (size, REPEAT)
+    for name, func in (('lists', render_lists), ('generators', render_generators)):
+        best, rss = measure(func, items)
+        print '%-12s %8.2f ms %8d kB' % (name, best * 1000, rss)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
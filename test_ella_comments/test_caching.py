@@ -0,0 +1,81 @@
+import time
+import threading
+
+from django.core.cache import get_cache
+from django.test import TestCase
+
+from mock import patch
+from nose import tools
+
+from ella_comments import caching
+
+
+class TestGetCached(TestCase):
+    def setUp(self):
+        super(TestGetCached, self).setUp()
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.cache.clear()
+        self.patcher = patch.object(caching, 'cache', self.cache)
+        self.patcher.start()
+        caching.reset_stats()
+        self.calls = 0
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.cache.clear()
+        super(TestGetCached, self).tearDown()
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_value_is_computed_once(self):
+        tools.assert_equals(1, caching.get_cached('key', self.compute, 10))
+        tools.assert_equals(1, caching.get_cached('key', self.compute, 10))
+        tools.assert_equals(1, self.calls)
+
+    def test_expired_value_is_recomputed(self):
+        caching.get_cached('key', self.compute, 10)
+        self.cache.set('key', (1, time.time() - 1))
+        tools.assert_equals(2, caching.get_cached('key', self.compute, 10))
+
+    def test_stale_value_is_served_while_somebody_else_recomputes(self):
+        caching.get_cached('key', self.compute, 10)
+        self.cache.set('key', (1, time.time() - 1))
+        self.cache.add(caching._lock_key('key'), 1)
+        tools.assert_equals(1, caching.get_cached('key', self.compute, 10))
+        tools.assert_equals(1, self.calls)
+        tools.assert_equals(1, caching.get_stats()['stale_served'])
+
+    @patch.object(caching, 'LOCK_WAIT', 0.1)
+    def test_missing_value_is_computed_after_waiting_for_lock(self):
+        self.cache.add(caching._lock_key('key'), 1)
+        tools.assert_equals(1, caching.get_cached('key', self.compute, 10))
+        tools.assert_equals(1, caching.get_stats()['lock_waits'])
+
+    def test_threads_share_one_computation(self):
+        started = threading.Event()
+        release = threading.Event()
+        def slow_compute():
+            started.set()
+            release.wait(5)
+            return self.compute()
+
+        results = []
+        def get():
+            results.append(caching.get_cached('key', slow_compute, 10))
+
+        threads = [threading.Thread(target=get)]
+        threads[0].start()
+        started.wait(5)
+        threads.append(threading.Thread(target=get))
+        threads[1].start()
+        # give the second thread time to join the computation
+        time.sleep(0.1)
+        release.set()
+        for t in threads:
+            t.join()
+
+        tools.assert_equals([1, 1], results)
+        tools.assert_equals(1, self.calls)
+        tools.assert_equals(1, caching.get_stats()['coalesced'])
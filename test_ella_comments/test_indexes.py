@@ -0,0 +1,52 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import importlib
+
+from ella_comments.models import CachedCommentList, listed_comments
+
+from nose import tools, SkipTest
+
+migration = importlib.import_module('ella_comments.migrations.0006_add_comment_listing_index')
+
+
+class TestListingIndex(TestCase):
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            raise SkipTest()
+
+        super(TestListingIndex, self).setUp()
+        self.ctype = ContentType.objects.get_for_model(ContentType)
+
+        # south isn't installed in tests, apply the migration by hand; sqlite
+        # commits before DDL and EXPLAIN, so no data may be written in tests
+        migration.Migration().forwards(None)
+
+    def tearDown(self):
+        migration.Migration().backwards(None)
+        super(TestListingIndex, self).tearDown()
+
+    def get_plan(self, qs):
+        sql, params = qs.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return ' '.join(row[-1] for row in cursor.fetchall())
+
+    def assert_uses_index(self, qs):
+        plan = self.get_plan(qs)
+        tools.assert_true(migration.INDEX_NAME in plan, plan)
+        tools.assert_false('TEMP B-TREE' in plan, plan)
+
+    def test_flat_list_is_index_range_scan(self):
+        clist = CachedCommentList(self.ctype, 1, flat=True)
+        self.assert_uses_index(clist.get_query_set())
+
+    @override_settings(COMMENTS_HIDE_REMOVED=True)
+    def test_list_without_removed_comments_is_index_range_scan(self):
+        clist = CachedCommentList(self.ctype, 1, flat=True)
+        self.assert_uses_index(clist.get_query_set())
+
+    def test_count_is_index_range_scan(self):
+        qs = listed_comments().filter(content_type=self.ctype, object_pk=1)
+        tools.assert_true(migration.INDEX_NAME in self.get_plan(qs.values('pk')))
@@ -2,14 +2,19 @@ import mock
 
 from datetime import datetime
 
+from django.conf import settings
 from django.contrib import comments
+from django.contrib.sites.models import Site
+from django.core.signals import request_started, request_finished, got_request_exception
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from ella.core.cache.redis import client
 from ella.utils.test_helpers import create_basic_categories, create_and_place_a_publishable
 from ella.utils.timezone import utc_localize, use_tz
 
-from ella_comments import listing_handlers
+from ella_comments import listing_handlers, deferred, maintenance
+from ella_comments.models import CachedCommentList
 
 from nose import tools, SkipTest
 
@@ -78,6 +83,34 @@ class TestListingHandlers(TestCase):
         tools.assert_equals({'submit_date': tstamp, 'user_id': '', 'username': 'kvbik', 'comment': '', 'url': ''}, client.hgetall('lastcom:pub:%d:1' % ct_id))
         tools.assert_equals('1', client.get('comcount:pub:%d:1' % ct_id))
 
+    def test_comment_posted_takes_one_round_trip(self):
+        comment = create_comment(self.publishable, self.publishable.content_type)
+        client.flushdb()
+        pipelines = []
+        def pipeline(*args, **kwargs):
+            pipe = real_pipeline(*args, **kwargs)
+            pipelines.append(pipe)
+            return pipe
+        real_pipeline = client.pipeline
+
+        patchers = [
+            mock.patch.object(client, 'pipeline', pipeline),
+            mock.patch.object(client, 'execute_command', mock.Mock(side_effect=AssertionError('unexpected redis call'))),
+        ]
+        for p in patchers:
+            p.start()
+        try:
+            listing_handlers.comment_posted(comment)
+        finally:
+            for p in patchers:
+                p.stop()
+
+        tools.assert_equals(1, len(pipelines))
+        ct_id = self.publishable.content_type_id
+        tools.assert_equals(1.0, client.zscore('comcount:2', '%d:1' % ct_id))
+        tools.assert_equals(1.0, client.zscore('slidingccount:2', '%d:1' % ct_id))
+        tools.assert_equals(client.hget('lastcom:pub:%d:1' % ct_id, 'submit_date'), repr(client.zscore('lastcom:2', '%d:1' % ct_id)))
+
 class TestCommentPostSaveSignalHandler(TestListingHandlers):
     " Unit tests for `ella_comments.listing_handlers.comment_post_save()`. "
     def setUp(self):
@@ -158,11 +191,58 @@ class TestCommentPostSaveSignalHandler(TestListingHandlers):
             0
         )
 
+    def _create_two_comments(self):
+        older = self._create_comment()
+        newer = create_comment(self.publishable, self.publishable.content_type, user_name='newer',
+            submit_date=utc_localize(datetime(2010, 10, 11, 10, 10, 10)))
+        return older, newer
+
+    def _last_username(self):
+        return client.hget(listing_handlers.LASTCOM_KEY % (self.publishable.content_type_id, self.publishable.pk), 'username')
+
+    def test_hiding_older_comment_keeps_last_comment(self):
+        older, newer = self._create_two_comments()
+        older.is_public = False
+        setattr(older, '__pub_info', {'is_public': True, 'is_removed': False})
+        self.assertNumQueries(0, lambda: listing_handlers.comment_post_save(older))
+        tools.assert_equals('1', client.get(self._build_publishable_comment_count_key(self.publishable)))
+        tools.assert_equals('newer', self._last_username())
+
+    def test_hiding_last_comment_finds_previous_one(self):
+        older, newer = self._create_two_comments()
+        newer.is_removed = True
+        newer.save()
+        tools.assert_equals('1', client.get(self._build_publishable_comment_count_key(self.publishable)))
+        tools.assert_equals('kvbik', self._last_username())
+
+        newer.is_removed = False
+        newer.save()
+        tools.assert_equals('2', client.get(self._build_publishable_comment_count_key(self.publishable)))
+        tools.assert_equals('newer', self._last_username())
+
+    def test_premoderated_comment_is_counted_once_approved(self):
+        comment = create_comment(self.publishable, self.publishable.content_type, user_name='pending', is_public=False)
+        tools.assert_equals(None, client.get(self._build_publishable_comment_count_key(self.publishable)))
+        tools.assert_equals(None, self._last_username())
+
+        comment.is_public = True
+        comment.save()
+        tools.assert_equals('1', client.get(self._build_publishable_comment_count_key(self.publishable)))
+        tools.assert_equals('pending', self._last_username())
+        tools.assert_equals(1.0, client.zscore('comcount:2', '%d:1' % self.publishable.content_type_id))
+
+    def test_missing_counter_is_reconciled(self):
+        older, newer = self._create_two_comments()
+        client.delete(self._build_publishable_comment_count_key(self.publishable))
+        newer.is_public = False
+        newer.save()
+        tools.assert_equals('1', client.get(self._build_publishable_comment_count_key(self.publishable)))
+
     @mock.patch.object(listing_handlers, 'client')
     def test_client_invoked(self, mock_client):
         """
         Call `comment_post_save()` with a comment that has been modified,
-        and assert that the client was not invoked.
+        and assert that the counter was not touched.
         """
         # Create a new public comment
         comment = self._create_comment()
@@ -176,8 +256,8 @@ class TestCommentPostSaveSignalHandler(TestListingHandlers):
         # Pass this comment to the `comment_post_save()` signal handler
         listing_handlers.comment_post_save(comment)
 
-        # Assert that that client.set() was called w/ the appropriate args
-        mock_client.set.assert_called_with(
+        # Assert that that the counter was incremented
+        mock_client.pipeline.return_value.incrby.assert_called_with(
             self._build_publishable_comment_count_key(self.publishable),
             1
         )
@@ -186,7 +266,7 @@ class TestCommentPostSaveSignalHandler(TestListingHandlers):
     def test_client_not_invoked(self, mock_client):
         """
         Call `comment_post_save()` with a comment that has not been modified,
-        and assert that `client.set()` was not invoked.
+        and assert that the counter was not touched.
         """
         # Create a new public comment
         comment = self._create_comment()
@@ -200,5 +280,226 @@ class TestCommentPostSaveSignalHandler(TestListingHandlers):
         # Pass this comment to the `comment_post_save()` signal handler
         listing_handlers.comment_post_save(comment)
 
-        # Assert that the `set` method was NOT called
+        # Assert that the counter was NOT touched
+        tools.assert_false(mock_client.pipeline.return_value.incrby.called)
         tools.assert_false(mock_client.set.called)
+
+@override_settings(COMMENTS_REDIS_INDEX=True)
+class TestCommentIndex(TestCase):
+    def setUp(self):
+        if not client:
+            raise SkipTest()
+
+        super(TestCommentIndex, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        client.flushdb()
+        self.ct_id = self.publishable.content_type_id
+
+    def get_list(self, **kwargs):
+        clist = CachedCommentList(self.publishable.content_type, self.publishable.pk, **kwargs)
+        # don't cache the whole thread, go to the index
+        clist.FULL_THREAD_SIZE = 0
+        return clist
+
+    def test_index_is_built_on_first_use(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        b = create_comment(self.publishable, self.publishable.content_type)
+        client.flushdb()
+        tools.assert_equals([a, b], self.get_list().get_list(0, 10))
+        tools.assert_equals(2, client.zcard(listing_handlers.COMINDEX_TREE_KEY % (self.ct_id, self.publishable.pk, settings.SITE_ID)))
+
+    def test_index_is_maintained_by_signals(self):
+        tools.assert_equals([], self.get_list().get_list(0, 10))
+        a = create_comment(self.publishable, self.publishable.content_type)
+        b = create_comment(self.publishable, self.publishable.content_type)
+        ab = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        tools.assert_equals([a.pk, ab.pk, b.pk], listing_handlers.get_index_range(self.ct_id, self.publishable.pk, settings.SITE_ID, False, True, 0, None))
+        tools.assert_equals([ab.pk, b.pk, a.pk], listing_handlers.get_index_range(self.ct_id, self.publishable.pk, settings.SITE_ID, True, False, 0, None))
+
+        b.is_public = False
+        b.save()
+        tools.assert_equals([a.pk, ab.pk], listing_handlers.get_index_range(self.ct_id, self.publishable.pk, settings.SITE_ID, False, True, 0, None))
+
+        a.delete()
+        tools.assert_equals([], listing_handlers.get_index_range(self.ct_id, self.publishable.pk, settings.SITE_ID, False, True, 0, None))
+
+    def test_comments_from_other_sites_are_not_indexed(self):
+        other = Site.objects.create(domain='other.example.com', name='other')
+        a = create_comment(self.publishable, self.publishable.content_type)
+        create_comment(self.publishable, self.publishable.content_type, site=other)
+        tools.assert_equals([a], self.get_list().get_list(0, 10))
+        tools.assert_equals([a.pk], listing_handlers.get_index_range(self.ct_id, self.publishable.pk, settings.SITE_ID, False, True, 0, None))
+        tools.assert_equals(None, listing_handlers.get_index_range(self.ct_id, self.publishable.pk, other.pk, False, True, 0, None))
+
+    def test_pages_are_loaded_by_primary_key(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        b = create_comment(self.publishable, self.publishable.content_type)
+        ab = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        tools.assert_equals([ab, a], self.get_list(reverse=True)[1:3])
+
+    def test_position_is_rank_in_index(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        b = create_comment(self.publishable, self.publishable.content_type)
+        ab = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        client.delete(listing_handlers.COMINDEX_READY_KEY % (self.ct_id, self.publishable.pk, settings.SITE_ID))
+        tools.assert_equals(1, self.get_list().get_position(ab))
+        tools.assert_equals(0, self.get_list(reverse=True).get_position(b))
+        tools.assert_equals(0, self.get_list(flat=True).get_position(ab))
+
+
+class TestReplyCounts(TestCase):
+    def setUp(self):
+        if not client:
+            raise SkipTest()
+
+        super(TestReplyCounts, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        client.flushdb()
+
+        ct = self.publishable.content_type
+        self.a = create_comment(self.publishable, ct)
+        self.ab = create_comment(self.publishable, ct, parent_id=self.a.pk)
+        self.abc = create_comment(self.publishable, ct, parent_id=self.ab.pk)
+        self.d = create_comment(self.publishable, ct)
+
+    def tearDown(self):
+        client.flushdb()
+        super(TestReplyCounts, self).tearDown()
+
+    def get_counts(self):
+        return listing_handlers.get_reply_counts(self.publishable.content_type_id, self.publishable.pk, [self.a.pk, self.d.pk])
+
+    def test_replies_are_counted_per_thread(self):
+        tools.assert_equals({self.a.pk: 2, self.d.pk: 0}, self.get_counts())
+
+    def test_hidden_reply_is_not_counted(self):
+        self.abc.is_public = False
+        self.abc.save()
+        tools.assert_equals({self.a.pk: 1, self.d.pk: 0}, self.get_counts())
+
+    def test_deleted_thread_is_dropped(self):
+        self.a.delete()
+        tools.assert_false(client.hexists(listing_handlers.COMREPLIES_KEY % (self.publishable.content_type_id, self.publishable.pk), self.a.tree_path))
+
+    def test_rebuild_restores_reply_counts(self):
+        client.flushdb()
+        maintenance.rebuild_counters()
+        tools.assert_equals({self.a.pk: 2, self.d.pk: 0}, self.get_counts())
+
+
+class TestDeferredHandlers(TestCase):
+    def setUp(self):
+        if not client:
+            raise SkipTest()
+
+        super(TestDeferredHandlers, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        client.flushdb()
+        self.comment = create_comment(self.publishable, self.publishable.content_type)
+        # start from scratch, the comment was counted by the synchronous handlers
+        client.flushdb()
+        self.count_key = listing_handlers.COMCOUNT_KEY % (self.publishable.content_type_id, self.publishable.pk)
+
+    def tearDown(self):
+        deferred.discard()
+        client.flushdb()
+        super(TestDeferredHandlers, self).tearDown()
+
+    @mock.patch.object(deferred, 'MODE', 'redis')
+    def test_tasks_wait_for_end_of_request(self):
+        request_started.send(sender=None)
+        listing_handlers.deferred_comment_posted(self.comment)
+        tools.assert_equals(0, client.llen(deferred.QUEUE_KEY))
+        request_finished.send(sender=None)
+        tools.assert_equals(1, client.llen(deferred.QUEUE_KEY))
+
+    @mock.patch.object(deferred, 'MODE', 'redis')
+    def test_tasks_are_queued_immediately_outside_of_request(self):
+        # management commands and scripts never finish a request
+        listing_handlers.deferred_comment_posted(self.comment)
+        tools.assert_equals(1, client.llen(deferred.QUEUE_KEY))
+
+    @mock.patch.object(deferred, 'MODE', 'redis')
+    def test_tasks_of_failed_request_are_queued(self):
+        request_started.send(sender=None)
+        listing_handlers.deferred_comment_posted(self.comment)
+        got_request_exception.send(sender=None, request=None)
+        request_finished.send(sender=None)
+        tools.assert_equals(1, client.llen(deferred.QUEUE_KEY))
+
+    def test_tasks_of_one_object_share_a_thread(self):
+        other = create_comment(self.publishable, self.publishable.content_type)
+        with mock.patch.object(deferred, '_start_threads'):
+            deferred.defer('comment_posted', self.comment)
+            deferred.defer('comment_post_save', other, {'is_public': True, 'is_removed': False})
+        queue = deferred._get_queue('%s:%s' % (self.publishable.content_type_id, self.publishable.pk))
+        tools.assert_equals(['comment_posted', 'comment_post_save'], [queue.get_nowait()[0][0] for i in range(2)])
+
+    @mock.patch.object(deferred, 'MODE', 'redis')
+    def test_worker_executes_queued_task(self):
+        listing_handlers.deferred_comment_posted(self.comment)
+        tools.assert_true(deferred.process_queue(1))
+        tools.assert_equals('1', client.get(self.count_key))
+        tools.assert_false(deferred.process_queue(1))
+
+    @mock.patch.object(deferred, 'MODE', 'redis')
+    def test_pub_info_is_passed_to_the_worker(self):
+        self.comment.is_public = False
+        self.comment.save()
+        listing_handlers.deferred_comment_post_save(self.comment)
+        tools.assert_true(deferred.process_queue(1))
+        tools.assert_equals('0', client.get(self.count_key))
+
+    def run_queued(self):
+        # the synchronous handlers counted the changes too, count just self.comment
+        client.set(self.count_key, 1)
+        while deferred.process_queue(1):
+            pass
+
+    @mock.patch.object(deferred, 'MODE', 'redis')
+    def test_changes_queued_before_the_worker_runs_are_counted_once(self):
+        other = create_comment(self.publishable, self.publishable.content_type, is_public=False)
+        listing_handlers.deferred_comment_posted(other)
+        other.is_public = True
+        other.save()
+        listing_handlers.deferred_comment_post_save(other)
+        other.is_removed = True
+        other.save()
+        listing_handlers.deferred_comment_post_save(other)
+
+        self.run_queued()
+        tools.assert_equals('1', client.get(self.count_key))
+
+    @mock.patch.object(deferred, 'MODE', 'redis')
+    def test_comment_removed_before_the_worker_runs_is_counted_once(self):
+        other = create_comment(self.publishable, self.publishable.content_type)
+        listing_handlers.deferred_comment_posted(other)
+        other.is_removed = True
+        other.save()
+        listing_handlers.deferred_comment_post_save(other)
+
+        self.run_queued()
+        tools.assert_equals('1', client.get(self.count_key))
+
+    @mock.patch.object(deferred, 'MODE', 'redis')
+    @mock.patch.object(deferred, 'RETRY_DELAY', 0)
+    def test_failed_task_is_retried(self):
+        handler = mock.Mock(side_effect=[ValueError(), None])
+        deferred.register('failing', handler)
+        deferred.enqueue(('failing', self.comment.pk, None, None, 0))
+        tools.assert_true(deferred.process_queue(1))
+        tools.assert_true(deferred.process_queue(1))
+        tools.assert_equals(2, handler.call_count)
+        tools.assert_equals(0, client.zcard(deferred.QUEUE_KEY + ':retry'))
+
+    @mock.patch.object(deferred, 'MAX_RETRIES', 0)
+    def test_task_is_not_retried_forever(self):
+        tools.assert_false(deferred.retry(('failing', self.comment.pk, None, None, 0)))
+
+    def test_task_for_missing_comment_is_dropped(self):
+        deferred.register('noop', mock.Mock())
+        deferred.run_task(('noop', self.comment.pk + 1000, None, None, 0))
+        tools.assert_false(deferred._handlers['noop'].called)
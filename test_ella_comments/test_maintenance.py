@@ -0,0 +1,173 @@
+from datetime import datetime, timedelta
+
+from django.contrib import comments
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TestCase
+
+from ella.core.cache.redis import client
+from ella.utils.test_helpers import create_basic_categories, create_and_place_a_publishable
+from ella.utils.timezone import now, utc_localize, localize
+
+from ella_comments import maintenance
+
+from mock import patch
+from nose import tools, SkipTest
+
+from test_ella_comments.helpers import create_comment
+
+
+def dump_redis():
+    " Return the content of redis as a dict. "
+    data = {}
+    for k in client.keys('*'):
+        t = client.type(k)
+        if t == 'string':
+            data[k] = client.get(k)
+        elif t == 'hash':
+            data[k] = client.hgetall(k)
+        elif t == 'set':
+            data[k] = client.smembers(k)
+        elif t == 'zset':
+            data[k] = client.zrange(k, 0, -1, withscores=True)
+    return data
+
+
+class TestRebuildCounters(TestCase):
+    def setUp(self):
+        if not client:
+            raise SkipTest()
+
+        super(TestRebuildCounters, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        client.flushdb()
+
+        ct = self.publishable.content_type
+        category_ct = ContentType.objects.get_for_model(self.category)
+        create_comment(self.publishable, ct, user_name='old', submit_date=utc_localize(datetime(2010, 10, 10, 10, 10, 10)))
+        create_comment(self.publishable, ct, user_name='recent', submit_date=now() - timedelta(days=1))
+        create_comment(self.publishable, ct, user_name='removed', is_removed=True)
+        create_comment(self.category, category_ct, user_name='category')
+        create_comment(self.category_nested, category_ct, user_name='nested')
+
+    def tearDown(self):
+        client.flushdb()
+        super(TestRebuildCounters, self).tearDown()
+
+    def test_iter_comment_stats_is_chunked(self):
+        chunks = [rows for last, rows in maintenance.iter_comment_stats(chunk_size=2)]
+        # the publishable's comments are in the first chunk, the categories' in the second one
+        tools.assert_equals([1, 2], map(len, chunks))
+        tools.assert_equals([1, 1, 2], sorted(r['cnt'] for chunk in chunks for r in chunk))
+
+    def test_object_is_yielded_with_its_first_comment(self):
+        # the third chunk has just the publishable's comment, it was counted already
+        create_comment(self.publishable, self.publishable.content_type)
+        chunks = [rows for last, rows in maintenance.iter_comment_stats(chunk_size=2)]
+        tools.assert_equals([1, 2], map(len, chunks))
+        tools.assert_equals(3, chunks[0][0]['cnt'])
+
+    def test_objects_are_aggregated_once(self):
+        create_comment(self.publishable, self.publishable.content_type)
+        with patch.object(maintenance, '_object_stats', wraps=maintenance._object_stats) as object_stats:
+            list(maintenance.iter_comment_stats(chunk_size=2))
+        keys = [key for args, kwargs in object_stats.call_args_list for key in args[0]]
+        tools.assert_equals(len(set(keys)), len(keys))
+
+    def test_rebuild_restores_flushed_redis(self):
+        # live updates put comments to slots by the time of posting, start from the rebuilt state
+        client.flushdb()
+        maintenance.rebuild_counters()
+        expected = dump_redis()
+
+        client.flushdb()
+        tools.assert_equals(3, maintenance.rebuild_counters(chunk_size=1))
+        tools.assert_equals(expected, dump_redis())
+        tools.assert_equals('2', client.get('comcount:pub:%d:%d' % (self.publishable.content_type_id, self.publishable.pk)))
+
+    def test_recently_commented_counts_comments_within_window(self):
+        client.flushdb()
+        maintenance.rebuild_counters()
+        tools.assert_equals([('%d:1' % self.publishable.content_type_id, 1.0)], client.zrange('slidingccount:2', 0, -1, withscores=True))
+
+    def test_recently_commented_keeps_live_updates(self):
+        client.flushdb()
+        create_comment(self.publishable, self.publishable.content_type)
+        day_key = 'slidingccount:2:%s' % localize(now()).strftime('%Y%m%d')
+        member = '%d:1' % self.publishable.content_type_id
+        # a comment posted while the rebuild runs, not seen by its query
+        client.zincrby(day_key, member, 1)
+        maintenance.rebuild_recently_commented()
+        tools.assert_equals(2.0, client.zscore(day_key, member))
+
+    def test_rebuild_can_continue_after_given_object(self):
+        last, rows = list(maintenance.iter_comment_stats(chunk_size=2))[0]
+        tools.assert_equals(2, maintenance.rebuild_counters(start=last))
+
+    def test_command(self):
+        client.flushdb()
+        call_command('rebuild_comment_counters', verbosity=0)
+        tools.assert_equals('recent', client.hget('lastcom:pub:%d:%d' % (self.publishable.content_type_id, self.publishable.pk), 'username'))
+
+
+@patch.object(maintenance, 'RECHECK_DELAY', 0)
+class TestDriftCheck(TestCase):
+    def setUp(self):
+        if not client:
+            raise SkipTest()
+
+        super(TestDriftCheck, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        client.flushdb()
+
+        self.key = (self.publishable.content_type_id, unicode(self.publishable.pk))
+        self.count_key = 'comcount:pub:%s:%s' % self.key
+        create_comment(self.publishable, self.publishable.content_type)
+        self.comment = create_comment(self.publishable, self.publishable.content_type)
+
+    def tearDown(self):
+        client.flushdb()
+        super(TestDriftCheck, self).tearDown()
+
+    def test_sample_contains_recently_commented_objects(self):
+        tools.assert_true(self.key in maintenance.sample_objects(size=1))
+
+    def test_consistent_counts_pass(self):
+        tools.assert_equals([], maintenance.check_counts([self.key]))
+
+    def test_drift_is_detected_and_fixed(self):
+        # bypass the signals like a queryset update does
+        comments.get_model()._default_manager.filter(pk=self.comment.pk).update(is_public=False)
+        tools.assert_equals([self.key + (2, 1)], maintenance.check_counts([self.key]))
+        tools.assert_equals('2', client.get(self.count_key))
+
+        maintenance.check_counts([self.key], fix=True)
+        tools.assert_equals('1', client.get(self.count_key))
+
+    def test_transient_mismatch_is_not_fixed(self):
+        # the comment's handlers run between the two checks
+        client.set(self.count_key, 1)
+        with patch.object(maintenance, 'rebuild_objects') as rebuild_objects:
+            with patch.object(maintenance.time, 'sleep', lambda delay: client.set(self.count_key, 2)):
+                tools.assert_equals([], maintenance.check_counts([self.key], fix=True))
+        tools.assert_false(rebuild_objects.called)
+        tools.assert_equals('2', client.get(self.count_key))
+
+    def test_object_without_comments_is_fixed(self):
+        comments.get_model()._default_manager.update(is_removed=True)
+        maintenance.check_counts([self.key], fix=True)
+        tools.assert_equals('0', client.get(self.count_key))
+
+    def test_drift_stats_are_recorded(self):
+        client.set(self.count_key, 5)
+        checked, mismatches = maintenance.check_drift(size=10, fix=True)
+        tools.assert_equals(1, checked)
+        stats = maintenance.get_drift_stats()
+        tools.assert_equals((1, 1, 1), (stats['checked'], stats['mismatched'], stats['fixed']))
+        tools.assert_equals('2', client.get(self.count_key))
+
+    def test_command(self):
+        call_command('check_comment_counts', verbosity=0)
+        tools.assert_equals(1, maintenance.get_drift_stats()['checked'])
@@ -0,0 +1,497 @@
+import cPickle
+from itertools import count
+
+from django.core.cache import get_cache
+from django.contrib import comments
+from django.contrib.contenttypes.models import ContentType
+from django.test import TestCase
+
+from mock import patch
+from nose import tools
+
+from ella.core.cache.redis import client
+from ella.core.models import Author
+from ella.utils.test_helpers import create_basic_categories, create_and_place_a_publishable
+
+from threadedcomments.util import annotate_tree_properties, fill_tree
+
+from ella_comments import models, caching
+from ella_comments.models import CachedCommentList, CollapsedCommentList, CommentOptionsObject, count_key
+from ella_comments.signals import comment_updated
+
+from test_ella_comments.helpers import create_comment
+
+
+class CachedCommentListTestCase(TestCase):
+    def setUp(self):
+        super(CachedCommentListTestCase, self).setUp()
+        if client:
+            client.flushdb()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        # tests run with dummy cache, use a real one to test invalidation
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.cache.clear()
+        self.patchers = [patch.object(models, 'cache', self.cache), patch.object(caching, 'cache', self.cache)]
+        for p in self.patchers:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patchers:
+            p.stop()
+        self.cache.clear()
+        if client:
+            client.flushdb()
+        super(CachedCommentListTestCase, self).tearDown()
+
+    def get_list(self, **kwargs):
+        return CachedCommentList(self.publishable.content_type, self.publishable.pk, **kwargs)
+
+
+class TestCacheGeneration(CachedCommentListTestCase):
+    def test_new_comment_is_visible_immediately(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        tools.assert_equals([a], self.get_list()[0:10])
+        b = create_comment(self.publishable, self.publishable.content_type)
+        tools.assert_equals([a, b], self.get_list()[0:10])
+
+    def test_cached_list_is_reused_while_generation_is_same(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        tools.assert_equals([a], self.get_list()[0:10])
+        # nothing changed, no query needed
+        self.assertNumQueries(0, lambda: self.get_list()[0:10])
+
+    def test_updated_comment_bumps_generation(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        gen = self.get_list()._generation()
+        comment_updated.send(sender=a.__class__, comment=a, updating_user=None, date_updated=None)
+        tools.assert_not_equals(gen, self.get_list()._generation())
+
+    def test_removed_comment_disappears_from_count(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        b = create_comment(self.publishable, self.publishable.content_type)
+        tools.assert_equals(2, self.get_list(ids=[str(a.pk), str(b.pk)]).count())
+        b.is_public = False
+        b.save()
+        tools.assert_equals(1, self.get_list(ids=[str(a.pk), str(b.pk)]).count())
+
+
+class TestFullThreadCache(CachedCommentListTestCase):
+    def setUp(self):
+        super(TestFullThreadCache, self).setUp()
+        self.a = create_comment(self.publishable, self.publishable.content_type)
+        self.d = create_comment(self.publishable, self.publishable.content_type)
+        self.ab = create_comment(self.publishable, self.publishable.content_type, parent_id=self.a.pk)
+        self.de = create_comment(self.publishable, self.publishable.content_type, parent_id=self.d.pk)
+
+    def test_all_variants_are_served_from_one_query(self):
+        self.assertNumQueries(1, lambda: self.get_list()[0:2])
+        def variants():
+            tools.assert_equals([self.ab, self.d], self.get_list()[1:3])
+            tools.assert_equals([self.de, self.d, self.ab, self.a], self.get_list(reverse=True)[0:10])
+            tools.assert_equals([self.a, self.ab], self.get_list(ids=[str(self.a.pk)])[0:10])
+            tools.assert_equals(2, self.get_list(ids=[str(self.d.pk)]).count())
+            tools.assert_equals(4, len(self.get_list(flat=True)[0:10]))
+            tools.assert_equals(self.a, self.get_list().get_list()[0])
+        self.assertNumQueries(0, variants)
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 2)
+    def test_big_threads_are_paged_in_db(self):
+        tools.assert_equals(None, self.get_list().get_thread())
+        tools.assert_equals([self.ab, self.d], self.get_list()[1:3])
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 2)
+    def test_big_thread_is_not_loaded_with_low_counter(self):
+        if client:
+            client.set('comcount:pub:%s:%s' % (self.publishable.content_type_id, self.publishable.pk), 1)
+        tools.assert_equals(None, self.get_list().get_thread())
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 2)
+    def test_big_thread_is_not_loaded_again_after_new_comment(self):
+        self.get_list().get_thread()
+        create_comment(self.publishable, self.publishable.content_type)
+        self.assertNumQueries(0, lambda: self.get_list().get_thread())
+
+
+class TestPackedComments(CachedCommentListTestCase):
+    def setUp(self):
+        super(TestPackedComments, self).setUp()
+        self.a = create_comment(self.publishable, self.publishable.content_type, comment='first')
+        self.ab = create_comment(self.publishable, self.publishable.content_type, parent_id=self.a.pk)
+        self.d = create_comment(self.publishable, self.publishable.content_type)
+        self.items = list(self.get_list().get_query_set())
+
+    def test_unpacked_comments_have_all_fields_needed_for_rendering(self):
+        unpacked = models.unpack_comments(models.pack_comments(self.items))
+        tools.assert_equals(self.items, unpacked)
+        tools.assert_equals(u'first', unpacked[0].comment)
+        tools.assert_equals(self.ab.tree_path, unpacked[1].tree_path)
+        tools.assert_equals(self.a.pk, unpacked[1].parent_id)
+        tools.assert_equals(self.items[0].submit_date, unpacked[0].submit_date)
+
+    def test_unpacked_comments_work_with_annotate_tree(self):
+        unpacked = models.unpack_comments(models.pack_comments(self.items))
+        annotated = list(annotate_tree_properties(unpacked))
+        tools.assert_true(annotated[0].open)
+        tools.assert_true(annotated[1].open)
+        tools.assert_equals([0, 1], annotated[1].close)
+
+    @patch.object(models, 'COMPRESS_THRESHOLD', 1)
+    def test_big_lists_are_compressed(self):
+        packed = models.pack_comments(self.items)
+        tools.assert_equals('z', packed[0])
+        tools.assert_equals(self.items, models.unpack_comments(packed))
+
+
+class CommentTreeTestCase(CachedCommentListTestCase):
+    def setUp(self):
+        super(CommentTreeTestCase, self).setUp()
+        self.a = create_comment(self.publishable, self.publishable.content_type)
+        self.d = create_comment(self.publishable, self.publishable.content_type)
+        self.ab = create_comment(self.publishable, self.publishable.content_type, parent_id=self.a.pk)
+        self.de = create_comment(self.publishable, self.publishable.content_type, parent_id=self.d.pk)
+        self.ac = create_comment(self.publishable, self.publishable.content_type, parent_id=self.a.pk)
+
+
+class TestCursorPagination(CommentTreeTestCase):
+
+    def assert_pages(self, **kwargs):
+        clist = self.get_list(**kwargs)
+        expected = clist.get_list()
+
+        items, prev, next = clist.get_cursor_page(2)
+        tools.assert_equals(expected[:2], items)
+        tools.assert_equals(None, prev)
+
+        items, prev, next = clist.get_cursor_page(2, after=next)
+        tools.assert_equals(expected[2:4], items)
+
+        items, prev, last = clist.get_cursor_page(2, after=next)
+        tools.assert_equals(expected[4:], items)
+        tools.assert_equals(None, last)
+
+        items, prev, next = clist.get_cursor_page(2, before=prev)
+        tools.assert_equals(expected[2:4], items)
+
+    def test_threaded_pages(self):
+        self.assert_pages()
+
+    def test_reversed_threaded_pages(self):
+        self.assert_pages(reverse=True)
+
+    def test_flat_pages(self):
+        self.assert_pages(flat=True)
+
+    def test_reversed_flat_pages(self):
+        self.assert_pages(flat=True, reverse=True)
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_threaded_pages_from_db(self):
+        self.assert_pages()
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_flat_pages_from_db(self):
+        self.assert_pages(flat=True)
+
+    def test_before_first_page_returns_first_page(self):
+        clist = self.get_list()
+        items, prev, next = clist.get_cursor_page(2, before=clist.make_cursor(self.ab))
+        tools.assert_equals([self.a, self.ab], items)
+        tools.assert_equals(None, prev)
+
+    def test_cursor_of_other_list_type_is_rejected(self):
+        cursor = self.get_list(flat=True).make_cursor(self.a)
+        tools.assert_raises(ValueError, self.get_list().parse_cursor, cursor)
+        tools.assert_raises(ValueError, self.get_list().parse_cursor, 'garbage')
+
+
+class TestPosition(CommentTreeTestCase):
+    def assert_positions(self, **kwargs):
+        clist = self.get_list(**kwargs)
+        for i, c in enumerate(clist.get_list()):
+            tools.assert_equals(i, clist.get_position(c))
+
+    def test_positions_in_thread(self):
+        self.assert_positions()
+        self.assert_positions(reverse=True)
+        self.assert_positions(flat=True)
+        self.assert_positions(ids=[str(self.a.pk)])
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_positions_counted_in_db(self):
+        self.assert_positions()
+        self.assert_positions(reverse=True)
+        self.assert_positions(flat=True)
+        self.assert_positions(flat=True, reverse=True)
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_position_doesnt_load_comments(self):
+        self.assertNumQueries(1, lambda: self.get_list().get_position(self.de))
+
+    def test_non_public_comment_has_no_position(self):
+        self.ab.is_public = False
+        self.ab.save()
+        tools.assert_equals(None, self.get_list().get_position(self.ab))
+        tools.assert_equals(None, self.get_list(ids=[str(self.d.pk)]).get_position(self.a))
+
+
+@patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+class TestBranches(CommentTreeTestCase):
+    def test_adjacent_branches_are_one_range(self):
+        clist = self.get_list(ids=[str(self.d.pk), str(self.a.pk)])
+        sql = str(clist.get_query_set().query)
+        tools.assert_false('LIKE' in sql)
+        tools.assert_equals(1, sql.count('tree_path" >='))
+        tools.assert_equals([self.a, self.ab, self.ac, self.d, self.de], clist.get_list())
+
+    def test_branch_lists_are_cached_per_branch(self):
+        tools.assert_equals([self.a, self.ab, self.ac], self.get_list(ids=[str(self.a.pk)]).get_list())
+        # only the new branch is loaded
+        self.assertNumQueries(1, lambda: self.get_list(ids=[str(self.d.pk), str(self.a.pk)]).get_list())
+        self.assertNumQueries(0, lambda: self.get_list(ids=[str(self.d.pk)]).get_list())
+
+    def test_branch_counts_are_cached_per_branch(self):
+        tools.assert_equals(3, self.get_list(ids=[str(self.a.pk)]).count())
+        self.assertNumQueries(1, lambda: tools.assert_equals(5, self.get_list(ids=[str(self.a.pk), str(self.d.pk)]).count()))
+        self.assertNumQueries(0, lambda: tools.assert_equals(2, self.get_list(ids=[str(self.d.pk)]).count()))
+
+    def test_invalid_ids_are_ignored(self):
+        tools.assert_equals(2, self.get_list(ids=['x', str(self.d.pk)]).count())
+        tools.assert_equals(0, self.get_list(ids=['x']).count())
+
+
+class TestCollapsedList(CommentTreeTestCase):
+    def get_collapsed(self, replies=1, **kwargs):
+        return CollapsedCommentList(self.get_list(**kwargs), replies)
+
+    def assert_collapsed(self):
+        tools.assert_equals(2, len(self.get_collapsed()))
+        tools.assert_equals([self.a, self.ab, self.d, self.de], self.get_collapsed()[0:10])
+        tools.assert_equals([self.d, self.de], self.get_collapsed()[1:2])
+        tools.assert_equals([self.d, self.de, self.a, self.ab], self.get_collapsed(reverse=True)[0:10])
+        tools.assert_equals([self.a, self.d], self.get_collapsed(replies=0)[0:10])
+
+    def assert_replies(self):
+        clist = self.get_list()
+        items, cursor = clist.get_replies(self.a, 1)
+        tools.assert_equals([self.ab], items)
+        items, cursor = clist.get_replies(self.a, 1, after=cursor)
+        tools.assert_equals(([self.ac], None), (items, cursor))
+        tools.assert_equals(([self.de], None), clist.get_replies(self.d, 5))
+
+    def test_threads_from_full_thread(self):
+        self.assert_collapsed()
+        self.assert_replies()
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_threads_from_db(self):
+        self.assert_collapsed()
+        self.assert_replies()
+
+    def assert_depth(self):
+        abc = create_comment(self.publishable, self.publishable.content_type, parent_id=self.ab.pk)
+        tools.assert_equals([self.a, self.ab, abc, self.ac, self.d, self.de], self.get_collapsed(replies=3)[0:10])
+        tools.assert_equals([self.a, self.ab, self.ac, self.d, self.de], self.get_collapsed(replies=3, max_depth=2)[0:10])
+        tools.assert_equals([self.a, self.d], self.get_collapsed(replies=3, max_depth=1)[0:10])
+
+    def test_max_depth_from_full_thread(self):
+        self.assert_depth()
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_max_depth_from_db(self):
+        self.assert_depth()
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_first_replies_are_cached_per_thread(self):
+        # roots and one limited query for each thread
+        self.assertNumQueries(3, lambda: self.get_collapsed()[0:10])
+        self.assertNumQueries(0, lambda: self.get_collapsed()[0:10])
+        # other pages reuse the cached threads
+        self.assertNumQueries(1, lambda: self.get_collapsed()[1:2])
+
+
+class TestMaxDepth(CommentTreeTestCase):
+    def setUp(self):
+        super(TestMaxDepth, self).setUp()
+        self.abx = create_comment(self.publishable, self.publishable.content_type, parent_id=self.ab.pk)
+        self.abxy = create_comment(self.publishable, self.publishable.content_type, parent_id=self.abx.pk)
+
+    def assert_depth_limited(self):
+        clist = self.get_list(max_depth=2)
+        tools.assert_equals([self.a, self.ab, self.ac, self.d, self.de], clist.get_list())
+        tools.assert_equals(5, clist.count())
+        tools.assert_equals(None, clist.get_position(self.abx))
+        tools.assert_equals({self.ab: 2}, clist.get_truncated_counts(clist.get_list()))
+        tools.assert_equals([self.a, self.ab, self.ac], self.get_list(max_depth=2, ids=[str(self.a.pk)]).get_list())
+        tools.assert_equals(3, self.get_list(max_depth=2, ids=[str(self.a.pk)]).count())
+        tools.assert_equals(2, self.get_list(max_depth=1).count())
+
+    def test_depth_limited_from_full_thread(self):
+        self.assert_depth_limited()
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_depth_limited_in_db(self):
+        tools.assert_true('LENGTH(' in str(self.get_list(max_depth=2).get_query_set().query))
+        self.assert_depth_limited()
+
+    def test_depth_limited_lists_are_cached_separately(self):
+        tools.assert_equals(7, len(self.get_list()[0:10]))
+        tools.assert_equals(5, len(self.get_list(max_depth=2)[0:10]))
+
+
+class TestTreeTransforms(CommentTreeTestCase):
+    def setUp(self):
+        super(TestTreeTransforms, self).setUp()
+        self.abx = create_comment(self.publishable, self.publishable.content_type, parent_id=self.ab.pk)
+        self.packed = models.pack_comments(self.get_list().get_list())
+
+    def get_items(self):
+        return models.unpack_comments(self.packed)
+
+    def properties(self, items):
+        return [(c.pk, getattr(c, 'open', None), getattr(c, 'close', None), getattr(c, 'last', None)) for c in items]
+
+    def test_annotate_tree_matches_threadedcomments(self):
+        expected = self.properties(annotate_tree_properties(self.get_items()))
+        tools.assert_equals(expected, self.properties(models.annotate_tree(self.get_items())))
+        tools.assert_equals(expected, self.properties(models.annotate_tree(iter(self.get_items()))))
+
+    def test_fill_tree_matches_threadedcomments(self):
+        items = self.get_items()[3:]
+        expected = [(c.pk, getattr(c, 'added_path', False)) for c in fill_tree(items)]
+        tools.assert_equals(expected, [(c.pk, getattr(c, 'added_path', False)) for c in models.fill_tree(iter(items))])
+        tools.assert_equals([], list(models.fill_tree([])))
+
+    def test_threads_are_grouped_lazily(self):
+        calls = []
+        def prop(x):
+            calls.append(x)
+            return x // 2
+        tools.assert_equals([0, 1], next(models.iter_threads(count(), prop)))
+        # one call per item, the first item of the next thread was needed
+        tools.assert_equals([0, 1, 2], calls)
+
+    def test_transforms_chain(self):
+        threads = list(models.iter_threads(models.annotate_tree(self.get_items())))
+        tools.assert_equals([[self.a, self.ab, self.abx, self.ac], [self.d, self.de]], threads)
+        tools.assert_equals([0, 1], threads[0][3].close)
+
+
+class TestCachedAnnotations(CommentTreeTestCase):
+    def properties(self, items):
+        return [(c.pk, getattr(c, 'open', None), getattr(c, 'close', None), getattr(c, 'last', None)) for c in items]
+
+    def assert_annotations_cached(self):
+        expected = self.properties(models.annotate_tree(self.get_list().get_list(0, 4)))
+        with patch.object(models, 'annotate_tree', wraps=models.annotate_tree) as annotate:
+            items = self.get_list(annotate=True).get_list(0, 4)
+            tools.assert_equals(expected, self.properties(items))
+            tools.assert_equals([self.a, self.d], [c for c in items if getattr(c, 'new_thread', False)])
+
+            # the page is read from cache, annotations included
+            items = self.get_list(annotate=True).get_list(0, 4)
+            tools.assert_equals(expected, self.properties(items))
+            tools.assert_equals(1, annotate.call_count)
+
+    def test_annotations_of_pages_from_full_thread_are_cached(self):
+        self.assert_annotations_cached()
+
+    @patch.object(CachedCommentList, 'FULL_THREAD_SIZE', 0)
+    def test_annotations_of_pages_from_db_are_cached(self):
+        self.assert_annotations_cached()
+
+    def test_annotated_pages_of_different_branches_are_cached_separately(self):
+        items = self.get_list(ids=[str(self.a.pk)], annotate=True).get_list(0, 10)
+        tools.assert_equals([self.a, self.ab, self.ac], items)
+        items = self.get_list(ids=[str(self.d.pk)], annotate=True).get_list(0, 10)
+        tools.assert_equals([self.d, self.de], items)
+
+    def test_flat_lists_are_not_annotated(self):
+        items = self.get_list(annotate=True, flat=True).get_list(0, 4)
+        tools.assert_false(any(hasattr(c, 'open') for c in items))
+
+    def test_lists_packed_without_annotations_can_be_unpacked(self):
+        fields, records, extra = cPickle.loads(models.pack_comments([self.a, self.ab])[1])
+        packed = ('p', cPickle.dumps((fields, records)))
+        tools.assert_equals([self.a, self.ab], models.unpack_comments(packed))
+
+
+class TestBulkCounts(CachedCommentListTestCase):
+    def setUp(self):
+        super(TestBulkCounts, self).setUp()
+        self.patchers.append(patch.object(models, 'client', None))
+        self.patchers[-1].start()
+        create_comment(self.publishable, self.publishable.content_type)
+
+    def test_counts_are_cached(self):
+        objs = [self.publishable, self.category]
+        tools.assert_equals({count_key(self.publishable): 1, count_key(self.category): 0}, CachedCommentList.get_counts(objs))
+        self.assertNumQueries(0, lambda: CachedCommentList.get_counts(objs))
+
+    def test_counts_are_shared_with_comment_lists(self):
+        tools.assert_equals(1, self.get_list().count())
+        self.assertNumQueries(0, lambda: CachedCommentList.get_counts([self.publishable]))
+
+    def test_new_comment_invalidates_count(self):
+        CachedCommentList.get_counts([self.publishable])
+        create_comment(self.publishable, self.publishable.content_type)
+        tools.assert_equals({count_key(self.publishable): 2}, CachedCommentList.get_counts([self.publishable]))
+
+    def test_objects_equal_to_each_other_share_their_key(self):
+        # a Publishable equals its Article, an Author with the same pk doesn't
+        author = Author.objects.create(slug='author', pk=self.publishable.pk)
+        create_comment(author, ContentType.objects.get_for_model(author))
+        counts = CachedCommentList.get_counts([self.only_publishable, self.publishable, author])
+        tools.assert_equals({count_key(self.publishable): 1, count_key(author): 1}, counts)
+
+
+class TestBulkCommentOptions(CachedCommentListTestCase):
+    def setUp(self):
+        super(TestBulkCommentOptions, self).setUp()
+        self.authors = [Author.objects.create(name=n, slug=n) for n in ('a', 'b')]
+
+    def test_missing_options_are_cached(self):
+        opts = CommentOptionsObject.objects.get_for_objects(self.authors)
+        tools.assert_equals({self.authors[0]: models.DEFAULT_COMMENT_OPTIONS, self.authors[1]: models.DEFAULT_COMMENT_OPTIONS}, opts)
+        self.assertNumQueries(0, lambda: CommentOptionsObject.objects.get_for_objects(self.authors))
+
+    def test_options_for_all_objects_are_fetched_by_one_query(self):
+        CommentOptionsObject.objects.set_for_object(self.authors[1], blocked=True)
+        self.cache.clear()
+        self.assertNumQueries(1, lambda: CommentOptionsObject.objects.get_for_objects(self.authors))
+        tools.assert_true(CommentOptionsObject.objects.get_for_object(self.authors[1])['blocked'])
+        tools.assert_false(CommentOptionsObject.objects.get_for_object(self.authors[0])['blocked'])
+
+    def test_saved_options_invalidate_cache(self):
+        tools.assert_false(CommentOptionsObject.objects.get_for_object(self.authors[0])['blocked'])
+        CommentOptionsObject.objects.set_for_object(self.authors[0], blocked=True)
+        tools.assert_true(CommentOptionsObject.objects.get_for_object(self.authors[0])['blocked'])
+        CommentOptionsObject.objects.set_for_object(self.authors[0], blocked=False)
+        tools.assert_false(CommentOptionsObject.objects.get_for_object(self.authors[0])['blocked'])
+        CommentOptionsObject.objects.all().delete()
+        tools.assert_equals(models.DEFAULT_COMMENT_OPTIONS, CommentOptionsObject.objects.get_for_object(self.authors[0]))
+
+
+class TestPubInfo(CachedCommentListTestCase):
+    def setUp(self):
+        super(TestPubInfo, self).setUp()
+        self.comment = create_comment(self.publishable, self.publishable.content_type)
+
+    def test_loaded_comment_needs_no_query_for_pub_info(self):
+        c = comments.get_model().objects.get(pk=self.comment.pk)
+        c.is_public = False
+        self.assertNumQueries(0, lambda: models.comment_pre_save(c))
+        tools.assert_equals({'is_public': True, 'is_removed': False}, getattr(c, '__pub_info'))
+
+    def test_pub_info_follows_saves_of_the_same_instance(self):
+        self.comment.is_removed = True
+        self.comment.save()
+        tools.assert_equals({'is_public': True, 'is_removed': False}, getattr(self.comment, '__pub_info'))
+        self.comment.is_public = False
+        self.comment.save()
+        tools.assert_equals({'is_public': True, 'is_removed': True}, getattr(self.comment, '__pub_info'))
+
+    def test_unsaved_instance_with_pk_reads_old_values_from_db(self):
+        c = comments.get_model()(pk=self.comment.pk, is_public=False)
+        self.assertNumQueries(1, lambda: models.comment_pre_save(c))
+        tools.assert_equals({'is_public': True, 'is_removed': False}, getattr(c, '__pub_info'))
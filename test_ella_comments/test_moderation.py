@@ -0,0 +1,131 @@
+from django.contrib import comments
+from django.contrib.auth.models import User
+from django.contrib.comments.models import CommentFlag
+from django.db.models.signals import post_delete
+from django.test import TestCase
+
+from ella.core.cache.redis import client
+from ella.utils.test_helpers import create_basic_categories, create_and_place_a_publishable
+
+from ella_comments import moderation
+from ella_comments.listing_handlers import COMCOUNT_KEY, LASTCOM_KEY, PENDING_SITE_KEY, \
+    PENDING_COUNT_KEY, get_pending_counts, get_reply_counts
+from ella_comments.signals import comment_removed, comments_removed
+
+from nose import tools, SkipTest
+
+from test_ella_comments.helpers import create_comment
+
+
+class TestBulkModeration(TestCase):
+    def setUp(self):
+        if not client:
+            raise SkipTest()
+
+        super(TestBulkModeration, self).setUp()
+        create_basic_categories(self)
+        create_and_place_a_publishable(self)
+        client.flushdb()
+
+        ct = self.publishable.content_type
+        self.a = create_comment(self.publishable, ct, user_name='a')
+        self.ab = create_comment(self.publishable, ct, user_name='ab', parent_id=self.a.pk)
+        self.c = create_comment(self.publishable, ct, user_name='c')
+
+        self.count_key = COMCOUNT_KEY % (ct.pk, self.publishable.pk)
+        self.last_key = LASTCOM_KEY % (ct.pk, self.publishable.pk)
+        self.removed = []
+        self.receiver = lambda comments, **kwargs: self.removed.append(comments)
+        comments_removed.connect(self.receiver, weak=False)
+
+    def tearDown(self):
+        comments_removed.disconnect(self.receiver)
+        client.flushdb()
+        super(TestBulkModeration, self).tearDown()
+
+    def get_qs(self, *comments_):
+        return comments.get_model().objects.filter(pk__in=[c.pk for c in comments_])
+
+    def test_remove_updates_counters_and_sends_one_signal(self):
+        tools.assert_equals(2, moderation.remove_comments(self.get_qs(self.ab, self.c)))
+        tools.assert_equals('1', client.get(self.count_key))
+        tools.assert_equals('a', client.hget(self.last_key, 'username'))
+        tools.assert_equals(1, len(self.removed))
+        tools.assert_equals(set([self.ab.pk, self.c.pk]), set(c.pk for c in self.removed[0]))
+
+    def test_already_removed_comments_are_skipped(self):
+        moderation.remove_comments(self.get_qs(self.c))
+        tools.assert_equals(0, moderation.remove_comments(self.get_qs(self.c)))
+
+    def test_approve_restores_counters(self):
+        moderation.remove_comments(self.get_qs(self.a, self.ab, self.c))
+        tools.assert_equals('0', client.get(self.count_key))
+        tools.assert_false(client.exists(self.last_key))
+
+        tools.assert_equals(3, moderation.approve_comments(self.get_qs(self.a, self.ab, self.c)))
+        tools.assert_equals('3', client.get(self.count_key))
+        tools.assert_equals('c', client.hget(self.last_key, 'username'))
+
+    def test_delete_includes_replies(self):
+        tools.assert_equals(2, moderation.delete_comments(self.get_qs(self.a)))
+        tools.assert_equals([self.c], list(comments.get_model().objects.all()))
+        tools.assert_equals('1', client.get(self.count_key))
+
+    def test_delete_whole_thread(self):
+        moderation.delete_comments(comments.get_model().objects.all())
+        tools.assert_equals(0, comments.get_model().objects.count())
+        tools.assert_equals('0', client.get(self.count_key))
+        tools.assert_equals([], client.zrange('lastcom:ct:%d' % self.publishable.content_type_id, 0, -1))
+        tools.assert_equals(1, len(self.removed))
+
+    def test_approved_comments_leave_pending_queue(self):
+        ct = self.publishable.content_type
+        pending = create_comment(self.publishable, ct, is_public=False)
+        key = PENDING_SITE_KEY % pending.site_id
+        tools.assert_equals([str(pending.pk)], client.zrange(key, 0, -1))
+        tools.assert_equals([1], get_pending_counts([(ct.pk, pending.object_pk)]))
+
+        moderation.approve_comments(self.get_qs(pending))
+        tools.assert_equals([], client.zrange(key, 0, -1))
+        tools.assert_equals([0], get_pending_counts([(ct.pk, pending.object_pk)]))
+
+    def test_deleted_comments_leave_pending_queue(self):
+        ct = self.publishable.content_type
+        pending = create_comment(self.publishable, ct, is_public=False)
+        moderation.delete_comments(self.get_qs(pending))
+        tools.assert_equals([], client.zrange(PENDING_SITE_KEY % pending.site_id, 0, -1))
+        tools.assert_equals('0', client.get(PENDING_COUNT_KEY % (ct.pk, pending.object_pk)))
+
+    def test_delete_handles_related_objects_and_signals(self):
+        user = User.objects.create(username='flagger')
+        CommentFlag.objects.create(comment=self.ab, user=user, flag='removal suggestion')
+        deleted = []
+        receiver = lambda instance, **kwargs: deleted.append(instance.pk)
+        post_delete.connect(receiver, sender=comments.get_model(), weak=False)
+        try:
+            moderation.delete_comments(self.get_qs(self.a))
+        finally:
+            post_delete.disconnect(receiver, sender=comments.get_model())
+        tools.assert_equals(set([self.a.pk, self.ab.pk]), set(deleted))
+        tools.assert_equals(0, CommentFlag.objects.count())
+
+    def test_delete_sends_only_the_aggregated_signal(self):
+        removed = []
+        receiver = lambda comment, **kwargs: removed.append(comment.pk)
+        comment_removed.connect(receiver, weak=False)
+        try:
+            moderation.delete_comments(self.get_qs(self.a, self.c))
+        finally:
+            comment_removed.disconnect(receiver)
+        tools.assert_equals([], removed)
+        tools.assert_equals(1, len(self.removed))
+        tools.assert_equals(set([self.a.pk, self.ab.pk, self.c.pk]), set(c.pk for c in self.removed[0]))
+
+    def test_delete_reply_updates_reply_counts(self):
+        moderation.delete_comments(self.get_qs(self.ab))
+        tools.assert_equals({self.a.pk: 0}, get_reply_counts(self.publishable.content_type_id, self.publishable.pk, [self.a.pk]))
+
+    def test_delete_reply_fixes_last_child_of_parent(self):
+        ac = create_comment(self.publishable, self.publishable.content_type, parent_id=self.a.pk)
+        moderation.delete_comments(self.get_qs(ac))
+        tools.assert_equals(self.ab.pk, comments.get_model().objects.get(pk=self.a.pk).last_child_id)
@@ -4,11 +4,18 @@ from nose import tools
 from mock import patch
 
 from django import template
+from django.contrib import comments
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
 from ella.core.cache.redis import client
 from ella.utils.test_helpers import create_basic_categories, create_and_place_a_publishable
 
+from ella_comments import models
 from ella_comments.listing_handlers import COMCOUNT_KEY
+from ella_comments.moderation import remove_comments
+from ella_comments.signals import comment_updated
 
+from test_ella_comments import template_loader
 from test_ella_comments.helpers import create_comment
 
 class TestTemplateTags(TestCase):
@@ -34,6 +41,26 @@ class TestTemplateTagsWithoutRedis(TestTemplateTags):
         t = template.Template('''{% load ellacomments_tags %}{% get_comment_count for obj as var_name%}{{ var_name }}''')
         tools.assert_equals('1', t.render(template.Context({'obj': self.only_publishable})))
 
+    @patch('ella_comments.models.client', None)
+    def test_comment_counts_for_many_objects_use_one_query(self):
+        category_ct = ContentType.objects.get_for_model(self.category)
+        create_comment(self.publishable, self.publishable.content_type)
+        create_comment(self.publishable, self.publishable.content_type)
+        create_comment(self.category, category_ct)
+        t = template.Template('''{% load ellacomments_tags %}{% get_comment_counts for objs as counts %}{% for o in objs %}{{ counts|count_for:o }}{% endfor %}''')
+        ctx = template.Context({'objs': [self.only_publishable, self.category, self.category_nested]})
+        self.assertNumQueries(1, lambda: tools.assert_equals('210', t.render(ctx)))
+
+    @patch('ella_comments.models.client', None)
+    def test_reply_counts_are_counted_in_one_query(self):
+        ct = self.publishable.content_type
+        a = create_comment(self.publishable, ct)
+        create_comment(self.publishable, ct, parent_id=a.pk)
+        create_comment(self.publishable, ct, parent_id=a.pk)
+        d = create_comment(self.publishable, ct)
+        t = template.Template('''{% load ellacomments_tags %}{% get_reply_counts for roots as replies %}{% for c in roots %}{{ replies|count_for:c }},{% endfor %}''')
+        self.assertNumQueries(1, lambda: tools.assert_equals(u'2,0,', t.render(template.Context({'roots': [a, d]}))))
+
     def tearDown(self):
         self.patcher.stop()
 
@@ -55,6 +82,26 @@ class TestTemplateTagsWithRedis(TestTemplateTags):
         t = template.Template('''{% load ellacomments_tags %}{% get_comment_list for obj as var_name%}{{ var_name|length }}''')
         tools.assert_equals('1', t.render(template.Context({'obj': self.only_publishable})))
 
+    def test_comment_list_can_be_depth_limited(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        ab = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        create_comment(self.publishable, self.publishable.content_type, parent_id=ab.pk)
+        t = template.Template('''{% load ellacomments_tags %}{% get_comment_list for obj as var_name max_depth depth %}{{ var_name|length }}''')
+        tools.assert_equals('2', t.render(template.Context({'obj': self.publishable, 'depth': 2})))
+
+    def test_group_threads_filter_returns_a_list(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        create_comment(self.publishable, self.publishable.content_type)
+        t = template.Template('''{% load ellacomments_tags %}{% with comments|group_threads as threads %}{{ threads|length }}{% for t in threads %}{{ t|length }}{% endfor %}{% for t in threads %}.{% endfor %}{% endwith %}''')
+        tools.assert_equals(u'221..', t.render(template.Context({'comments': comments.get_model().objects.order_by('tree_path')})))
+
+    def test_iter_threads_filter_groups_lazily(self):
+        a = create_comment(self.publishable, self.publishable.content_type)
+        create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        t = template.Template('''{% load ellacomments_tags %}{% for t in comments|iter_threads %}{{ t|length }}{% endfor %}''')
+        tools.assert_equals(u'2', t.render(template.Context({'comments': comments.get_model().objects.order_by('tree_path')})))
+
     def test_default_comment_options_for_article(self):
         create_comment(self.publishable, self.publishable.content_type)
         t = template.Template('''{% load ellacomments_tags %}{% get_comment_options for obj as opts %}{% if not opts.blocked %}XX{% endif %}''')
@@ -65,3 +112,94 @@ class TestTemplateTagsWithRedis(TestTemplateTags):
         CommentOptionsObject.objects.set_for_object(self.publishable, blocked=True)
         t = template.Template('''{% load ellacomments_tags %}{% get_comment_options for obj as opts %}{% if opts.blocked %}XX{% endif %}''')
         tools.assert_equals(u"XX", t.render(template.Context({'obj': self.publishable})))
+
+    def test_comment_counts_for_many_objects_are_picked_up_from_redis(self):
+        client.set(COMCOUNT_KEY % (self.publishable.content_type.pk, self.publishable.pk), '10')
+        t = template.Template('''{% load ellacomments_tags %}{% get_comment_counts for objs as counts %}{% for o in objs %}{{ counts|count_for:o }},{% endfor %}''')
+        tools.assert_equals(u'10,0,', t.render(template.Context({'objs': [self.publishable, self.category]})))
+
+    def test_reply_counts_are_picked_up_from_redis(self):
+        ct = self.publishable.content_type
+        a = create_comment(self.publishable, ct)
+        ab = create_comment(self.publishable, ct, parent_id=a.pk)
+        create_comment(self.publishable, ct, parent_id=ab.pk)
+        d = create_comment(self.publishable, ct)
+        t = template.Template('''{% load ellacomments_tags %}{% get_reply_counts for comments as replies %}{% for c in comments %}{{ replies|count_for:c }},{% endfor %}''')
+        ctx = template.Context({'comments': [a, ab, d]})
+        self.assertNumQueries(0, lambda: tools.assert_equals(u'2,0,0,', t.render(ctx)))
+
+
+class TestRenderComments(TestTemplateTags):
+    def setUp(self):
+        super(TestRenderComments, self).setUp()
+        # tests run with dummy cache, use a real one to test invalidation
+        self.cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        self.cache.clear()
+        self.patcher = patch.object(models, 'cache', self.cache)
+        self.patcher.start()
+
+        ct = self.publishable.content_type
+        self.a = create_comment(self.publishable, ct, comment='first')
+        self.b = create_comment(self.publishable, ct, comment='second')
+        template_loader.templates['comment_item.html'] = '{{ comment.comment }},'
+        self.t = template.Template('''{% load ellacomments_tags %}{% render_comments comments using "comment_item.html" %}''')
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.cache.clear()
+        template_loader.templates = {}
+        super(TestRenderComments, self).tearDown()
+
+    def render(self, **context):
+        context.setdefault('comments', [self.a, self.b])
+        return self.t.render(template.Context(context))
+
+    def test_comments_are_rendered(self):
+        tools.assert_equals(u'first,second,', self.render())
+
+    def test_cached_fragments_are_not_rendered_again(self):
+        self.render()
+        template_loader.templates['comment_item.html'] = 'changed,'
+        tools.assert_equals(u'first,second,', self.render())
+
+    def test_updated_comment_is_rendered_again(self):
+        self.render()
+        template_loader.templates['comment_item.html'] = 'changed,'
+        comment_updated.send(sender=self.a.__class__, comment=self.a)
+        tools.assert_equals(u'changed,second,', self.render())
+
+    def test_removed_comments_are_rendered_again(self):
+        self.render()
+        template_loader.templates['comment_item.html'] = 'changed,'
+        remove_comments(comments.get_model().objects.filter(pk=self.b.pk))
+        tools.assert_equals(u'first,changed,', self.render())
+
+    def test_fragments_are_fetched_at_once(self):
+        self.render()
+        with patch.object(self.cache, 'get_many', wraps=self.cache.get_many) as get_many:
+            self.render()
+        tools.assert_equals(1, get_many.call_count)
+
+    def test_page_variables_are_not_rendered_into_fragments(self):
+        template_loader.templates['comment_item.html'] = '{{ user }}{{ comment.comment }},'
+        tools.assert_equals(u'first,second,', self.render(user='alice'))
+        tools.assert_equals(u'first,second,', self.render(user='bob'))
+
+    def test_fragments_depend_on_tree_annotations(self):
+        template_loader.templates['comment_item.html'] = '{{ comment.comment }}{% if comment.open %}<{% endif %},'
+        tools.assert_equals(u'first,second,', self.render())
+        self.a.open = True
+        tools.assert_equals(u'first<,second,', self.render())
+
+    def test_fragments_of_comments_changed_while_rendering_are_not_cached(self):
+        def context(*args):
+            models.bump_versions([self.a.pk])
+            return template.Context(*args)
+        with patch.object(models, 'Context', side_effect=context):
+            self.render(comments=[self.a])
+        template_loader.templates['comment_item.html'] = 'changed,'
+        tools.assert_equals(u'changed,', self.render(comments=[self.a]))
+
+    def test_template_is_looked_up_for_object(self):
+        template_loader.templates['page/comment_item.html'] = '[{{ comment.comment }}]'
+        tools.assert_equals(u'[first][second]', self.render(object=self.publishable))
@@ -7,12 +7,15 @@ from urlparse import urlparse
 from django.conf import settings
 from django.contrib import comments
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.cache import cache
 from django.template.defaultfilters import slugify
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.utils.translation import ugettext as _
+from django.utils import simplejson
 
-from nose import tools
+from nose import tools, SkipTest
 
 from ella.core.cache.redis import client
 from ella.core.cache import utils
@@ -21,7 +24,7 @@ from ella.utils.test_helpers import create_basic_categories, create_and_place_a_
 # register must be imported for custom urls
 from ella_comments import register
 from ella_comments.models import CommentOptionsObject
-from ella_comments import views, models
+from ella_comments import views, models, listing_handlers
 
 from test_ella_comments.helpers import create_comment
 from test_ella_comments import template_loader
@@ -117,6 +120,27 @@ class TestCommentViewPagination(CommentViewTestCase):
         tools.assert_equals(200, response.status_code)
         tools.assert_equals([a, ab, ac], list(response.context['comment_list']))
 
+    def test_get_list_with_cursor_returns_following_page(self):
+        template_loader.templates['page/comment_list.html'] = ''
+        a = create_comment(self.publishable, self.publishable.content_type)
+        d = create_comment(self.publishable, self.publishable.content_type)
+        ab = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        de = create_comment(self.publishable, self.publishable.content_type, parent_id=d.pk)
+        def_ = create_comment(self.publishable, self.publishable.content_type, parent_id=de.pk)
+        ac = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        response = self.client.get(self.get_url())
+        response = self.client.get(self.get_url(), {'after': response.context['next_cursor']})
+        tools.assert_equals(200, response.status_code)
+        tools.assert_equals([d, de, def_], list(response.context['comment_list']))
+        tools.assert_equals(None, response.context['next_cursor'])
+        response = self.client.get(self.get_url(), {'before': response.context['prev_cursor']})
+        tools.assert_equals([a, ab, ac], list(response.context['comment_list']))
+
+    def test_get_list_raises_404_on_invalid_cursor(self):
+        template_loader.templates['404.html'] = ''
+        response = self.client.get(self.get_url(), {'after': 'invalid'})
+        tools.assert_equals(404, response.status_code)
+
 class TestCommentModeration(CommentViewTestCase):
     def setUp(self):
         super(TestCommentModeration, self).setUp()
@@ -138,6 +162,42 @@ class TestCommentModeration(CommentViewTestCase):
         tools.assert_true('comment_list' in response.context)
         tools.assert_equals(0, len(response.context['comment_list']))
 
+    def get_queue(self, url='/moderation/'):
+        if not User.objects.filter(username='staff').exists():
+            User.objects.create_superuser(username='staff', email='bar@bar.com', password='test')
+            self.client.login(username='staff', password='test')
+        response = self.client.get(url, {'format': 'json'})
+        tools.assert_equals(200, response.status_code)
+        return simplejson.loads(response.content)
+
+    def test_moderation_queue_requires_permission(self):
+        if not client:
+            raise SkipTest()
+        tools.assert_equals(403, self.client.get('/moderation/').status_code)
+
+    def test_premoderated_comments_are_queued(self):
+        if not client:
+            raise SkipTest()
+        self.client.post(self.get_url('new'), self.get_form_data(self.form))
+        comment = comments.get_model().objects.all()[0]
+        data = self.get_queue()
+        tools.assert_equals([comment.pk], data['comment_list'])
+        tools.assert_equals(1, data['total'])
+        tools.assert_equals([comment.pk], self.get_queue('/moderation/%d/' % self.publishable.category_id)['comment_list'])
+        tools.assert_equals([1], listing_handlers.get_pending_counts([(comment.content_type_id, comment.object_pk)]))
+
+    def test_stale_comments_are_dropped_from_queue(self):
+        if not client:
+            raise SkipTest()
+        self.client.post(self.get_url('new'), self.get_form_data(self.form))
+        # bypass the signals like a queryset update does
+        comments.get_model().objects.update(is_public=True)
+        tools.assert_equals([], self.get_queue()['comment_list'])
+        tools.assert_equals(0, client.zcard(listing_handlers.PENDING_SITE_KEY % settings.SITE_ID))
+        tools.assert_equals(0, client.zcard(listing_handlers.PENDING_CATEGORY_KEY % self.publishable.category_id))
+        tools.assert_equals([0], listing_handlers.get_pending_counts([(self.publishable.content_type_id, self.publishable.pk)]))
+        tools.assert_equals('0', client.get(listing_handlers.PENDING_COUNT_KEY % (self.publishable.content_type_id, self.publishable.pk)))
+
 class TestCommentViews(CommentViewTestCase):
 
     def test_comments_urls_is_blocked(self):
@@ -257,6 +317,55 @@ class TestCommentViews(CommentViewTestCase):
         tools.assert_equals(200, response.status_code)
         tools.assert_equals([a, ab, ac, d, de, def_], list(response.context['comment_list']))
 
+    def test_get_list_collapsed_pages_by_threads(self):
+        template_loader.templates['page/comment_list.html'] = ''
+        a = create_comment(self.publishable, self.publishable.content_type)
+        d = create_comment(self.publishable, self.publishable.content_type)
+        ab = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        ac = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        de = create_comment(self.publishable, self.publishable.content_type, parent_id=d.pk)
+        response = self.client.get(self.get_url(), {'collapsed': 1, 'pby': 1})
+        tools.assert_equals(200, response.status_code)
+        tools.assert_equals([a, ab], list(response.context['comment_list']))
+        tools.assert_equals(2, response.context['page'].paginator.num_pages)
+        # cursors would leave the collapsed mode
+        tools.assert_equals(None, response.context['next_cursor'])
+
+    def test_get_list_collapsed_and_limited_by_depth(self):
+        template_loader.templates['page/comment_list.html'] = ''
+        a = create_comment(self.publishable, self.publishable.content_type)
+        create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        response = self.client.get(self.get_url(), {'collapsed': 3, 'depth': 1})
+        tools.assert_equals([a], list(response.context['comment_list']))
+        tools.assert_equals({a: 1}, response.context['truncated_counts'])
+
+    def test_get_list_limited_by_depth_reports_truncated_replies(self):
+        template_loader.templates['page/comment_list.html'] = ''
+        a = create_comment(self.publishable, self.publishable.content_type)
+        ab = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        create_comment(self.publishable, self.publishable.content_type, parent_id=ab.pk)
+        response = self.client.get(self.get_url(), {'depth': 2})
+        tools.assert_equals([a, ab], list(response.context['comment_list']))
+        tools.assert_equals({ab: 1}, response.context['truncated_counts'])
+
+    def test_replies_are_paged_by_cursor(self):
+        template_loader.templates['page/comment_replies.html'] = ''
+        a = create_comment(self.publishable, self.publishable.content_type)
+        ab = create_comment(self.publishable, self.publishable.content_type, parent_id=a.pk)
+        abc = create_comment(self.publishable, self.publishable.content_type, parent_id=ab.pk)
+        d = create_comment(self.publishable, self.publishable.content_type)
+        response = self.client.get(self.get_url('replies', a.pk), {'pby': 1})
+        tools.assert_equals(200, response.status_code)
+        tools.assert_equals([ab], response.context['comment_list'])
+        response = self.client.get(self.get_url('replies', a.pk), {'pby': 1, 'after': response.context['next_cursor']})
+        tools.assert_equals([abc], response.context['comment_list'])
+        tools.assert_equals(None, response.context['next_cursor'])
+
+    def test_replies_raise_404_for_comment_of_other_object(self):
+        template_loader.templates['404.html'] = ''
+        a = create_comment(self.category, ContentType.objects.get_for_model(self.category))
+        tools.assert_equals(404, self.client.get(self.get_url('replies', a.pk)).status_code)
+
 class TestUpdateComment(CommentViewTestCase):
     def setUp(self):
         super(TestUpdateComment, self).setUp()
@@ -276,6 +385,14 @@ class TestUpdateComment(CommentViewTestCase):
         tools.assert_raises(comments.get_model().DoesNotExist, lambda: views.update_comment.get_comment_for_user(self.publishable, boy, 1024))
         tools.assert_raises(comments.get_model().DoesNotExist, lambda: views.update_comment.get_comment_for_user(self.publishable, boy, second.pk))
 
+    @override_settings(COMMENTS_ALLOW_MODERATOR_UPDATE=False)
+    def test_get_comment_for_user_can_deny_access(self):
+        comment = create_comment(self.publishable, self.publishable.content_type, comment='first', user=self.user_foo)
+        self.client.login(username='foo', password='test')
+        with mock.patch.object(views.update_comment, 'get_comment_for_user', side_effect=comments.get_model().DoesNotExist):
+            response = self.client.get(self.get_url('update', comment.id))
+        tools.assert_equals(404, response.status_code)
+
     def test_get_update_comment_form(self):
         comment = create_comment(self.publishable, self.publishable.content_type, comment='some comment')
         form = views.update_comment.get_update_comment_form(self.publishable, comment, None, None)
@@ -1,5 +1,8 @@
 from django.conf.urls.defaults import *
 
+from ella_comments.urls import moderation_urlpatterns
+
 urlpatterns = patterns('',
+    (r'^moderation/', include(moderation_urlpatterns)),
     (r'^', include('ella.core.urls')),
 )